@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""Perceptual hashing, to spot near-identical source images.
+
+Hashtag streams are full of default avatars and re-uploads of the same
+photo; indexed separately, they make the mosaic repetitive.  Each image
+gets a 64 bits *difference hash* (dHash): the image is shrunk to 9x8
+gray pixels and each bit tells whether a pixel is brighter than its
+right neighbour.  Re-encoded or resized copies of the same picture end
+up with hashes differing by a few bits at most.
+
+``HashIndex`` finds, among the hashes seen so far, one within
+`max_distance` bits of a new one.  The 64 bits are split in
+`max_distance` + 1 bands: two hashes that close necessarily have one
+band in common, so only images sharing a band are compared.
+
+"""
+
+from PIL import Image
+
+HASH_BITS = 64
+
+
+def dhash(image, size=8):
+    """Return the difference hash of a PIL image, as an integer."""
+    pixels = list(image.convert('L').resize((size + 1, size),
+                                            Image.LANCZOS).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            offset = row * (size + 1) + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def hamming(a, b):
+    """Return the number of different bits of two hashes.
+    >>> hamming(0b1011, 0b0010)
+    2
+    """
+    return bin(a ^ b).count('1')
+
+
+def to_hex(value):
+    """
+    >>> to_hex(255)
+    '00000000000000ff'
+    """
+    return '%016x' % value
+
+
+def from_hex(value):
+    """
+    >>> from_hex('00000000000000ff')
+    255
+    """
+    return int(value, 16)
+
+
+class HashIndex(object):
+    """Canonical images by hash, with reference counts.
+
+    >>> index = HashIndex(max_distance=2)
+    >>> index.add(0b1111 << 40, 'a.jpg')
+    'a.jpg'
+    >>> index.add((0b1111 << 40) | 1, 'b.jpg')
+    'a.jpg'
+    >>> index.add(0b1111, 'c.jpg')
+    'c.jpg'
+    >>> index.refcount['a.jpg']
+    2
+    """
+
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        width = HASH_BITS // bands
+        #(shift, mask) of each band, the last one takes the extra bits
+        self._bands = []
+        for i in range(bands):
+            bits = width if i < bands - 1 else HASH_BITS - width * i
+            self._bands.append((width * i, (1 << bits) - 1))
+        self._buckets = [{} for band in self._bands]
+        self._hashes = {}
+        self.refcount = {}
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _keys(self, value):
+        return [(value >> shift) & mask for (shift, mask) in self._bands]
+
+    def find(self, value):
+        """Return the key of a canonical image close to `value`, or None."""
+        best = (self.max_distance + 1, None)
+        for (bucket, band) in zip(self._buckets, self._keys(value)):
+            for key in bucket.get(band, ()):
+                distance = hamming(value, self._hashes[key])
+                if distance < best[0]:
+                    best = (distance, key)
+        return best[1]
+
+    def insert(self, value, key, refcount=1):
+        """Register `key` as a canonical image."""
+        self._hashes[key] = value
+        self.refcount[key] = refcount
+        for (bucket, band) in zip(self._buckets, self._keys(value)):
+            bucket.setdefault(band, []).append(key)
+
+    def add(self, value, key):
+        """Return the canonical key for an image hashed as `value`: an
+        existing near duplicate (its reference count is incremented), or
+        `key` itself, which becomes canonical."""
+        canonical = self.find(value)
+        if canonical is None:
+            self.insert(value, key)
+            return key
+        self.refcount[canonical] += 1
+        return canonical
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
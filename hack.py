@@ -26,10 +26,15 @@ from tweepy.streaming import StreamListener
 from tweepy import OAuthHandler
 from tweepy import Stream
 
+import atexit
+import csv
 import json
 import os
 import requests
 import shutil
+import time
+
+from tilestore import TileStore
 
 
 auth = tweepy.OAuthHandler(settings.consumer_key, settings.consumer_secret)
@@ -38,41 +43,84 @@ auth.set_access_token(settings.access_token, settings.access_token_secret)
 
 api = tweepy.API(auth)
 
+#replay.py serves a local stand-in of the stream/search apis,
+#for load testing: replay_url = 'http://localhost:8765'
+replay_url = getattr(settings, 'replay_url', None)
+
 #print(api.me().name) #needs access_tokens
-print(api.rate_limit_status())
+if not replay_url:
+    print(api.rate_limit_status())
 
 
 class CsvFile:
-    def __init__(self, imgdir, csvfile):
+    def __init__(self, imgdir, csvfile, store=None,
+                 flush_rows=500, flush_seconds=2.0):
         self.imgdir = imgdir
         self.csvfile = csvfile
+        #packed TileStore path -- images are added to it instead of imgdir
+        #(keeping imgdir/<user_id>.<ext> as their id)
+        self.store = TileStore(store, mode='a') if store else None
+        #rows are buffered and written out when there are flush_rows
+        #of them, or when the oldest one waited flush_seconds
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._rows = []
+        self._first_row_at = None
+        #the csv module writes its own line endings
+        if sys.version_info[0] < 3:
+            self._csv = open(self.csvfile, 'ab')
+        else:
+            self._csv = open(self.csvfile, 'a', newline='')
+        self._writer = csv.writer(self._csv)
+
+    def flush(self):
+        if self._rows:
+            self._writer.writerows(self._rows)
+            self._csv.flush()
+        self._rows = []
+        self._first_row_at = None
+
+    def close(self):
+        self.flush()
+        self._csv.close()
 
-        
     def save_data(self, img_url, tweet_id, user_id, text=None):
         ext = img_url.rsplit('.', 1)[1]
         if ext not in ('jpg', 'png', 'jpeg'):
             return
         path = os.path.join(self.imgdir, '%s.%s' % (user_id, ext))
-        with open(self.csvfile, 'a') as ff:
-            ff.write(
-                "%s,%s,%s,%s\n" % (tweet_id, user_id, img_url, str(text))
-            )
-            
-        r = requests.get(img_url, stream=True)
-        if r.status_code == 200:
+        #csv takes care of quoting commas/newlines inside the text
+        self._rows.append((tweet_id, user_id, img_url, text or ''))
+        now = time.time()
+        if self._first_row_at is None:
+            self._first_row_at = now
+        if len(self._rows) >= self.flush_rows \
+           or now - self._first_row_at >= self.flush_seconds:
+            self.flush()
+
+        r = requests.get(img_url, stream=not self.store)
+        if r.status_code == 200 and self.store:
+            self.store.add(path, r.content)
+        elif r.status_code == 200:
             with open(path, 'wb') as f:
                 r.raw.decode_content = True
                 shutil.copyfileobj(r.raw, f)
 
 #a = api.search(q='#DoYourJob filter:safe', rpp=100)
 
+def search(**kwargs):
+    if not replay_url:
+        return api.search(**kwargs)
+    r = requests.get(replay_url + '/1.1/search/tweets.json', params=kwargs)
+    return [tweepy.Status.parse(api, s) for s in r.json()['statuses']]
+
 def get_past_tweets():
     least_tweet = None
     all_queries = []
     bunch = []
     all_ids = set()
     for x in range(100):
-        a = list(api.search(q='#DoYourJob filter:safe', rpp=100, max_id=least_tweet))
+        a = list(search(q='#DoYourJob filter:safe', rpp=100, max_id=least_tweet))
         all_queries.append(a)
         ids = [int(x.id_str) for x in a]
         bunch.append(ids)
@@ -88,7 +136,9 @@ def get_past_tweets():
 #since_id, max_id, 
 #include_entities=False
 
-ccc = CsvFile('images2/', 'downloads.csv')
+ccc = CsvFile('images2/', 'downloads.csv',
+              store=getattr(settings, 'tile_store', None))
+atexit.register(ccc.close)
 
 #for x in range(100):
 
@@ -112,9 +162,16 @@ class StdOutListener(StreamListener):
 
 stdout = StdOutListener()
 
-stream = Stream(auth, stdout)
-#stream.filter(track=['#BernieOrBust'])
-stream.filter(track=['#FeelTheBern'], async=True)
+if replay_url:
+    r = requests.post(replay_url + '/1.1/statuses/filter.json',
+                      data={'track': '#FeelTheBern'}, stream=True)
+    for line in r.iter_lines():
+        if line:
+            stdout.on_data(line.decode('utf-8'))
+else:
+    stream = Stream(auth, stdout)
+    #stream.filter(track=['#BernieOrBust'])
+    stream.filter(track=['#FeelTheBern'], async=True)
 
 #stream.disconnect() causes thread to end/stop
 #os.listdir('./')
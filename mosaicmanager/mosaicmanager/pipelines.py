@@ -2,4 +2,265 @@
 upload to s3
  serve locally (can always do this, as well)
 
+A render is published as a directory named after the mosaic's slug:
+
+    <slug>/render.jpg       the mosaic (and blended.jpg, if preblended)
+    <slug>/layout.json      the layout payload (see mosaicrenderer.views)
+    <slug>/render.dzi       its Deep Zoom pyramid, if one was rendered
+    <slug>/render_files/... (see pyramid.py)
+
+then Mosaic.public_url is set to the directory.  With
+MOSAIC_PUBLISH_BUCKET, files go to that S3 bucket (MOSAIC_PUBLISH_ENDPOINT
+for any S3-compatible store: minio, or moto_server to test locally);
+without, they are copied under MEDIA_ROOT/published and served with the
+media files.  MOSAIC_PUBLISH_URL overrides the base url (e.g. a CDN).
+
+Viewers fetch the files straight from public_url, so they have to be
+publicly readable.  Objects are uploaded with the MOSAIC_PUBLISH_ACL
+canned ACL ('public-read' by default).  Buckets with ACLs disabled (the
+default of new S3 buckets) refuse it: set MOSAIC_PUBLISH_ACL = None and
+grant the reads with a bucket policy instead:
+
+    {"Version": "2012-10-17",
+     "Statement": [{"Effect": "Allow", "Principal": "*",
+                    "Action": "s3:GetObject",
+                    "Resource": "arn:aws:s3:::<bucket>/*"}]}
+
+With a CDN in front of a private bucket, grant them to the CDN only.
+
+Most of the tiles of a pyramid don't change from one render to the
+next.  Each published directory has a manifest (manifest.json: key ->
+md5 of the content) of what is there: only files whose content changed
+are sent, and files no longer part of the render are removed.  Files are
+hashed and sent by a pool of MOSAIC_PUBLISH_WORKERS threads sharing
+pooled connections; large files are uploaded in parallel parts.  The
+manifest is written last: an interrupted publish is simply sent again.
 """
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+from mosaicrenderer.models import Mosaic
+from mosaicrenderer.payloads import build
+
+MANIFEST = 'manifest.json'
+#files larger than this are uploaded in parts, in parallel
+MULTIPART_THRESHOLD = 8 * 2 ** 20
+
+
+def md5(source):
+    "Hex md5 of a source: bytes, or the path of a file"
+    digest = hashlib.md5()
+    if isinstance(source, bytes):
+        digest.update(source)
+    else:
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_type(key):
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+class Publisher(object):
+    """
+    Sends directories of files to a destination (see S3Publisher,
+    LocalPublisher), skipping the files it has already
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or getattr(settings, 'MOSAIC_PUBLISH_WORKERS',
+                                          32)
+
+    def publish(self, directory, files):
+        """
+        Make `files` ({key: bytes or path}) the content of `directory`;
+        returns (url of the directory, number of files sent)
+        """
+        manifest = self.fetch('%s/%s' % (directory, MANIFEST))
+        manifest = json.loads(manifest.decode('utf-8')) if manifest else {}
+        keys = sorted(files)
+        pool = ThreadPool(self.workers)
+        try:
+            digests = dict(zip(keys, pool.map(
+                md5, [files[key] for key in keys], chunksize=64)))
+            changed = [key for key in keys
+                       if manifest.get(key) != digests[key]]
+            pool.map(lambda key: self.send('%s/%s' % (directory, key),
+                                           files[key]),
+                     changed, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+        gone = sorted(set(manifest) - set(digests))
+        if gone:
+            self.remove(['%s/%s' % (directory, key) for key in gone])
+        self.send('%s/%s' % (directory, MANIFEST),
+                  json.dumps(digests, sort_keys=True).encode('utf-8'))
+        return (self.url(directory + '/'), len(changed))
+
+    def fetch(self, key):
+        "Content of `key`, or None"
+        raise NotImplementedError
+
+    def send(self, key, source):
+        raise NotImplementedError
+
+    def remove(self, keys):
+        raise NotImplementedError
+
+    def url(self, key):
+        return self.base_url + key
+
+
+class S3Publisher(Publisher):
+
+    def __init__(self, bucket, endpoint_url=None, base_url=None,
+                 workers=None, acl='public-read'):
+        super(S3Publisher, self).__init__(workers)
+        if boto3 is None:
+            raise ImproperlyConfigured('publishing to S3 needs boto3')
+        self.bucket = bucket
+        #None when a bucket policy makes the objects readable
+        self.acl = acl
+        #boto3 clients are thread safe: one, with a connection per worker
+        self.client = boto3.client(
+            's3', endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=self.workers))
+        self.transfer = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+                                       max_concurrency=8)
+        self.base_url = base_url or '%s/%s/' % (
+            (endpoint_url or 'https://s3.amazonaws.com').rstrip('/'), bucket)
+
+    def fetch(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return response['Body'].read()
+
+    def send(self, key, source):
+        extra = {'ContentType': content_type(key)}
+        if self.acl:
+            extra['ACL'] = self.acl
+        if isinstance(source, bytes):
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=source,
+                                   **extra)
+        elif os.path.getsize(source) < MULTIPART_THRESHOLD:
+            with open(source, 'rb') as f:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=f,
+                                       **extra)
+        else:
+            self.client.upload_file(source, self.bucket, key,
+                                    ExtraArgs=extra, Config=self.transfer)
+
+    def remove(self, keys):
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + 1000]],
+                'Quiet': True})
+
+
+class LocalPublisher(Publisher):
+
+    def __init__(self, directory=None, base_url=None, workers=None):
+        super(LocalPublisher, self).__init__(workers)
+        self.directory = directory or os.path.join(settings.MEDIA_ROOT,
+                                                   'published')
+        self.base_url = base_url or settings.MEDIA_URL + 'published/'
+
+    def path(self, key):
+        return os.path.join(self.directory, *key.split('/'))
+
+    def fetch(self, key):
+        if not os.path.exists(self.path(key)):
+            return None
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def send(self, key, source):
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            #there already, maybe made by another worker meanwhile
+            if not os.path.isdir(os.path.dirname(path)):
+                raise
+        #written aside then renamed: viewers never get half a file
+        if isinstance(source, bytes):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(source)
+        else:
+            shutil.copyfile(source, path + '.tmp')
+        os.rename(path + '.tmp', path)
+
+    def remove(self, keys):
+        for key in keys:
+            if os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+
+
+def default_publisher():
+    "Publisher configured by the settings (see above)"
+    bucket = getattr(settings, 'MOSAIC_PUBLISH_BUCKET', None)
+    base_url = getattr(settings, 'MOSAIC_PUBLISH_URL', None)
+    if bucket:
+        return S3Publisher(bucket,
+                           getattr(settings, 'MOSAIC_PUBLISH_ENDPOINT', None),
+                           base_url,
+                           acl=getattr(settings, 'MOSAIC_PUBLISH_ACL',
+                                       'public-read'))
+    return LocalPublisher(base_url=base_url)
+
+
+def render_files(render, pyramid=None):
+    "{key: bytes or path} of what is published for `render`"
+    from mosaicrenderer import views  # registers the builders
+    files = {'render.jpg': render.final_image.path,
+             'layout.json': build('layout', render)[0]}
+    if render.blended_image:
+        files['blended.jpg'] = render.blended_image.path
+    if pyramid:
+        files['render.dzi'] = pyramid
+        tiles = os.path.splitext(pyramid)[0] + '_files'
+        for (root, dirs, names) in os.walk(tiles):
+            if 'job' in dirs:
+                #the progress of the pyramid render, not tiles
+                dirs.remove('job')
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, tiles).replace(os.sep, '/')
+                files['render_files/' + relative] = path
+    return files
+
+
+def publish_render(render, pyramid=None, publisher=None):
+    """
+    Publish `render` (with the Deep Zoom image at `pyramid`, if any) and
+    make it the public_url of its mosaic; returns the url
+    """
+    publisher = publisher or default_publisher()
+    (url, sent) = publisher.publish(render.mosaic.slug,
+                                    render_files(render, pyramid))
+    Mosaic.objects.filter(pk=render.mosaic_id).update(public_url=url)
+    return url
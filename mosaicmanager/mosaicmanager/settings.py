@@ -11,10 +11,14 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# osaic.py (and tilestore.py) live at the root of the repository
+sys.path.append(os.path.dirname(BASE_DIR))
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.9/howto/deployment/checklist/
 
@@ -38,9 +42,8 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'social.apps.django_app.default',    
     'mosaicrenderer',
-    #this auto-starts processes for collecting tweets
-    #  just do 'twittercollector' if you want to manage
-    #  collecting separately
+    #collecting tweets runs in separate processes: manage.py run_collectors
+    #  (or TWITTERCOLLECTOR_AUTOSTART = True to start them from here)
     'twittercollector.apps.TwitterCollectorConfig',
 ]
 
@@ -0,0 +1,125 @@
+import json
+import os
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    import boto3
+    from moto import mock_s3
+except ImportError:
+    mock_s3 = None
+
+from mosaicrenderer.models import Mosaic, MosaicRender
+from mosaicrenderer.scheduler import RenderScheduler
+from mosaicrenderer.tests import MediaTestCase, jpeg, make_mosaic
+
+from .pipelines import MANIFEST, LocalPublisher, S3Publisher, publish_render
+
+
+class PublisherTests(object):
+    "Publishing the same directory again, with `self.publisher`"
+
+    def stored(self, key):
+        "Content of `key` at the destination, or None"
+        return self.publisher.fetch('cats/' + key)
+
+    def test_publish(self):
+        with open(self.media_root + '/tile.jpg', 'wb') as f:
+            f.write(b'tile')
+        files = {'layout.json': b'{}', 'render_files/0/0_0.jpg':
+                 self.media_root + '/tile.jpg'}
+        (url, sent) = self.publisher.publish('cats', files)
+        self.assertEqual(url, self.publisher.base_url + 'cats/')
+        self.assertEqual(sent, 2)
+        self.assertEqual(self.stored('render_files/0/0_0.jpg'), b'tile')
+        manifest = json.loads(self.stored(MANIFEST).decode('utf-8'))
+        self.assertEqual(sorted(manifest), sorted(files))
+
+        #unchanged files aren't sent again
+        self.assertEqual(self.publisher.publish('cats', files), (url, 0))
+        files['layout.json'] = b'{"tiles_x": 2}'
+        self.assertEqual(self.publisher.publish('cats', files)[1], 1)
+        self.assertEqual(self.stored('layout.json'), b'{"tiles_x": 2}')
+
+        #files no longer part of the render are removed
+        del files['render_files/0/0_0.jpg']
+        self.assertEqual(self.publisher.publish('cats', files)[1], 0)
+        self.assertIsNone(self.stored('render_files/0/0_0.jpg'))
+        manifest = json.loads(self.stored(MANIFEST).decode('utf-8'))
+        self.assertEqual(list(manifest), ['layout.json'])
+
+
+class LocalPublisherTest(PublisherTests, MediaTestCase):
+
+    def setUp(self):
+        super(LocalPublisherTest, self).setUp()
+        self.publisher = LocalPublisher(workers=2)
+
+    def test_publish_render(self):
+        render = MosaicRender(mosaic=make_mosaic(), tiles_x=2, tiles_y=2)
+        render.final_image.save('renders/cats.jpg', jpeg())
+        url = publish_render(render, publisher=self.publisher)
+        self.assertEqual(url, '/media/published/cats/')
+        self.assertEqual(Mosaic.objects.get(slug='cats').public_url, url)
+        with open(render.final_image.path, 'rb') as f:
+            self.assertEqual(self.stored('render.jpg'), f.read())
+        self.assertIsNotNone(self.stored('layout.json'))
+
+
+@unittest.skipIf(mock_s3 is None, 'needs boto3 and moto')
+class S3PublisherTest(PublisherTests, MediaTestCase):
+
+    def setUp(self):
+        super(S3PublisherTest, self).setUp()
+        self.s3 = mock_s3()
+        self.s3.start()
+        self.region = os.environ.get('AWS_DEFAULT_REGION')
+        os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+        boto3.client('s3').create_bucket(Bucket='mosaics')
+        self.publisher = S3Publisher('mosaics', workers=2)
+
+    def tearDown(self):
+        self.s3.stop()
+        if self.region is None:
+            del os.environ['AWS_DEFAULT_REGION']
+        else:
+            os.environ['AWS_DEFAULT_REGION'] = self.region
+        super(S3PublisherTest, self).tearDown()
+
+    def public_reads(self, key):
+        grants = self.publisher.client.get_object_acl(
+            Bucket='mosaics', Key=key)['Grants']
+        return [grant['Permission'] for grant in grants
+                if grant['Grantee'].get('URI', '').endswith('/AllUsers')]
+
+    def test_public_url(self):
+        (url, sent) = self.publisher.publish('cats', {'render.jpg': b'jpeg'})
+        self.assertEqual(url, 'https://s3.amazonaws.com/mosaics/cats/')
+        #readable by the viewers public_url sends there
+        self.assertEqual(self.public_reads('cats/render.jpg'), ['READ'])
+        response = self.publisher.client.get_object(Bucket='mosaics',
+                                                    Key='cats/render.jpg')
+        self.assertEqual(response['ContentType'], 'image/jpeg')
+
+    def test_bucket_policy(self):
+        self.publisher.acl = None
+        self.publisher.publish('cats', {'render.jpg': b'jpeg'})
+        self.assertEqual(self.public_reads('cats/render.jpg'), [])
+
+
+class SchedulerPublishTest(MediaTestCase):
+
+    def test_publish_failure(self):
+        #no image to publish: the render is fine, the publish fails
+        mosaic = make_mosaic()
+        scheduler = RenderScheduler(render=lambda mosaic: MosaicRender(
+            mosaic=mosaic), publish=True)
+        with mock.patch('mosaicrenderer.scheduler.logger') as logger:
+            scheduler._render(mosaic, scheduler.slots.acquire())
+        (args, kwargs) = logger.error.call_args
+        self.assertEqual(args, ('%s of %s failed', 'publish', 'cats'))
+        self.assertTrue(kwargs['exc_info'])
@@ -18,5 +18,7 @@ from django.contrib import admin
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
+    url(r'^data/', include('mosaicrenderer.urls')),
+    url(r'^data/', include('twittercollector.urls')),
     url('', include('social.apps.django_app.urls', namespace='social')),
 ]
@@ -0,0 +1,30 @@
+"""
+Average colors of source images, as stored in
+MosaicSourceImage.average_color / SourcePosition.average_color
+("r,g,b" strings).
+"""
+from PIL import Image
+
+
+def average_color(image):
+    "Average (r, g, b) of a PIL image"
+    image = image.convert('RGB')
+    (width, height) = image.size
+    (red, green, blue) = (0, 0, 0)
+    for (count, (r, g, b)) in image.getcolors(width * height):
+        red += count * r
+        green += count * g
+        blue += count * b
+    pixels = width * height
+    return (red // pixels, green // pixels, blue // pixels)
+
+
+def format_color(color):
+    return '%d,%d,%d' % tuple(color)
+
+
+def parse_color(value):
+    "(r, g, b) from a stored color, or None"
+    if not value:
+        return None
+    return tuple(int(v) for v in value.split(','))
@@ -0,0 +1,144 @@
+"""
+Live updates of a mosaic, pushed to viewers as server-sent events.
+
+Instead of reloading the whole image and its data after each render,
+viewers keep an EventSource open on /data/<slug>/events and receive,
+for each new version of the latest render (see payloads.py), only what
+changed since the version they have:
+
+    event: tiles
+    id: <new version>
+    data: {"from": <their version>, "version": <new version>,
+           "image": <url of the full image>,
+           "cells": [[x, y, source id], ...],
+           "sources": {source id: image url}}
+
+so they can paint the new sources over the changed cells themselves.
+When that isn't possible (the lattice changed, or their version is too
+old to be in the cache any more), they get a `reload` event instead.
+
+Streams only look at the cache (payloads.latest), once per POLL_INTERVAL,
+and a diff is computed once per process and pair of versions, whatever
+the number of viewers.  A stream ends after MOSAIC_EVENTS_DURATION
+seconds (default 25); the browser reconnects on its own, with the
+Last-Event-ID it got last, and gets what it missed meanwhile.
+
+An open stream holds the worker serving it.  With synchronous workers
+(gunicorn's default), each viewer takes a whole worker while connected,
+so keep streams shorter than the worker timeout (30 seconds by default)
+and expect as many viewers as workers at most.  For an event, run the
+server with an asynchronous worker class, where a stream only costs a
+greenlet, e.g.:
+
+    gunicorn -k gevent --worker-connections 2000 mosaicmanager.wsgi
+"""
+import json
+import time
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from .models import MosaicSourceImage
+from .payloads import latest, parse_version, versioned_payload
+
+POLL_INTERVAL = 1
+#a comment line now and then keeps proxies from closing idle streams
+KEEPALIVE_INTERVAL = 15
+
+
+def stream_duration():
+    return getattr(settings, 'MOSAIC_EVENTS_DURATION', 25)
+
+#(from version, to version): event, for this process
+_diffs = {}
+
+
+def diff(old, new):
+    """
+    [(x, y, source id)] of the cells of the `new` layout payload whose
+    source isn't the one of the `old` layout, or None if the lattices
+    differ
+    """
+    if (old['tiles_x'], old['tiles_y']) != (new['tiles_x'], new['tiles_y']):
+        return None
+    tiles_x = new['tiles_x']
+    return [(i % tiles_x, i // tiles_x, tile[0] if tile else None)
+            for (i, (before, tile)) in enumerate(zip(old['tiles'],
+                                                     new['tiles']))
+            if (before and before[0]) != (tile and tile[0])]
+
+
+def _data(name, current, build_missing=True):
+    payload = versioned_payload(name, current, build_missing)
+    return json.loads(payload.body.decode('utf-8')) if payload else None
+
+
+def tile_event(since, current):
+    "The event taking a viewer from version `since` to `current`"
+    key = (since, current['version'])
+    if key in _diffs:
+        return _diffs[key]
+    event = ('reload', json.dumps({'version': current['version']}))
+    old = None
+    if since:
+        try:
+            old = _data('layout', parse_version(since), build_missing=False)
+        except ValueError:
+            pass
+    if old is not None:
+        cells = diff(old, _data('layout', current))
+        if cells is not None:
+            storage = MosaicSourceImage._meta.get_field('image').storage
+            sources = dict(
+                (pk, storage.url(image)) for (pk, image) in
+                MosaicSourceImage.objects.filter(
+                    pk__in=set(c[2] for c in cells if c[2] is not None))
+                .exclude(image='').values_list('pk', 'image'))
+            event = ('tiles', json.dumps({
+                'from': since,
+                'version': current['version'],
+                'image': _data('render', current)['image'],
+                'cells': cells,
+                'sources': sources,
+            }, separators=(',', ':')))
+    if len(_diffs) > 100:
+        _diffs.clear()
+    _diffs[key] = event
+    return event
+
+
+def stream(slug, since):
+    "Lines of the event stream of `slug`, for a viewer at version `since`"
+    yield 'retry: %d\n\n' % (POLL_INTERVAL * 1000)
+    started = last_sent = time.time()
+    duration = stream_duration()
+    if not since:
+        #no version yet: whatever is the latest is what the viewer has
+        current = latest(slug)
+        since = current['version'] if current else ''
+    while time.time() - started < duration:
+        current = latest(slug)
+        if current is not None and current['version'] != since:
+            (name, data) = tile_event(since, current)
+            since = current['version']
+            last_sent = time.time()
+            yield 'event: %s\nid: %s\ndata: %s\n\n' % (name, since, data)
+        elif time.time() - last_sent > KEEPALIVE_INTERVAL:
+            last_sent = time.time()
+            yield ': keepalive\n\n'
+        time.sleep(POLL_INTERVAL)
+
+
+def events(request, slug):
+    """
+    The event stream view; ?version= (see render.json) if there is no
+    Last-Event-ID yet
+    """
+    since = request.META.get('HTTP_LAST_EVENT_ID') \
+        or request.GET.get('version', '')
+    response = StreamingHttpResponse(stream(slug, since),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    #nginx would buffer the whole stream otherwise
+    response['X-Accel-Buffering'] = 'no'
+    return response
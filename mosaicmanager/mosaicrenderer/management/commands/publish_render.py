@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mosaicmanager.pipelines import publish_render
+from mosaicrenderer.models import MosaicRender
+
+
+class Command(BaseCommand):
+    help = "Publish the latest render of a mosaic (see mosaicmanager.pipelines)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug')
+        parser.add_argument('--pyramid', default=None,
+                            help="also publish this Deep Zoom image "
+                            "(see pyramid.py), e.g. print.dzi")
+
+    def handle(self, *args, **options):
+        render = MosaicRender.objects.filter(mosaic__slug=options['slug'])\
+                                     .select_related('mosaic')\
+                                     .order_by('-pk').first()
+        if render is None:
+            raise CommandError('no render of %s' % options['slug'])
+        url = publish_render(render, pyramid=options['pyramid'])
+        self.stdout.write('published %s' % url)
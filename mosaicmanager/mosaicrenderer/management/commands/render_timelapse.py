@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mosaicrenderer.models import Mosaic
+from mosaicrenderer.timelapse import Timelapse
+
+
+class Command(BaseCommand):
+    help = "Make a video (or gif) of a mosaic's renders, from the first one"
+
+    def add_arguments(self, parser):
+        parser.add_argument('slug')
+        parser.add_argument('destination',
+                            help="e.g. timelapse.mp4 or timelapse.gif")
+        parser.add_argument('--size', default='800x600',
+                            help="WIDTHxHEIGHT of the video")
+        parser.add_argument('--fps', type=float, default=10,
+                            help="renders per second")
+        parser.add_argument('--hold', type=float, default=2,
+                            help="seconds the last render stays on screen")
+
+    def handle(self, *args, **options):
+        mosaic = Mosaic.objects.filter(slug=options['slug']).first()
+        if mosaic is None:
+            raise CommandError('no mosaic %s' % options['slug'])
+        size = tuple(int(v) for v in options['size'].split('x'))
+        frames = Timelapse(mosaic, size).write(options['destination'],
+                                               fps=options['fps'],
+                                               hold=options['hold'])
+        self.stdout.write('%d renders in %s' % (frames,
+                                                options['destination']))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from mosaicrenderer.scheduler import RenderScheduler
+
+
+class Command(BaseCommand):
+    help = "Render active mosaics as they collect new sources"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help=("renders at the same time on this host "
+                                  "(default: MOSAIC_RENDER_CONCURRENCY or 1)"))
+        parser.add_argument('--cooldown', type=int, default=None,
+                            help="minimum seconds between renders of a mosaic")
+        parser.add_argument('--interval', type=int, default=10,
+                            help="seconds between checks")
+
+    def handle(self, *args, **options):
+        RenderScheduler(concurrency=options['concurrency'],
+                        cooldown=options['cooldown'],
+                        interval=options['interval']).run_forever()
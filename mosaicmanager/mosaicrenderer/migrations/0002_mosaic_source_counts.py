@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_sources(apps, schema_editor):
+    Mosaic = apps.get_model('mosaicrenderer', 'Mosaic')
+    for mosaic in Mosaic.objects.annotate(count=models.Count('source_images')):
+        Mosaic.objects.filter(pk=mosaic.pk).update(source_count=mosaic.count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mosaicrenderer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mosaic',
+            name='source_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='mosaic',
+            name='rendered_source_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='source_count when the last render started'),
+        ),
+        migrations.RunPython(count_sources, migrations.RunPython.noop),
+    ]
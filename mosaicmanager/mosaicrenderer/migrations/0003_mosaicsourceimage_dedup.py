@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mosaicrenderer', '0002_mosaic_source_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mosaicsourceimage',
+            name='image_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='mosaicsourceimage',
+            name='canonical',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='mosaicrenderer.MosaicSourceImage'),
+        ),
+        migrations.AddField(
+            model_name='mosaicsourceimage',
+            name='reference_count',
+            field=models.PositiveIntegerField(default=1, help_text='sources using this image (itself included)'),
+        ),
+    ]
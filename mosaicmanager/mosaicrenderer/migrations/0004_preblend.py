@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mosaicrenderer', '0003_mosaicsourceimage_dedup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mosaic',
+            name='preblend',
+            field=models.BooleanField(default=False, help_text='also render the mosaic with the target blended over it at opacity, for viewers to load a single image'),
+        ),
+        migrations.AddField(
+            model_name='mosaicrender',
+            name='blended_image',
+            field=models.ImageField(blank=True, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mosaicrenderer', '0004_preblend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mosaic',
+            name='color_correction',
+            field=models.FloatField(default=0, help_text='0 to 1: how much tiles are shifted towards the color of the target where they are placed'),
+        ),
+    ]
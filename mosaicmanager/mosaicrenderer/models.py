@@ -1,4 +1,7 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import Signal, receiver
 
 from django.contrib.contenttypes.models import ContentType
 
@@ -23,10 +26,39 @@ class MosaicSourceImage(models.Model):
     image_height = models.PositiveIntegerField(null=True)
 
     average_color = models.CharField(null=True, blank=True, max_length=32)
+
+    #perceptual hash (hex, see dedup.py); '' when the image is unusable
+    image_hash = models.CharField(null=True, blank=True, max_length=16,
+                                  db_index=True)
+    #near-identical image collected before: use its image instead
+    canonical = models.ForeignKey('self', null=True, blank=True,
+                                  on_delete=models.SET_NULL,
+                                  related_name='duplicates')
+    reference_count = models.PositiveIntegerField(
+        default=1, help_text="sources using this image (itself included)")
     
     def save(self, *args, **kw):
-        self.content_type = ContentType.objects.get_for_model(self)
+        #bulk writers set it once for the whole batch
+        if self.content_type_id is None:
+            self.content_type = ContentType.objects.get_for_model(self)
         super(MosaicSourceImage, self).save(*args, **kw)
+
+    @classmethod
+    def same_pictures(cls, sources):
+        """
+        Q of the sources showing one of the pictures of `sources` (a
+        queryset): the sources of their canonical source, and those whose
+        picture has the same perceptual hash without being linked to it
+        """
+        ids = sources.values('pk')
+        canonicals = sources.exclude(canonical=None).values('canonical')
+        pictures = Q(pk__in=ids) | Q(pk__in=canonicals)
+        hashes = cls.objects.filter(pictures).exclude(image_hash=None)\
+                                             .exclude(image_hash='')\
+                                             .values('image_hash')
+        return (pictures | Q(canonical__in=ids) | Q(canonical__in=canonicals)
+                | Q(image_hash__in=hashes)
+                | Q(canonical__image_hash__in=hashes))
     
 
 class Mosaic(models.Model):
@@ -53,6 +85,14 @@ class Mosaic(models.Model):
     incremental_update_count = models.PositiveIntegerField()
 
     opacity = models.FloatField(default=0.5)
+    preblend = models.BooleanField(
+        default=False,
+        help_text="also render the mosaic with the target blended over it "
+        "at opacity, for viewers to load a single image")
+    color_correction = models.FloatField(
+        default=0,
+        help_text="0 to 1: how much tiles are shifted towards the color of "
+        "the target where they are placed")
     
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     modified_at = models.DateTimeField(auto_now=True)
@@ -63,10 +103,37 @@ class Mosaic(models.Model):
 
     public_url = models.URLField(blank=True, null=True)
 
+    #kept up to date when sources are added/removed, so deciding whether
+    #to render doesn't need to count source_images
+    source_count = models.PositiveIntegerField(default=0, editable=False)
+    rendered_source_count = models.PositiveIntegerField(
+        default=0, editable=False,
+        help_text="source_count when the last render started")
+
 
     def save(self, *args, **kw):
         self.content_type = ContentType.objects.get_for_model(self)
         super(Mosaic, self).save(*args, **kw)
+
+    @classmethod
+    def count_sources(cls, counts):
+        "Add {mosaic id: number of new (or, negative, removed) sources}"
+        for (mosaic_id, count) in counts.items():
+            if count:
+                cls.objects.filter(pk=mosaic_id).update(
+                    source_count=F('source_count') + count)
+
+    def render_source_images(self):
+        "Sources a render picks from (see TwitterMosaic)"
+        return self.source_images.all()
+
+    def excluded_source_ids(self):
+        "Ids of sources that shouldn't be shown (see TwitterMosaic)"
+        return set()
+
+    @property
+    def new_source_count(self):
+        return self.source_count - self.rendered_source_count
     
 
 class MosaicRender(models.Model):
@@ -75,6 +142,8 @@ class MosaicRender(models.Model):
                                     width_field='image_height',
                                     height_field='image_width')
     mosaic = models.ForeignKey(Mosaic, db_index=True)
+    #final_image with the target blended over it (Mosaic.preblend)
+    blended_image = models.ImageField(blank=True)
     source_images = models.ManyToManyField(MosaicSourceImage,
                                            through='SourcePosition',
                                            related_name="renders")
@@ -84,6 +153,9 @@ class MosaicRender(models.Model):
     tiles_x = models.PositiveIntegerField(null=True)
     tiles_y = models.PositiveIntegerField(null=True)
 
+    #also bumped when tiles are repainted (see render.repaint_positions)
+    modified_at = models.DateTimeField(auto_now=True)
+
     
 class SourcePosition(models.Model):
     render = models.ForeignKey(MosaicRender)
@@ -94,3 +166,42 @@ class SourcePosition(models.Model):
     average_color = models.CharField(null=True, blank=True,
                                      max_length=32,
                                      help_text="average color for target")
+
+
+#sent by RenderScheduler.check (see scheduler.py), for the work other apps
+#want done by the render worker, e.g. takedowns
+scheduler_check = Signal()
+
+
+@receiver(m2m_changed, sender=Mosaic.source_images.through)
+def count_mosaic_sources(sender, instance, action, reverse, pk_set, **kwargs):
+    #bulk_create of the links (twittercollector.buffer) counts itself
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    sign = -1 if action != 'post_add' else 1
+    if action == 'pre_clear':
+        if reverse:
+            pk_set = set(instance.mosaics.values_list('pk', flat=True))
+        else:
+            pk_set = None
+            Mosaic.objects.filter(pk=instance.pk).update(source_count=0)
+    if not pk_set:
+        return
+    if reverse:
+        #instance is a source, pk_set its mosaics
+        Mosaic.count_sources(dict((pk, sign) for pk in pk_set))
+    else:
+        Mosaic.count_sources({instance.pk: sign * len(pk_set)})
+
+
+@receiver(post_save, sender=MosaicRender)
+def publish_render(sender, instance, **kwargs):
+    #viewers get the new payloads (see payloads.py) once it's committed;
+    #the layout is kept for live updates to diff against (see live.py)
+    from .payloads import prebuild, set_latest
+    from . import views  # registers the builders
+
+    def publish():
+        set_latest(instance)
+        prebuild('layout', instance)
+    transaction.on_commit(publish)
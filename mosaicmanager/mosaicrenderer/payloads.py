@@ -0,0 +1,172 @@
+"""
+Precomputed json payloads for mosaic viewers, with conditional GET.
+
+At an event, thousands of viewers poll the same few payloads (the
+latest render of a mosaic, its layout, who is on each tile) which only
+change when the mosaic is rendered again.  So a payload is built once
+per render: serialized, gzipped and given an ETag, then kept in the
+cache under a key naming the render *version* (its id and modified_at to
+the microsecond, bumped by takedown repaints too).
+
+Which version is the latest is cached as well, and set as soon as a
+MosaicRender is saved: serving a payload needs no database query.  With
+a cache shared by the processes (memcached...) new renders are served
+right away; with a per-process cache, the latest version is looked up
+again after MOSAIC_DATA_TTL seconds at most.
+"""
+import calendar
+import gzip
+import hashlib
+import io
+import json
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from .models import MosaicRender
+
+LATEST_KEY = 'mosaicrenderer:latest:%s'
+PAYLOAD_KEY = 'mosaicrenderer:payload:%s:%s'
+#payloads don't change for a given version; they just age out
+PAYLOAD_TTL = 24 * 3600
+
+#name: function(render) returning the data of the payload
+builders = {}
+
+Payload = namedtuple('Payload', 'body gzipped etag last_modified')
+
+
+def latest_ttl():
+    return getattr(settings, 'MOSAIC_DATA_TTL', 10)
+
+
+def register(name):
+    "Decorator registering a payload builder under `name`"
+    def decorator(func):
+        builders[name] = func
+        return func
+    return decorator
+
+
+def version(render):
+    "Render id, version string and modified_at timestamp of a render"
+    modified = calendar.timegm(render.modified_at.utctimetuple())
+    #repaints can follow each other within a second
+    stamp = modified * 10 ** 6 + render.modified_at.microsecond
+    return {'id': render.pk, 'mosaic': render.mosaic_id,
+            'version': '%d-%d' % (render.pk, stamp),
+            'modified': modified}
+
+
+def set_latest(render, slug=None):
+    "Make `render` the latest of its mosaic (on MosaicRender save)"
+    slug = slug or render.mosaic.slug
+    cache.set(LATEST_KEY % slug, version(render), latest_ttl())
+
+
+def latest(slug):
+    "Version of the latest render of the mosaic `slug`, or None"
+    current = cache.get(LATEST_KEY % slug)
+    if current is None:
+        render = MosaicRender.objects.filter(mosaic__slug=slug)\
+                                     .select_related('mosaic')\
+                                     .order_by('-pk').first()
+        #an empty dict (no render yet) is cached too
+        current = version(render) if render is not None else {}
+        cache.set(LATEST_KEY % slug, current, latest_ttl())
+    return current or None
+
+
+def build(name, render):
+    data = builders[name](render)
+    body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(body)
+    return (body, buf.getvalue(), hashlib.md5(body).hexdigest())
+
+
+def prebuild(name, render):
+    "Build and cache the payload `name` of `render` now (at render time)"
+    cache.set(PAYLOAD_KEY % (name, version(render)['version']),
+              build(name, render), PAYLOAD_TTL)
+
+
+def parse_version(value):
+    "The version dict of a version string (see version)"
+    (render_id, stamp) = (int(v) for v in value.split('-'))
+    return {'id': render_id, 'version': value, 'modified': stamp // 10 ** 6}
+
+
+def versioned_payload(name, current, build_missing=True):
+    """
+    The Payload `name` of the `current` version: built if needed, unless
+    not `build_missing` (an older version can't be built again: the
+    render may have been repainted since), then it may be None
+    """
+    key = PAYLOAD_KEY % (name, current['version'])
+    cached = cache.get(key)
+    if cached is None:
+        if not build_missing:
+            return None
+        cached = build(name, MosaicRender.objects.select_related('mosaic')
+                       .get(pk=current['id']))
+        cache.set(key, cached, PAYLOAD_TTL)
+    (body, gzipped, etag) = cached
+    return Payload(body, gzipped, etag, current['modified'])
+
+
+def payload(name, slug):
+    "The Payload `name` for the latest render of `slug`, or None"
+    current = latest(slug)
+    if current is None:
+        return None
+    return versioned_payload(name, current)
+
+
+#(name, slug): (etag, data) of the payloads used as data by this process
+_parsed = {}
+
+
+def payload_data(name, slug):
+    "The data of the payload `name` of `slug`, parsed once per version"
+    current = payload(name, slug)
+    if current is None:
+        return None
+    parsed = _parsed.get((name, slug))
+    if parsed is None or parsed[0] != current.etag:
+        parsed = (current.etag, json.loads(current.body.decode('utf-8')))
+        _parsed[(name, slug)] = parsed
+    return parsed[1]
+
+
+def serve(request, name, slug):
+    "Response with the payload, 304 if the client has it already"
+    data = payload(name, slug)
+    if data is None:
+        raise Http404('no render of %s yet' % slug)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    #the gzipped variant has its own ETag, derived from the same hash
+    if (if_none_match is not None and data.etag in if_none_match) or \
+       (if_none_match is None and if_modified_since is not None
+            and data.last_modified <= if_modified_since):
+        response = HttpResponseNotModified()
+        response['ETag'] = quote_etag(data.etag)
+    elif 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(data.gzipped,
+                                content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+        response['ETag'] = quote_etag(data.etag + '-gzip')
+    else:
+        response = HttpResponse(data.body, content_type='application/json')
+        response['ETag'] = quote_etag(data.etag)
+    response['Last-Modified'] = http_date(data.last_modified)
+    response['Vary'] = 'Accept-Encoding'
+    #viewers revalidate, and can share what proxies cached
+    response['Cache-Control'] = 'public, no-cache'
+    return response
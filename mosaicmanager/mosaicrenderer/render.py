@@ -0,0 +1,176 @@
+"""
+Rendering a Mosaic with osaic, into a MosaicRender (the image and
+where each source went, as SourcePositions).
+"""
+import io
+import itertools
+
+import numpy
+from PIL import Image
+
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+
+import osaic
+
+from .colors import format_color, parse_color
+from .models import Mosaic, MosaicRender, MosaicSourceImage, SourcePosition
+
+
+def specific(mosaic):
+    "The mosaic as its own subclass (e.g. TwitterMosaic)"
+    model = mosaic.content_type.model_class()
+    if model is None or isinstance(mosaic, model):
+        return mosaic
+    return model.objects.get(pk=mosaic.pk)
+
+
+def render_sources(mosaic, excluded=()):
+    """
+    {image path: [source ids]} of the mosaic's images, but `excluded`
+    sources: duplicates use the image of their canonical source, so
+    each picture is there once, but they keep their own ids -- tiles
+    are credited to the tweets that brought the picture, not to
+    whoever sent it first
+    """
+    storage = MosaicSourceImage._meta.get_field('image').storage
+    sources = {}
+    images = mosaic.render_source_images().order_by('pk')
+    for (pk, image, canonical_image) in images.values_list(
+            'pk', 'image', 'canonical__image'):
+        image = canonical_image or image
+        if image and pk not in excluded:
+            sources.setdefault(storage.path(image), []).append(pk)
+    return sources
+
+
+def render_mosaic(mosaic, tiles=None, zoom=1):
+    """
+    Render the mosaic with its current sources and return the new
+    MosaicRender.  Sources added while rendering count as new sources
+    for the next render.
+    """
+    mosaic = specific(mosaic)
+    source_count = Mosaic.objects.values_list(
+        'source_count', flat=True).get(pk=mosaic.pk)
+    sources = render_sources(mosaic)
+    credits = render_sources(mosaic, mosaic.excluded_source_ids())
+    exclude = set(sources) - set(credits)
+    if not credits:
+        raise ValueError('mosaic %s has no source images' % mosaic.slug)
+
+    result = osaic.mosaicify(target=mosaic.target_image.path,
+                             sources=sorted(sources), tiles=tiles, zoom=zoom,
+                             exclude=exclude,
+                             correction=mosaic.color_correction)
+    output = io.BytesIO()
+    result.save(output, 'JPEG')
+    layout = result.layout
+    blended = None
+    if mosaic.preblend:
+        blended = io.BytesIO()
+        result.blended(osaic.Overlay(
+            mosaic.target_image.path, mosaic.opacity,
+            (layout['width'], layout['height']))).save(blended, 'JPEG')
+
+    with transaction.atomic():
+        render = MosaicRender(mosaic=mosaic,
+                              tiles_x=layout['tiles_x'],
+                              tiles_y=layout['tiles_y'])
+        render.final_image.save('renders/%s.jpg' % mosaic.slug,
+                                ContentFile(output.getvalue()), save=False)
+        if blended is not None:
+            render.blended_image.save('renders/%s-blended.jpg' % mosaic.slug,
+                                      ContentFile(blended.getvalue()),
+                                      save=False)
+        render.save()
+        tiles_x = layout['tiles_x']
+        #a picture used on several tiles credits each of its sources
+        credits = dict((path, itertools.cycle(ids))
+                       for (path, ids) in credits.items())
+        SourcePosition.objects.bulk_create(
+            SourcePosition(render=render,
+                           source_image_id=next(credits[filename]),
+                           x=i % tiles_x, y=i // tiles_x,
+                           average_color=format_color(color))
+            for (i, (filename, color)) in enumerate(
+                zip(layout['best_matching'], layout['target_colors']))
+            if filename is not None)
+        Mosaic.objects.filter(pk=mosaic.pk).update(
+            last_render=timezone.now(), rendered_source_count=source_count)
+    return render
+
+
+def color_distance(a, b):
+    return sum((x - y) ** 2 for (x, y) in zip(a, b))
+
+
+def repaint_positions(render, positions):
+    """
+    Replace the sources at `positions` (SourcePositions of `render`) by
+    their next best match, directly in the render's image: used to take
+    sources down without rendering the whole mosaic again.
+
+    Replacements are the closest to the color of the target at each
+    position, among the mosaic's sources not excluded and, as long as
+    there are some, whose picture isn't used in the render yet.  The
+    blended image, if any, is repainted too.
+    """
+    if not positions:
+        return
+    mosaic = specific(render.mosaic)
+    excluded = mosaic.excluded_source_ids() \
+        | set(p.source_image_id for p in positions)
+    used = set(render.sourceposition_set.values_list('source_image_id',
+                                                     flat=True))
+    storage = MosaicSourceImage._meta.get_field('image').storage
+    sources = [(pk, parse_color(color), storage.path(canonical_image or image))
+               for (pk, color, image, canonical_image)
+               in mosaic.render_source_images().exclude(average_color=None)
+               .values_list('pk', 'average_color', 'image', 'canonical__image')
+               if canonical_image or image]
+    used_paths = set(path for (pk, color, path) in sources if pk in used)
+    candidates = [c for c in sources if c[0] not in excluded]
+    unused = [c for c in candidates if c[2] not in used_paths]
+    if not candidates:
+        return
+
+    image = Image.open(render.final_image.path)
+    image.load()
+    (tile_width, tile_height) = (image.size[0] // render.tiles_x,
+                                 image.size[1] // render.tiles_y)
+    (blended, overlay) = (None, None)
+    if render.blended_image:
+        blended = Image.open(render.blended_image.path)
+        blended.load()
+        overlay = osaic.Overlay(mosaic.target_image.path, mosaic.opacity,
+                                image.size)
+    for position in positions:
+        target = parse_color(position.average_color) or (0, 0, 0)
+        pool = unused or candidates
+        best = min(pool, key=lambda c: color_distance(c[1], target))
+        unused = [c for c in unused if c[2] != best[2]]
+        tile = osaic.ImageWrapper(filename=best[2], average_color=False)
+        tile.reratio(tile_width / float(tile_height))
+        tile.resize((tile_width, tile_height))
+        pixels = numpy.asarray(tile.blob)
+        if mosaic.color_correction:
+            #same shift as the tiles placed by render_mosaic
+            shift = osaic.color_shifts(
+                [pixels.reshape(-1, 3).mean(axis=0)], [target],
+                mosaic.color_correction)[0]
+            pixels = numpy.clip(pixels + shift, 0, 255).astype(numpy.uint8)
+        (x, y) = (position.x * tile_width, position.y * tile_height)
+        box = (x, y, x + tile_width, y + tile_height)
+        image.paste(Image.fromarray(pixels, 'RGB'), box)
+        if blended is not None:
+            blended.paste(Image.fromarray(overlay.blend(
+                pixels, box, image.size), 'RGB'), box)
+        position.source_image_id = best[0]
+        position.save(update_fields=['source_image'])
+    image.save(render.final_image.path)
+    if blended is not None:
+        blended.save(render.blended_image.path)
+    #new version of the render for viewers
+    render.save(update_fields=['modified_at'])
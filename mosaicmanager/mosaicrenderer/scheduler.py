@@ -0,0 +1,155 @@
+"""
+Deciding when each active Mosaic is rendered again.
+
+A mosaic is due once it has minimum_image_count sources (first render)
+or incremental_update_count new sources since its last render.  Both
+come from the counters on Mosaic, so a check is one query over active
+mosaics, whatever the number of sources.
+
+Bursts are coalesced: a mosaic is never queued twice, sources arriving
+during its render are left for the next one, and it isn't rendered
+again before `cooldown` seconds have passed.  Due mosaics are rendered
+by priority (never rendered first, then by how stale they are and how
+much changed, relative to how many sources -- the cost -- they have),
+within at most `concurrency` renders per host: each render holds one of
+the host's slot lock files, so several schedulers on the same host
+still share the cap.
+
+Each check first sends scheduler_check, for the work other apps leave to
+the render worker (twittercollector repaints the tiles of blocked users).
+"""
+import fcntl
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Mosaic, scheduler_check
+from .render import render_mosaic
+
+logger = logging.getLogger(__name__)
+
+
+def due_mosaics(cooldown=0, exclude=()):
+    "Active mosaics that should be rendered now"
+    first = Q(last_render__isnull=True,
+              source_count__gte=F('minimum_image_count'))
+    again = Q(last_render__isnull=False,
+              source_count__gte=F('rendered_source_count')
+              + F('incremental_update_count'))
+    mosaics = Mosaic.objects.filter(status=1).filter(first | again)\
+                            .exclude(target_image='').exclude(pk__in=exclude)
+    if cooldown:
+        mosaics = mosaics.exclude(
+            last_render__gt=timezone.now()
+            - timedelta(seconds=cooldown))
+    return list(mosaics)
+
+
+def priority(mosaic, now=None):
+    "Higher renders first"
+    if mosaic.last_render is None:
+        return float('inf')
+    now = now or timezone.now()
+    staleness = (now - mosaic.last_render).total_seconds()
+    changed = mosaic.new_source_count / float(
+        max(mosaic.incremental_update_count, 1))
+    return staleness * changed / math.sqrt(max(mosaic.source_count, 1))
+
+
+class HostSlots(object):
+    "At most `count` holders per host, with flock'ed files"
+
+    def __init__(self, count, directory=None):
+        self.count = count
+        self.directory = directory or os.path.join(tempfile.gettempdir(),
+                                                   'mosaicrenderer')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def acquire(self):
+        "An open slot file (to pass to release), or None if all are taken"
+        for i in range(self.count):
+            slot = open(os.path.join(self.directory, 'slot-%d.lock' % i), 'a')
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except IOError:
+                slot.close()
+        return None
+
+    def release(self, slot):
+        fcntl.flock(slot, fcntl.LOCK_UN)
+        slot.close()
+
+
+class RenderScheduler(object):
+
+    def __init__(self, concurrency=None, cooldown=None, interval=10,
+                 render=render_mosaic, publish=None):
+        self.slots = HostSlots(concurrency or getattr(
+            settings, 'MOSAIC_RENDER_CONCURRENCY', 1))
+        self.cooldown = cooldown if cooldown is not None else getattr(
+            settings, 'MOSAIC_RENDER_COOLDOWN', 60)
+        self.interval = interval
+        self.render = render
+        #see mosaicmanager.pipelines
+        self.publish = publish if publish is not None else getattr(
+            settings, 'MOSAIC_PUBLISH_ON_RENDER', False)
+        self.running = {}
+        self._lock = threading.Lock()
+
+    def _render(self, mosaic, slot):
+        step = 'render'
+        try:
+            render = self.render(mosaic)
+            if self.publish:
+                #the render itself is done, and served locally
+                step = 'publish'
+                from mosaicmanager.pipelines import publish_render
+                publish_render(render)
+        except Exception:
+            logger.error('%s of %s failed', step, mosaic.slug, exc_info=True)
+        finally:
+            self.slots.release(slot)
+            with self._lock:
+                self.running.pop(mosaic.pk, None)
+            close_old_connections()
+
+    def check(self):
+        "Start renders for due mosaics while slots are free"
+        for (receiver, result) in scheduler_check.send_robust(
+                sender=self.__class__):
+            if isinstance(result, Exception):
+                logger.error('%s failed', receiver.__name__, exc_info=result)
+        with self._lock:
+            running = list(self.running)
+        now = timezone.now()
+        due = sorted(due_mosaics(self.cooldown, exclude=running),
+                     key=lambda m: priority(m, now), reverse=True)
+        started = []
+        for mosaic in due:
+            slot = self.slots.acquire()
+            if slot is None:
+                break
+            thread = threading.Thread(target=self._render,
+                                      args=(mosaic, slot))
+            with self._lock:
+                self.running[mosaic.pk] = thread
+            thread.start()
+            started.append(mosaic)
+        return started
+
+    def run_forever(self):
+        while True:
+            self.check()
+            close_old_connections()
+            time.sleep(self.interval)
@@ -1,3 +1,221 @@
-from django.test import TestCase
+import io
+import json
+import shutil
+import tempfile
+from datetime import timedelta
 
-# Create your tests here.
+from PIL import Image
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from . import live
+from .models import Mosaic, MosaicRender, MosaicSourceImage, SourcePosition
+from .payloads import (latest, parse_version, prebuild, serve, set_latest,
+                       version)
+from .scheduler import HostSlots, due_mosaics, priority
+from .timelapse import Timelapse
+
+
+def make_mosaic(slug='cats'):
+    return Mosaic.objects.create(slug=slug, status=1, minimum_image_count=1,
+                                 incremental_update_count=1)
+
+
+def jpeg(size=(32, 32), color=(0, 0, 0)):
+    output = io.BytesIO()
+    Image.new('RGB', size, color).save(output, 'JPEG')
+    return ContentFile(output.getvalue())
+
+
+class MediaTestCase(TestCase):
+    "Files saved in a temporary MEDIA_ROOT"
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media = override_settings(MEDIA_ROOT=self.media_root)
+        self.media.enable()
+
+    def tearDown(self):
+        self.media.disable()
+        shutil.rmtree(self.media_root)
+
+
+class RenderTestCase(MediaTestCase):
+    "The mosaic 'cats', and a render of it"
+
+    def setUp(self):
+        super(RenderTestCase, self).setUp()
+        cache.clear()
+        self.mosaic = make_mosaic()
+        self.render = MosaicRender(mosaic=self.mosaic, tiles_x=2, tiles_y=2)
+        self.render.final_image.save('renders/cats.jpg', jpeg())
+
+    def repaint(self):
+        #what render.repaint_positions does once the tiles are pasted
+        self.render.save(update_fields=['modified_at'])
+        set_latest(self.render)
+
+    def get(self, **headers):
+        return serve(RequestFactory().get('/', **headers), 'render', 'cats')
+
+
+class PayloadTest(RenderTestCase):
+
+    def test_versions(self):
+        current = version(self.render)
+        self.assertEqual(parse_version(current['version']),
+                         dict((key, current[key])
+                              for key in ('id', 'version', 'modified')))
+        self.repaint()
+        #even within the same second
+        self.assertNotEqual(version(self.render)['version'],
+                            current['version'])
+
+    def test_latest(self):
+        self.assertEqual(latest('cats'), version(self.render))
+        self.assertIsNone(latest('dogs'))
+        self.repaint()
+        self.assertEqual(latest('cats'), version(self.render))
+
+    def test_repainted_image_url_changes(self):
+        data = json.loads(self.get().content.decode('utf-8'))
+        self.assertEqual(data['image'], '%s?v=%s' % (
+            self.render.final_image.url, data['version']))
+        self.assertIsNone(data['blended_image'])
+        self.repaint()
+        repainted = json.loads(self.get().content.decode('utf-8'))
+        self.assertNotEqual(repainted['image'], data['image'])
+
+    def test_conditional_get(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertNotEqual(response['ETag'], etag)
+        self.repaint()
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class TimelapseTest(RenderTestCase):
+
+    def test_frames(self):
+        source = MosaicSourceImage()
+        source.image.save('red.jpg', jpeg(color=(255, 0, 0)), save=False)
+        source.save()
+        SourcePosition.objects.create(render=self.render, x=1, y=1,
+                                      source_image=source)
+        #odd sizes: ffmpeg pads them for yuv420p
+        timelapse = Timelapse(self.mosaic, (101, 75))
+        self.assertIn('pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                      timelapse.ffmpeg_command('out.mp4', 10))
+        (frame,) = list(timelapse.frames())
+        self.assertEqual(frame.size, (101, 75))
+        self.assertEqual(frame.getpixel((10, 10)), (0, 0, 0))
+        (red, green, blue) = frame.getpixel((80, 60))
+        self.assertTrue(red > 200 and green < 50 and blue < 50)
+        destination = self.media_root + '/timelapse.gif'
+        self.assertEqual(timelapse._gif(timelapse.frames(), destination,
+                                        10, 1), 1)
+
+
+@override_settings(MOSAIC_EVENTS_DURATION=0)
+class LiveTest(RenderTestCase):
+
+    def position(self, x, y, source):
+        return SourcePosition.objects.create(render=self.render, x=x, y=y,
+                                             source_image=source)
+
+    def test_tile_event(self):
+        sources = []
+        for i in range(3):
+            source = MosaicSourceImage()
+            source.image.save('source%d.jpg' % i, jpeg(), save=False)
+            source.save()
+            sources.append(source)
+        (first, second, third) = sources
+        self.position(0, 0, first)
+        changed = self.position(1, 0, second)
+        prebuild('layout', self.render)
+        since = version(self.render)['version']
+        changed.source_image = third
+        changed.save()
+        self.repaint()
+        live._diffs.clear()
+        (name, data) = live.tile_event(since, latest('cats'))
+        self.assertEqual(name, 'tiles')
+        data = json.loads(data)
+        self.assertEqual(data['from'], since)
+        self.assertEqual(data['cells'], [[1, 0, third.pk]])
+        self.assertEqual(list(data['sources']), [str(third.pk)])
+        #too old to diff against: the viewer reloads
+        (name, data) = live.tile_event('1-0', latest('cats'))
+        self.assertEqual(name, 'reload')
+
+    def test_stream_ends(self):
+        #browsers reconnect, instead of holding a worker indefinitely
+        self.assertEqual(list(live.stream('cats', '')), ['retry: 1000\n\n'])
+
+
+class SchedulerTest(MediaTestCase):
+
+    def mosaic(self, slug, rendered_ago=None, target=True, **fields):
+        if rendered_ago is not None:
+            fields['last_render'] = timezone.now() - timedelta(
+                seconds=rendered_ago)
+        mosaic = Mosaic.objects.create(
+            slug=slug, status=fields.pop('status', 1), minimum_image_count=3,
+            incremental_update_count=5, **fields)
+        if target:
+            mosaic.target_image.save('%s.jpg' % slug, jpeg())
+        return mosaic
+
+    def due(self, **kwargs):
+        return sorted(mosaic.slug for mosaic in due_mosaics(**kwargs))
+
+    def test_due_mosaics(self):
+        self.mosaic('first', source_count=3)
+        self.mosaic('too-few', source_count=2)
+        self.mosaic('again', rendered_ago=3600, source_count=15,
+                    rendered_source_count=10)
+        self.mosaic('not-enough-new', rendered_ago=3600, source_count=14,
+                    rendered_source_count=10)
+        self.mosaic('inactive', status=0, source_count=3)
+        self.mosaic('no-target', target=False, source_count=3)
+        recent = self.mosaic('recent', rendered_ago=10, source_count=15,
+                             rendered_source_count=10)
+        self.assertEqual(self.due(), ['again', 'first', 'recent'])
+        self.assertEqual(self.due(cooldown=60), ['again', 'first'])
+        self.assertEqual(self.due(exclude=[recent.pk]), ['again', 'first'])
+
+    def test_priority(self):
+        now = timezone.now()
+        first = self.mosaic('first', source_count=3)
+        stale = self.mosaic('stale', rendered_ago=3600, source_count=15,
+                            rendered_source_count=10)
+        fresh = self.mosaic('fresh', rendered_ago=60, source_count=15,
+                            rendered_source_count=10)
+        busy = self.mosaic('busy', rendered_ago=60, source_count=30,
+                           rendered_source_count=10)
+        self.assertEqual(sorted([fresh, busy, stale, first],
+                                key=lambda m: priority(m, now), reverse=True),
+                         [first, stale, busy, fresh])
+
+    def test_host_slots(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        slots = HostSlots(2, directory)
+        taken = [slots.acquire(), slots.acquire()]
+        self.assertNotIn(None, taken)
+        self.assertIsNone(slots.acquire())
+        #another scheduler on the same host shares the cap
+        self.assertIsNone(HostSlots(2, directory).acquire())
+        slots.release(taken.pop())
+        slot = HostSlots(2, directory).acquire()
+        self.assertIsNotNone(slot)
+        for slot in taken + [slot]:
+            slots.release(slot)
@@ -0,0 +1,151 @@
+"""
+Time-lapse of a mosaic filling in, out of its render history.
+
+Each MosaicRender is a full image, but its SourcePositions tell what is
+on each tile: frames are rebuilt from those instead of decoding the
+renders.  A single canvas, at the size of the video, is kept from one
+frame to the next, and only the tiles whose source changed since the
+previous render are pasted (as small thumbnails, decoded once per
+source).  When the lattice itself changes, the frame is painted from
+scratch.  Frames are piped to ffmpeg as they're made (or, for a .gif
+without ffmpeg, handed to PIL).
+"""
+import subprocess
+
+from PIL import Image
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+from .models import MosaicSourceImage
+
+
+class Timelapse(object):
+
+    def __init__(self, mosaic, size=(800, 600)):
+        self.mosaic = mosaic
+        self.size = size
+        self.canvas = Image.new('RGB', size)
+        self._storage = MosaicSourceImage._meta.get_field('image').storage
+        self._paths = {}
+        self._thumbnails = {}
+        self._grid = None
+        self._cells = {}
+
+    def renders(self):
+        return self.mosaic.mosaicrender_set.exclude(tiles_x=None)\
+                                           .order_by('pk')
+
+    def _box(self, x, y):
+        (tiles_x, tiles_y) = self._grid
+        (width, height) = self.size
+        return (x * width // tiles_x, y * height // tiles_y,
+                (x + 1) * width // tiles_x, (y + 1) * height // tiles_y)
+
+    def _thumbnail(self, source_id, size):
+        key = (source_id, size)
+        if key not in self._thumbnails:
+            thumbnail = None
+            path = self._paths.get(source_id)
+            if path is not None:
+                try:
+                    image = Image.open(path)
+                    image.draft('RGB', size)
+                    thumbnail = image.convert('RGB').resize(size,
+                                                            Image.LANCZOS)
+                except IOError:
+                    pass
+            self._thumbnails[key] = thumbnail
+        return self._thumbnails[key]
+
+    def _load_paths(self, source_ids):
+        missing = set(source_ids) - set(self._paths)
+        #duplicates show the picture of their canonical source
+        for (pk, image, canonical_image) in MosaicSourceImage.objects\
+                .filter(pk__in=missing)\
+                .values_list('pk', 'image', 'canonical__image'):
+            if canonical_image or image:
+                self._paths[pk] = self._storage.path(canonical_image or image)
+
+    def apply(self, render):
+        "Update the canvas to `render`; returns the number of tiles pasted"
+        cells = dict(((x, y), source_id) for (x, y, source_id) in
+                     render.sourceposition_set.values_list(
+                         'x', 'y', 'source_image_id'))
+        grid = (render.tiles_x, render.tiles_y)
+        if grid != self._grid:
+            #other tiles: repaint everything
+            self._grid = grid
+            self._cells = {}
+            self._thumbnails = {}
+            self.canvas.paste((0, 0, 0), (0, 0) + self.size)
+        changed = [(cell, source_id) for (cell, source_id) in cells.items()
+                   if self._cells.get(cell) != source_id]
+        self._load_paths(source_id for (cell, source_id) in changed)
+        for ((x, y), source_id) in changed:
+            box = self._box(x, y)
+            thumbnail = self._thumbnail(source_id,
+                                        (box[2] - box[0], box[3] - box[1]))
+            if thumbnail is not None:
+                self.canvas.paste(thumbnail, box)
+        self._cells = cells
+        return len(changed)
+
+    def frames(self):
+        "The canvas after each render, in order"
+        for render in self.renders().iterator():
+            self.apply(render)
+            yield self.canvas
+
+    def write(self, destination, fps=10, hold=2):
+        """
+        Write the time-lapse to `destination` (any format ffmpeg knows,
+        or a .gif); the last frame is shown `hold` more seconds
+        """
+        frames = self.frames()
+        if which('ffmpeg'):
+            return self._ffmpeg(frames, destination, fps, hold)
+        if not destination.lower().endswith('.gif'):
+            raise ValueError('ffmpeg is needed for %s' % destination)
+        return self._gif(frames, destination, fps, hold)
+
+    def ffmpeg_command(self, destination, fps):
+        #yuv420p needs even dimensions: odd ones get a black line padded
+        return ['ffmpeg', '-loglevel', 'error', '-y',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                '-s', '%dx%d' % self.size, '-r', str(fps), '-i', '-',
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                '-pix_fmt', 'yuv420p', destination]
+
+    def _ffmpeg(self, frames, destination, fps, hold):
+        encoder = subprocess.Popen(self.ffmpeg_command(destination, fps),
+                                   stdin=subprocess.PIPE)
+        count = 0
+        frame = None
+        try:
+            for frame in frames:
+                encoder.stdin.write(frame.tobytes())
+                count += 1
+            if frame is not None:
+                for i in range(int(hold * fps)):
+                    encoder.stdin.write(frame.tobytes())
+        finally:
+            encoder.stdin.close()
+            encoder.wait()
+        if encoder.returncode:
+            raise RuntimeError('ffmpeg failed (%d)' % encoder.returncode)
+        return count
+
+    def _gif(self, frames, destination, fps, hold):
+        #PIL wants all the frames at once: keep them small, palettized
+        images = [frame.convert('P', palette=Image.ADAPTIVE)
+                  for frame in frames]
+        if not images:
+            return 0
+        durations = [int(1000 / fps)] * len(images)
+        durations[-1] += int(hold * 1000)
+        images[0].save(destination, save_all=True,
+                       append_images=images[1:], duration=durations, loop=0)
+        return len(images)
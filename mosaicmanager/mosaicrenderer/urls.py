@@ -0,0 +1,11 @@
+from django.conf.urls import url
+
+from . import live, views
+
+urlpatterns = [
+    url(r'^(?P<slug>[\w-]+)/render\.json$', views.render_json,
+        name='mosaic-render'),
+    url(r'^(?P<slug>[\w-]+)/layout\.json$', views.layout_json,
+        name='mosaic-layout'),
+    url(r'^(?P<slug>[\w-]+)/events$', live.events, name='mosaic-events'),
+]
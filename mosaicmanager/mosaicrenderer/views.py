@@ -1,3 +1,48 @@
-from django.shortcuts import render
+"""
+Read-only json data about the latest render of each mosaic, for
+viewers: built once per render and served from the cache (payloads.py).
+"""
+from .colors import parse_color
+from .payloads import register, serve, version
 
-# Create your views here.
+
+def versioned_url(image, current):
+    "Url of a render image, changing when it is repainted in place"
+    return '%s?v=%s' % (image.url, current['version']) if image else None
+
+
+@register('render')
+def render_data(render):
+    mosaic = render.mosaic
+    current = version(render)
+    return {
+        'id': render.pk,
+        'version': current['version'],
+        'slug': mosaic.slug,
+        'title': mosaic.title,
+        'image': versioned_url(render.final_image, current),
+        'blended_image': versioned_url(render.blended_image, current),
+        'opacity': mosaic.opacity,
+        'tiles_x': render.tiles_x,
+        'tiles_y': render.tiles_y,
+        'modified_at': render.modified_at.isoformat(),
+    }
+
+
+@register('layout')
+def layout_data(render):
+    "The source and target color of each tile, row by row"
+    tiles = [None] * (render.tiles_x * render.tiles_y)
+    for (x, y, source_id, color) in render.sourceposition_set.values_list(
+            'x', 'y', 'source_image_id', 'average_color'):
+        tiles[y * render.tiles_x + x] = [source_id, parse_color(color)]
+    return {'id': render.pk, 'tiles_x': render.tiles_x,
+            'tiles_y': render.tiles_y, 'tiles': tiles}
+
+
+def render_json(request, slug):
+    return serve(request, 'render', slug)
+
+
+def layout_json(request, slug):
+    return serve(request, 'layout', slug)
@@ -1,25 +1,39 @@
+import os
+
 from django.apps import AppConfig
 from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def sqlite_wal(sender, connection, **kwargs):
+    """
+    With the default rollback journal, every collector write blocks the
+    readers (admin, renders).  WAL lets them run concurrently, and with
+    synchronous=NORMAL a commit doesn't wait for a sync to disk.
+    """
+    if connection.vendor == 'sqlite':
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL;')
+        cursor.execute('PRAGMA synchronous=NORMAL;')
 
 
 class TwitterCollectorConfig(AppConfig):
     """
-    loading this config (by including 
-    'twittercollector.apps.TwitterCollectorConfig' in
-    settings.INSTALLED_APPS) will automatically start
-    processes for active twitter collectors as subprocesses
-    and make sure they remain present while Django is running.
+    Collector processes are started by `manage.py run_collectors`,
+    which keeps one running for each account with active mosaics (see
+    collector.CollectorSupervisor); run it next to the web server.
 
-    If you just want the schema, without running the
-    processes (e.g. if you will run the processes on a
-    different machine, or managed differently), then 
-    just include 'twittercollector' in INSTALLED_APPS instead
+    With TWITTERCOLLECTOR_AUTOSTART = True, loading this config starts
+    the supervisor in a background thread of every Django process
+    instead: only for a single process setup, e.g. runserver.
     """
     
     name = 'twittercollector'
 
     def ready(self):
-        #1. make sure that for all active Mosaics, there's a process running
-        print('sky sky sky')
-        print('settings', settings)
+        connection_created.connect(sqlite_wal)
+        from .collector import CHILD_ENV, CollectorSupervisor
+        if getattr(settings, 'TWITTERCOLLECTOR_AUTOSTART', False) \
+           and not os.environ.get(CHILD_ENV):
+            CollectorSupervisor().watch()
     
@@ -0,0 +1,131 @@
+"""
+Downloading the avatars of collected sources.
+
+Sources are saved first (see buffer.SourceBuffer and backfill.Backfill)
+and their avatars fetched right after, by a pool of threads.  For each
+avatar we store its average color and perceptual hash (see dedup.py).
+
+Avatars that are near-identical to one already collected (default
+avatars, the same photo re-uploaded...) aren't stored again: the source
+points to the first one as its `canonical` source, whose
+reference_count goes up.  Renders then use each picture only once.
+
+The hash index is loaded from the database when a fetcher starts, and
+kept up to date in memory: near duplicates collected at the same time
+by another process may not be recognized.
+"""
+import io
+import threading
+from multiprocessing.pool import ThreadPool
+
+import requests
+from PIL import Image
+
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+from django.db.models import F
+
+from dedup import HashIndex, dhash, from_hex, to_hex
+from mosaicrenderer.colors import average_color, format_color
+from mosaicrenderer.models import MosaicSourceImage
+
+from .models import TweetMosaicSource
+
+
+def image_extension(url):
+    ext = url.rsplit('.', 1)[-1].lower()
+    return ext if ext in ('jpg', 'jpeg', 'png') else None
+
+
+class AvatarFetcher(object):
+
+    def __init__(self, workers=8, max_distance=4):
+        self.workers = workers
+        self.max_distance = max_distance
+        self._pool = None
+        self._pending = []
+        self._index = None
+        self._lock = threading.Lock()
+
+    def index(self):
+        with self._lock:
+            if self._index is None:
+                self._index = HashIndex(self.max_distance)
+                for (pk, value, count) in MosaicSourceImage.objects.filter(
+                        canonical=None).exclude(image='').exclude(
+                        image_hash=None).exclude(image_hash='').values_list(
+                        'pk', 'image_hash', 'reference_count'):
+                    self._index.insert(from_hex(value), pk, count)
+            return self._index
+
+    def fetch(self, source):
+        "Download the avatar of a saved TweetMosaicSource"
+        try:
+            self._fetch(source)
+        finally:
+            close_old_connections()
+
+    def _fetch(self, source):
+        sources = MosaicSourceImage.objects.filter(pk=source.pk)
+        ext = image_extension(source.image_url)
+        try:
+            if ext is None:
+                raise IOError('not an image: %s' % source.image_url)
+            response = requests.get(source.image_url, timeout=30)
+            if response.status_code != 200:
+                raise IOError('status %s' % response.status_code)
+            image = Image.open(io.BytesIO(response.content))
+            color = average_color(image)
+            value = dhash(image)
+        except (requests.RequestException, IOError):
+            #an empty hash marks it as unusable, not to retry it forever
+            sources.update(image_hash='')
+            return
+        index = self.index()
+        with self._lock:
+            canonical = index.find(value)
+            if canonical is None:
+                index.insert(value, source.pk)
+            else:
+                index.refcount[canonical] += 1
+        if canonical is None:
+            storage = MosaicSourceImage._meta.get_field('image').storage
+            name = storage.save('tweets/%s.%s' % (source.user_id, ext),
+                                ContentFile(response.content))
+            sources.update(image=name, average_color=format_color(color),
+                           image_hash=to_hex(value))
+        else:
+            sources.update(canonical=canonical,
+                           average_color=format_color(color),
+                           image_hash=to_hex(value))
+            MosaicSourceImage.objects.filter(pk=canonical).update(
+                reference_count=F('reference_count') + 1)
+
+    def submit(self, sources):
+        "Fetch the avatars of saved sources in the background"
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        self._pending = [r for r in self._pending if not r.ready()]
+        self._pending.append(self._pool.map_async(self.fetch, list(sources)))
+
+    def submit_batch(self, batch):
+        "SourceBuffer on_flush callback"
+        self.submit(source for (source, mosaic_ids) in batch)
+
+    def submit_missing(self, mosaic_ids):
+        "Fetch avatars never fetched (e.g. the process died meanwhile)"
+        self.submit(TweetMosaicSource.objects.filter(
+            mosaics__in=mosaic_ids, image='', canonical=None,
+            image_hash=None).exclude(image_url='').distinct())
+
+    def wait(self):
+        for result in self._pending:
+            result.wait()
+        self._pending = []
+
+    def close(self):
+        self.wait()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
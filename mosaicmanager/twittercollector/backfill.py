@@ -0,0 +1,222 @@
+"""
+Historical backfill of a TwitterMosaic from the search api.
+
+The stream only brings tweets from now on; a new mosaic gets to its
+minimum_image_count much sooner with the tweets of the past days.
+Search pages go back in time (each page asks for tweets older than the
+oldest of the previous one), so fetching itself is sequential, but it
+runs in its own thread ahead of the rest:
+
+    fetch page -> save page -> download avatars (see avatars.py)
+
+Avatars are downloaded concurrently, while the next pages are fetched
+and saved.  A page is saved in one transaction together with the
+mosaic's BackfillCheckpoint, so after a crash the backfill resumes with
+the first page that wasn't saved (and avatars not downloaded yet are
+fetched when it starts again).
+
+Requests go through a TokenBucket per collector account, refilled at
+the search quota rate (180 requests / 15 minutes) and re-synchronized
+with the rate limit headers twitter sends back.
+"""
+import threading
+import time
+
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections, transaction
+
+from .avatars import AvatarFetcher
+from .buffer import save_sources
+from .models import BackfillCheckpoint, TweetMosaicSource
+
+#search quota, per user and 15 minutes window
+SEARCH_REQUESTS = 180
+SEARCH_WINDOW = 15 * 60
+
+
+class TokenBucket(object):
+    "Thread-safe token bucket: take() blocks until a request is allowed"
+
+    def __init__(self, rate=SEARCH_REQUESTS / float(SEARCH_WINDOW),
+                 capacity=SEARCH_REQUESTS):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._updated = time.time()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now >= self._paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self._paused_until - now,
+                           (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def sync(self, remaining, reset):
+        "Adopt the server's view: `remaining` requests until `reset` (epoch)"
+        with self._lock:
+            self._refill(time.time())
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining <= 0:
+                self._paused_until = max(self._paused_until, reset)
+
+    def pause_until(self, reset):
+        with self._lock:
+            self.tokens = 0
+            self._paused_until = max(self._paused_until, reset)
+
+
+class Backfill(object):
+
+    def __init__(self, mosaic, api, bucket=None, download_workers=8,
+                 prefetch=3, limit=None):
+        """
+        mosaic: TwitterMosaic
+        api: tweepy.API for the mosaic's collector
+        bucket: TokenBucket shared by the backfills of the same account
+        limit: stop after this many new sources (e.g. what is missing
+               to reach minimum_image_count)
+        """
+        self.mosaic = mosaic
+        self.api = api
+        self.bucket = bucket or TokenBucket()
+        self.avatars = AvatarFetcher(download_workers)
+        self.prefetch = prefetch
+        self.limit = limit
+        self.added = 0
+        self._stop = threading.Event()
+
+    def checkpoint(self):
+        (checkpoint, created) = BackfillCheckpoint.objects.get_or_create(
+            mosaic=self.mosaic)
+        if checkpoint.completed:
+            #everything up to newest_id is there: only look for newer
+            checkpoint.completed = False
+            checkpoint.max_id = checkpoint.newest_id = None
+            checkpoint.save()
+        return checkpoint
+
+    def _search(self, max_id, since_id):
+        import tweepy
+        while True:
+            self.bucket.take()
+            try:
+                results = self.api.search(q=self.mosaic.twitter_search,
+                                          count=100, result_type='recent',
+                                          max_id=max_id, since_id=since_id,
+                                          include_entities=False)
+            except tweepy.RateLimitError:
+                self.bucket.pause_until(self._reset() or
+                                        time.time() + SEARCH_WINDOW)
+                continue
+            headers = getattr(self.api.last_response, 'headers', {})
+            if 'x-rate-limit-remaining' in headers:
+                self.bucket.sync(int(headers['x-rate-limit-remaining']),
+                                 self._reset())
+            return [status._json for status in results]
+
+    def _reset(self):
+        headers = getattr(self.api.last_response, 'headers', {})
+        return int(headers.get('x-rate-limit-reset', 0))
+
+    def _put(self, pages, item):
+        while not self._stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def _fetch(self, checkpoint, pages):
+        "Producer thread: put pages of tweets, then None"
+        (max_id, since_id) = (checkpoint.max_id, checkpoint.since_id)
+        try:
+            while not self._stop.is_set():
+                tweets = self._search(max_id, since_id)
+                self._put(pages, tweets)
+                if not tweets:
+                    break
+                max_id = min(int(t['id_str']) for t in tweets) - 1
+        except Exception as e:
+            self._put(pages, e)
+        else:
+            self._put(pages, None)
+
+    def _new_sources(self, tweets):
+        "Sources for users not in the mosaic yet (one tile per user)"
+        sources = {}
+        for tweet in tweets:
+            source = TweetMosaicSource.from_tweet(tweet)
+            if source.image_url and source.user_id not in sources:
+                sources[source.user_id] = source
+        known = set(TweetMosaicSource.objects.filter(
+            mosaics=self.mosaic, user_id__in=list(sources))
+            .values_list('user_id', flat=True))
+        return [s for (user_id, s) in sources.items() if user_id not in known]
+
+    def _save(self, checkpoint, tweets, sources, content_type):
+        ids = [int(t['id_str']) for t in tweets]
+        with transaction.atomic():
+            save_sources([(s, [self.mosaic.pk]) for s in sources],
+                         content_type)
+            if tweets:
+                if checkpoint.newest_id is None:
+                    checkpoint.newest_id = max(ids)
+                checkpoint.max_id = min(ids) - 1
+                checkpoint.tweet_count += len(tweets)
+            else:
+                checkpoint.completed = True
+                checkpoint.since_id = checkpoint.newest_id \
+                    or checkpoint.since_id
+            checkpoint.save()
+        self.added += len(sources)
+
+    def run(self):
+        "Backfill until done, stopped or limit; returns # of sources added"
+        checkpoint = self.checkpoint()
+        content_type = ContentType.objects.get_for_model(TweetMosaicSource)
+        pages = Queue(self.prefetch)
+        fetcher = threading.Thread(target=self._fetch,
+                                   args=(checkpoint, pages))
+        fetcher.daemon = True
+        fetcher.start()
+        self.avatars.submit_missing([self.mosaic.pk])
+        try:
+            while True:
+                tweets = pages.get()
+                if tweets is None:
+                    break
+                if isinstance(tweets, Exception):
+                    raise tweets
+                sources = self._new_sources(tweets)
+                self._save(checkpoint, tweets, sources, content_type)
+                self.avatars.submit(sources)
+                if not tweets or self._stop.is_set() or \
+                   (self.limit is not None and self.added >= self.limit):
+                    break
+        finally:
+            #the fetcher notices within a second (or after its next
+            #request, if it waits for the rate limit)
+            self._stop.set()
+            self.avatars.close()
+            close_old_connections()
+        return self.added
+
+    def stop(self):
+        self._stop.set()
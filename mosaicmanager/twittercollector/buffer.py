@@ -0,0 +1,173 @@
+"""
+Batched writes of collected tweets.
+
+Saving every tweet on its own means a transaction (and on SQLite, a
+sync to disk) per tweet, which is what limits ingest during trending
+spikes.  A SourceBuffer keeps the tweets in memory and writes them
+together, in one transaction, when there are enough of them or when
+the oldest one has waited long enough.
+
+TweetMosaicSource is a multi-table child of MosaicSourceImage, which
+Django can't bulk_create.  So the MosaicSourceImage rows are
+bulk_created first, then the TweetMosaicSource rows pointing at them are
+inserted a batch at a time.  That takes the pks of the new parents: the
+database returns them on PostgreSQL, and on SQLite they are the last
+ones (the transaction holds its only write lock).  Other databases get
+one insert per source, still inside the batch transaction.  The
+mosaic <-> source links are bulk_created.
+"""
+import threading
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections, connection, transaction
+
+from mosaicrenderer.models import Mosaic, MosaicSourceImage
+
+from .models import TweetMosaicSource
+
+
+def insert_parents(sources):
+    """
+    bulk_create the MosaicSourceImage rows of unsaved `sources` and set
+    the pks of `sources` to theirs; returns False, having inserted
+    nothing, when the database can't tell those pks
+    """
+    features = connection.features
+    #renamed in Django 3.0
+    returns_ids = getattr(features, 'can_return_rows_from_bulk_insert',
+                          getattr(features, 'can_return_ids_from_bulk_insert',
+                                  False))
+    if not returns_ids and connection.vendor != 'sqlite':
+        return False
+    fields = MosaicSourceImage._meta.concrete_fields
+    parents = [MosaicSourceImage(**dict((field.attname,
+                                         getattr(source, field.attname))
+                                        for field in fields))
+               for source in sources]
+    MosaicSourceImage.objects.bulk_create(parents)
+    if not returns_ids:
+        #nobody else can write before the transaction ends: ours are the
+        #latest rows, in order
+        pks = MosaicSourceImage.objects.order_by('-pk')\
+            .values_list('pk', flat=True)[:len(parents)]
+        for (parent, pk) in zip(parents, reversed(list(pks))):
+            parent.pk = pk
+    for (source, parent) in zip(sources, parents):
+        source.pk = parent.pk
+    return True
+
+
+def insert_sources(sources):
+    "Insert unsaved TweetMosaicSources, in as few queries as possible"
+    if not insert_parents(sources):
+        for source in sources:
+            source.save(force_insert=True)
+        return
+    #the child rows, with the link to their parent
+    fields = TweetMosaicSource._meta.local_concrete_fields
+    size = max(1, connection.ops.bulk_batch_size(fields, sources))
+    for start in range(0, len(sources), size):
+        TweetMosaicSource._base_manager._insert(sources[start:start + size],
+                                                fields=fields)
+    for source in sources:
+        source._state.adding = False
+        source._state.db = connection.alias
+
+
+def save_sources(batch, content_type):
+    """
+    Insert (unsaved source, mosaic ids) pairs and their mosaic links;
+    call it inside a transaction
+    """
+    Link = Mosaic.source_images.through
+    links = []
+    counts = {}
+    for (source, mosaic_ids) in batch:
+        source.content_type = content_type
+    insert_sources([source for (source, mosaic_ids) in batch])
+    for (source, mosaic_ids) in batch:
+        for mosaic_id in mosaic_ids:
+            links.append(Link(mosaic_id=mosaic_id,
+                              mosaicsourceimage_id=source.pk))
+            counts[mosaic_id] = counts.get(mosaic_id, 0) + 1
+    Link.objects.bulk_create(links)
+    #bulk_create doesn't send m2m_changed
+    Mosaic.count_sources(counts)
+
+
+class SourceBuffer(object):
+
+    def __init__(self, max_size=500, max_wait=2.0, on_flush=None):
+        """
+        max_size: flush as soon as this many tweets are buffered
+        max_wait: flush when the oldest buffered tweet is this old (seconds)
+        on_flush: called with the list of (source, mosaic_ids) just saved
+        """
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.on_flush = on_flush
+        self._pending = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._timer = None
+        self._content_type = None
+
+    @property
+    def content_type(self):
+        if self._content_type is None:
+            self._content_type = ContentType.objects.get_for_model(
+                TweetMosaicSource)
+        return self._content_type
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, source, mosaic_ids=()):
+        """
+        Queue an unsaved TweetMosaicSource, to be linked to the mosaics
+        with the given ids
+        """
+        with self._lock:
+            self._pending.append((source, list(mosaic_ids)))
+            if self._oldest is None:
+                self._oldest = time.time()
+            full = len(self._pending) >= self.max_size
+        if full or self.due():
+            self.flush()
+
+    def due(self):
+        oldest = self._oldest
+        return oldest is not None and time.time() - oldest >= self.max_wait
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending, self._oldest = self._pending, [], None
+        if not batch:
+            return []
+        with transaction.atomic():
+            save_sources(batch, self.content_type)
+        if self.on_flush:
+            self.on_flush(batch)
+        return batch
+
+    def start_timer(self):
+        """
+        Flush from a background thread too, so that a quiet stream
+        doesn't keep the last tweets in memory
+        """
+        if self._timer is not None:
+            return
+        def run():
+            while self._timer is not None:
+                time.sleep(self.max_wait / 2.0)
+                if self.due():
+                    self.flush()
+            close_old_connections()
+        self._timer = threading.Thread(target=run, name='sourcebuffer')
+        self._timer.daemon = True
+        self._timer.start()
+
+    def close(self):
+        self._timer = None
+        self.flush()
@@ -0,0 +1,383 @@
+"""
+Collector processes: one stream per twitter account.
+
+Twitter only allows one filtered stream per account, so instead of a
+process per mosaic, all active TwitterMosaics sharing a collector
+(UserSocialAuth) are merged into a single stream tracking all of their
+searches.  Each incoming tweet is then routed locally to the mosaics
+whose search it matches.
+
+CollectorSupervisor (`manage.py run_collectors`, also used by
+TwitterMosaic.start_collectors) keeps one `manage.py run_collector
+<collector id>` process per account alive.
+Each process writes a pid file and touches a heartbeat file whenever
+it receives data (the stream sends keep-alives when quiet), so a
+process that is still there but stuck is restarted too.
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+
+from .avatars import AvatarFetcher
+from .buffer import SourceBuffer
+from .models import TweeterBlocklist, TweetMosaicSource, TwitterMosaic
+
+#set on the processes started by the supervisor
+CHILD_ENV = 'TWITTERCOLLECTOR_CHILD'
+
+WORD_RE = re.compile(r'[#@]?\w+', re.UNICODE)
+
+
+def search_terms(twitter_search):
+    """
+    Stream track phrases for a search query: phrases are separated by
+    commas (or OR), and search operators like filter:safe are dropped
+    since the stream doesn't support them
+    """
+    phrases = []
+    for phrase in re.split(r',|\s+OR\s+', twitter_search or ''):
+        words = [w for w in phrase.split() if ':' not in w]
+        if words:
+            phrases.append(' '.join(words).lower())
+    return phrases
+
+
+def tweet_words(data):
+    "Lowercased words of a tweet, with and without their #/@ prefix"
+    words = set()
+    for word in WORD_RE.findall(data.get('text') or ''):
+        word = word.lower()
+        words.add(word)
+        words.add(word.lstrip('#@'))
+    return words
+
+
+class StreamRouter(object):
+    """
+    Turns raw stream messages into TweetMosaicSources for the mosaics
+    that track them.
+
+    Like twitter's track, a phrase matches when all of its words are in
+    the tweet.  Phrases are indexed by their first word, so routing a
+    tweet costs a lookup per word of the tweet, not per mosaic.
+    """
+
+    def __init__(self, mosaics, buffer):
+        "mosaics: {mosaic id: twitter_search}"
+        self.buffer = buffer
+        self.terms = set()
+        self._by_word = {}
+        for (mosaic_id, twitter_search) in mosaics.items():
+            for phrase in search_terms(twitter_search):
+                self.terms.add(phrase)
+                words = phrase.split()
+                self._by_word.setdefault(words[0], []).append(
+                    (mosaic_id, set(words[1:])))
+        self.received = 0
+        self.routed = 0
+        self._blocked = (0, frozenset())
+
+    def blocked(self):
+        "Blocked usernames, re-read every few seconds"
+        (read_at, blocked) = self._blocked
+        if time.time() - read_at > 10:
+            blocked = TweeterBlocklist.blocked_usernames()
+            self._blocked = (time.time(), blocked)
+        return blocked
+
+    def route(self, data):
+        "Ids of the mosaics a tweet (dict) belongs to"
+        words = tweet_words(data)
+        mosaic_ids = set()
+        for word in words:
+            for (mosaic_id, rest) in self._by_word.get(word, ()):
+                if rest <= words:
+                    mosaic_ids.add(mosaic_id)
+        return sorted(mosaic_ids)
+
+    def on_data(self, raw):
+        data = json.loads(raw)
+        if 'user' not in data or 'text' not in data:
+            #delete/limit/warning messages
+            return True
+        self.received += 1
+        username = (data['user'].get('screen_name') or '').lower()
+        if username in self.blocked():
+            return True
+        mosaic_ids = self.route(data)
+        if mosaic_ids:
+            self.routed += 1
+            self.buffer.add(TweetMosaicSource.from_tweet(data), mosaic_ids)
+        return True
+
+
+def run_dir():
+    path = getattr(settings, 'TWITTERCOLLECTOR_RUN_DIR',
+                   os.path.join(tempfile.gettempdir(), 'twittercollector'))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def pid_file(collector_id):
+    return os.path.join(run_dir(), 'collector-%s.pid' % collector_id)
+
+
+def heartbeat_file(collector_id):
+    return os.path.join(run_dir(), 'collector-%s.heartbeat' % collector_id)
+
+
+def twitter_auth(collector_id):
+    "tweepy auth handler for a collector account (UserSocialAuth id)"
+    import tweepy
+    from social.apps.django_app.default.models import UserSocialAuth
+    token = UserSocialAuth.objects.get(pk=collector_id)\
+                                  .extra_data['access_token']
+    auth = tweepy.OAuthHandler(settings.SOCIAL_AUTH_TWITTER_KEY,
+                               settings.SOCIAL_AUTH_TWITTER_SECRET)
+    auth.set_access_token(token['oauth_token'],
+                          token['oauth_token_secret'])
+    return auth
+
+
+def active_mosaics(collector_id=None):
+    "{collector id: {mosaic id: twitter_search}} of active mosaics"
+    mosaics = TwitterMosaic.objects.filter(status=1, collector__isnull=False)
+    if collector_id is not None:
+        mosaics = mosaics.filter(collector_id=collector_id)
+    groups = {}
+    for (mosaic_id, collector, search) in mosaics.values_list(
+            'id', 'collector_id', 'twitter_search'):
+        if search_terms(search):
+            groups.setdefault(collector, {})[mosaic_id] = search
+    return groups
+
+
+class StreamCollector(object):
+    """
+    The body of a collector process: streams the merged searches of an
+    account, and reconnects when its mosaics (or their searches) change.
+
+    With stream_url, line-delimited tweets are read from that url over
+    plain http instead of twitter (e.g. from a local fake stream server).
+    """
+
+    def __init__(self, collector_id, stream_url=None, reload_interval=60,
+                 buffer=None):
+        self.collector_id = collector_id
+        self.stream_url = stream_url
+        self.reload_interval = reload_interval
+        self.avatars = AvatarFetcher()
+        self.buffer = buffer or SourceBuffer(
+            on_flush=self.avatars.submit_batch)
+        self._stop = threading.Event()
+        self._last_beat = 0
+
+    def heartbeat(self):
+        #at most once a second: it's called for every tweet
+        now = time.time()
+        if now - self._last_beat >= 1:
+            self._last_beat = now
+            with open(heartbeat_file(self.collector_id), 'a'):
+                os.utime(heartbeat_file(self.collector_id), None)
+
+    def mosaics(self):
+        return active_mosaics(self.collector_id).get(self.collector_id, {})
+
+    def _http_stream(self, router, stop):
+        import requests
+        response = requests.post(self.stream_url,
+                                 data={'track': ','.join(sorted(router.terms))},
+                                 stream=True, timeout=90)
+        response.raise_for_status()
+        for line in response.iter_lines():
+            self.heartbeat()
+            if stop.is_set():
+                break
+            if line:
+                router.on_data(line.decode('utf-8'))
+        response.close()
+
+    def _twitter_stream(self, router, stop):
+        from tweepy import Stream
+        from tweepy.streaming import StreamListener
+
+        collector = self
+
+        class Listener(StreamListener):
+            def keep_alive(self):
+                collector.heartbeat()
+
+            def on_data(self, raw):
+                collector.heartbeat()
+                if stop.is_set():
+                    return False
+                return router.on_data(raw)
+
+            def on_error(self, status):
+                print('collector %s stream error %s'
+                      % (collector.collector_id, status))
+                #420: we are being rate limited, tweepy backs off
+                return True
+
+        stream = Stream(twitter_auth(self.collector_id), Listener())
+        try:
+            stream.filter(track=sorted(router.terms))
+        finally:
+            stream.disconnect()
+
+    def run(self):
+        self.buffer.start_timer()
+        self.avatars.submit_missing(list(self.mosaics()))
+        try:
+            while not self._stop.is_set():
+                mosaics = self.mosaics()
+                if not mosaics:
+                    #nothing to collect anymore: the supervisor won't
+                    #restart us until there is again
+                    break
+                self.heartbeat()
+                router = StreamRouter(mosaics, self.buffer)
+                stop = threading.Event()
+                stream = threading.Thread(
+                    target=(self._http_stream if self.stream_url
+                            else self._twitter_stream),
+                    args=(router, stop))
+                stream.daemon = True
+                stream.start()
+                while stream.is_alive() and not self._stop.is_set():
+                    stream.join(self.reload_interval)
+                    close_old_connections()
+                    if self.mosaics() != mosaics:
+                        break
+                stop.set()
+                self.buffer.flush()
+                if stream.is_alive():
+                    #quiet streams only notice on the next keep-alive
+                    stream.join(self.reload_interval)
+                elif not self._stop.is_set():
+                    #disconnected: don't hammer the server
+                    time.sleep(5)
+        finally:
+            self.buffer.close()
+            self.avatars.close()
+
+    def stop(self):
+        self._stop.set()
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class CollectorSupervisor(object):
+    """
+    Keeps exactly one healthy collector process per account with
+    active mosaics.
+    """
+
+    def __init__(self, heartbeat_timeout=None, manage_py=None):
+        #twitter sends keep-alives every 30 seconds
+        self.heartbeat_timeout = heartbeat_timeout or getattr(
+            settings, 'TWITTERCOLLECTOR_HEARTBEAT_TIMEOUT', 120)
+        self.manage_py = manage_py or os.path.join(settings.BASE_DIR,
+                                                   'manage.py')
+        self.stream_url = getattr(settings, 'TWITTERCOLLECTOR_STREAM_URL', None)
+        self._processes = {}
+
+    def pid(self, collector_id):
+        try:
+            with open(pid_file(collector_id)) as f:
+                return int(f.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def running(self, collector_id):
+        "True if the account's collector process is there and healthy"
+        pid = self.pid(collector_id)
+        if pid is None or not process_alive(pid):
+            return False
+        process = self._processes.get(collector_id)
+        if process is not None and process.poll() is not None:
+            #our own child that exited (alive to os.kill as a zombie)
+            return False
+        try:
+            last_beat = os.path.getmtime(heartbeat_file(collector_id))
+        except OSError:
+            return False
+        return time.time() - last_beat < self.heartbeat_timeout
+
+    def start(self, collector_id):
+        self.stop(collector_id)
+        command = [sys.executable, self.manage_py, 'run_collector',
+                   str(collector_id)]
+        if self.stream_url:
+            command += ['--stream-url', self.stream_url]
+        env = dict(os.environ)
+        env[CHILD_ENV] = '1'
+        process = subprocess.Popen(command, env=env, close_fds=True)
+        self._processes[collector_id] = process
+        with open(pid_file(collector_id), 'w') as f:
+            f.write(str(process.pid))
+        #give it heartbeat_timeout to connect before the first check
+        with open(heartbeat_file(collector_id), 'w'):
+            pass
+        return process.pid
+
+    def stop(self, collector_id):
+        pid = self.pid(collector_id)
+        if pid is not None and process_alive(pid):
+            os.kill(pid, 15)
+        process = self._processes.pop(collector_id, None)
+        if process is not None:
+            process.wait()
+        for path in (pid_file(collector_id), heartbeat_file(collector_id)):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def check(self):
+        "Start collectors that are missing/unhealthy; returns started ids"
+        started = []
+        for collector_id in active_mosaics():
+            if not self.running(collector_id):
+                self.start(collector_id)
+                started.append(collector_id)
+        return started
+
+    def run(self, interval=30, stop=None):
+        "check() every `interval` seconds, until `stop` (an Event) is set"
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                self.check()
+            except DatabaseError:
+                #e.g. tables not migrated yet
+                pass
+            finally:
+                close_old_connections()
+            stop.wait(interval)
+
+    def stop_all(self):
+        "Stop the collector processes started by this supervisor"
+        for collector_id in list(self._processes):
+            self.stop(collector_id)
+
+    def watch(self, interval=30):
+        "run() from a background thread"
+        thread = threading.Thread(target=self.run, args=(interval,),
+                                  name='collectorsupervisor')
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,178 @@
+"""
+Where tweets come from, parsed once at ingest and indexed.
+
+Each source gets numeric coordinates when the tweet has some (its exact
+coordinates, or the center of its place), their geohash, and a region
+code ('US', or 'US-OR' for a place in a US state).  The geohash is a
+string whose prefixes are nested cells of the globe: the sources inside
+a bounding box are those whose geohash falls within a few prefix
+ranges (see `cover`), which the index on the column answers without
+looking at other rows.
+"""
+import re
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_LENGTH = 9
+
+#"City, ST", as twitter names places in US states
+US_CITY = re.compile(r',\s*([A-Z]{2})$')
+
+
+def geohash(latitude, longitude, length=GEOHASH_LENGTH):
+    """
+    >>> geohash(57.64911, 10.40744, 11)
+    'u4pruydqqvj'
+    """
+    (lat_range, lon_range) = ([-90.0, 90.0], [-180.0, 180.0])
+    (value, bits, even) = ([], 0, True)
+    bit_count = 0
+    while len(value) < length:
+        (interval, x) = (lon_range, longitude) if even else \
+                        (lat_range, latitude)
+        middle = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if x >= middle:
+            bits |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            value.append(BASE32[bits])
+            (bits, bit_count) = (0, 0)
+    return ''.join(value)
+
+
+def cell_size(length):
+    "(latitude, longitude) degrees covered by a geohash of `length`"
+    lon_bits = (5 * length + 1) // 2
+    lat_bits = 5 * length // 2
+    return (180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits)
+
+
+def cover(south, west, north, east, max_cells=32):
+    """
+    Geohash prefixes whose cells cover the bounding box, as long as
+    possible with at most `max_cells` of them
+    >>> cover(45.4, -122.8, 45.6, -122.5)
+    ['c20e', 'c20g', 'c20d', 'c20f']
+    """
+    length = 1
+    for candidate in range(1, GEOHASH_LENGTH + 1):
+        (lat_step, lon_step) = cell_size(candidate)
+        cells = (int((north - south) / lat_step) + 2) * \
+                (int((east - west) / lon_step) + 2)
+        if cells > max_cells:
+            break
+        length = candidate
+    (lat_step, lon_step) = cell_size(length)
+    prefixes = []
+    latitude = north
+    while True:
+        longitude = west
+        while True:
+            prefix = geohash(min(latitude, 90.0), min(longitude, 180.0),
+                             length)
+            if prefix not in prefixes:
+                prefixes.append(prefix)
+            if longitude >= east:
+                break
+            longitude = min(east, longitude + lon_step)
+        if latitude <= south:
+            break
+        latitude = max(south, latitude - lat_step)
+    return prefixes
+
+
+def box_prefixes(south, west, north, east, max_cells=32):
+    "`cover`, for boxes crossing the antimeridian (west > east) too"
+    if west <= east:
+        return cover(south, west, north, east, max_cells)
+    return cover(south, west, north, 180.0, max_cells // 2) + \
+        cover(south, -180.0, north, east, max_cells // 2)
+
+
+def parse_box(value):
+    """
+    (south, west, north, east) of "south,west,north,east"
+    >>> parse_box('45.4, -122.8, 45.6, -122.5')
+    (45.4, -122.8, 45.6, -122.5)
+    """
+    box = tuple(float(v) for v in value.split(','))
+    if len(box) != 4:
+        raise ValueError('bounding box should be south,west,north,east')
+    (south, west, north, east) = box
+    if not (-90 <= south <= north <= 90
+            and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError('invalid bounding box %s' % value)
+    return box
+
+
+def prefix_range(prefix):
+    "(low, high): the geohashes starting with `prefix` are low <= g < high"
+    #'{' sorts right after 'z', the last geohash character
+    return (prefix, prefix + '{')
+
+
+def place_center(place):
+    "(latitude, longitude) of the center of a twitter place, or None"
+    box = ((place or {}).get('bounding_box') or {}).get('coordinates')
+    if not box or not box[0]:
+        return None
+    points = box[0]
+    return (sum(p[1] for p in points) / float(len(points)),
+            sum(p[0] for p in points) / float(len(points)))
+
+
+def region_code(place):
+    """
+    >>> region_code({'country_code': 'US', 'full_name': 'Portland, OR'})
+    'US-OR'
+    >>> region_code({'country_code': 'CH', 'full_name': 'Bern, Schweiz'})
+    'CH'
+    """
+    country = ((place or {}).get('country_code') or '').upper()
+    if country == 'US':
+        state = US_CITY.search(place.get('full_name') or '')
+        if state:
+            return 'US-%s' % state.group(1)
+    return country
+
+
+def parse_tweet(data):
+    """
+    (latitude, longitude, region) of a tweet's json; coordinates are
+    None when the tweet isn't located
+    """
+    place = data.get('place')
+    location = None
+    coordinates = (data.get('coordinates') or {}).get('coordinates')
+    if coordinates:
+        #GeoJSON order
+        location = (coordinates[1], coordinates[0])
+    else:
+        location = place_center(place)
+    (latitude, longitude) = location or (None, None)
+    return (latitude, longitude, region_code(place))
+
+
+def parse_stored(value):
+    """
+    (latitude, longitude) of TweetMosaicSource.geo as stored before it
+    was parsed at ingest ("longitude,latitude" for located tweets, the
+    user's free-form location otherwise), or None
+    >>> parse_stored('7.44,46.95')
+    (46.95, 7.44)
+    >>> parse_stored('Bern, Switzerland')
+    """
+    parts = (value or '').split(',')
+    if len(parts) != 2:
+        return None
+    try:
+        (longitude, latitude) = (float(parts[0]), float(parts[1]))
+    except ValueError:
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return (latitude, longitude)
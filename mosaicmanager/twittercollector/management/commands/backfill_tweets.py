@@ -0,0 +1,56 @@
+import threading
+
+import tweepy
+from django.core.management.base import BaseCommand
+
+from twittercollector.backfill import Backfill, TokenBucket
+from twittercollector.collector import twitter_auth
+from twittercollector.models import TwitterMosaic
+
+
+class Command(BaseCommand):
+    help = ("Collect past tweets of active mosaics from the search api, "
+            "resuming from their last checkpoint")
+
+    def add_arguments(self, parser):
+        parser.add_argument('mosaic_ids', nargs='*', type=int,
+                            help="defaults to all active mosaics")
+        parser.add_argument('--until-minimum', action='store_true',
+                            help="stop once minimum_image_count is reached")
+        parser.add_argument('--download-workers', type=int, default=8)
+
+    def backfill(self, mosaics, options):
+        #mosaics of the same account share its quota, one after the other
+        collector_id = mosaics[0].collector_id
+        api = tweepy.API(twitter_auth(collector_id))
+        bucket = TokenBucket()
+        for mosaic in mosaics:
+            limit = None
+            if options['until_minimum']:
+                limit = mosaic.minimum_image_count \
+                    - mosaic.source_images.count()
+                if limit <= 0:
+                    continue
+            added = Backfill(mosaic, api, bucket, limit=limit,
+                             download_workers=options['download_workers'])\
+                .run()
+            self.stdout.write('%s: %d new sources' % (mosaic.slug, added))
+
+    def handle(self, *args, **options):
+        mosaics = TwitterMosaic.objects.filter(collector__isnull=False)\
+                                       .exclude(twitter_search='')
+        if options['mosaic_ids']:
+            mosaics = mosaics.filter(pk__in=options['mosaic_ids'])
+        else:
+            mosaics = mosaics.filter(status=1)
+        by_collector = {}
+        for mosaic in mosaics.order_by('created_at'):
+            by_collector.setdefault(mosaic.collector_id, []).append(mosaic)
+        #accounts have separate quotas: backfill them concurrently
+        threads = [threading.Thread(target=self.backfill,
+                                    args=(group, options))
+                   for group in by_collector.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,29 @@
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+
+from twittercollector.collector import StreamCollector, pid_file
+
+
+class Command(BaseCommand):
+    help = ("Stream tweets for all active mosaics of a collector account "
+            "(usually started by TwitterMosaic.start_collectors)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('collector_id', type=int,
+                            help="id of the collector's UserSocialAuth")
+        parser.add_argument('--stream-url', default=None,
+                            help=("read line-delimited tweets from this url "
+                                  "instead of twitter (e.g. a fake stream)"))
+        parser.add_argument('--reload-interval', type=int, default=60,
+                            help="seconds between checks for mosaic changes")
+
+    def handle(self, *args, **options):
+        collector = StreamCollector(options['collector_id'],
+                                    stream_url=options['stream_url'],
+                                    reload_interval=options['reload_interval'])
+        with open(pid_file(collector.collector_id), 'w') as f:
+            f.write(str(os.getpid()))
+        signal.signal(signal.SIGTERM, lambda *args: collector.stop())
+        collector.run()
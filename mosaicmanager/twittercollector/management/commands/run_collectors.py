@@ -0,0 +1,26 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from twittercollector.collector import CollectorSupervisor
+
+
+class Command(BaseCommand):
+    help = ("Keep a collector process running for each account with active "
+            "mosaics, restarting the ones that exit or stop receiving data")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=30,
+                            help="seconds between checks of the processes")
+
+    def handle(self, *args, **options):
+        supervisor = CollectorSupervisor()
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop.set())
+        try:
+            supervisor.run(options['interval'], stop)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            supervisor.stop_all()
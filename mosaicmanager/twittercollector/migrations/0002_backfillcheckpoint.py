@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twittercollector', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackfillCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('since_id', models.BigIntegerField(blank=True, null=True)),
+                ('max_id', models.BigIntegerField(blank=True, null=True)),
+                ('newest_id', models.BigIntegerField(blank=True, null=True)),
+                ('completed', models.BooleanField(default=False)),
+                ('tweet_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('mosaic', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='backfill', to='twittercollector.TwitterMosaic')),
+            ],
+        ),
+    ]
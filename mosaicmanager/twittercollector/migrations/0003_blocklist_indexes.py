@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def lowercase_usernames(apps, schema_editor):
+    for name in ('TweeterBlocklist', 'TweetMosaicSource'):
+        model = apps.get_model('twittercollector', name)
+        for (pk, username) in model.objects.values_list('pk', 'username'):
+            if username != username.lstrip('@').lower():
+                model.objects.filter(pk=pk).update(
+                    username=username.lstrip('@').lower())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twittercollector', '0002_backfillcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tweeterblocklist',
+            name='username',
+            field=models.CharField(db_index=True, max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='tweetmosaicsource',
+            name='username',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+        migrations.RunPython(lowercase_usernames, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from twittercollector import geo
+
+
+def parse_geo(apps, schema_editor):
+    #regions need the tweet's place, which wasn't kept: only coordinates
+    model = apps.get_model('twittercollector', 'TweetMosaicSource')
+    for (pk, value) in model.objects.values_list('pk', 'geo').iterator():
+        location = geo.parse_stored(value)
+        if location is not None:
+            model.objects.filter(pk=pk).update(
+                latitude=location[0], longitude=location[1],
+                geohash=geo.geohash(*location))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twittercollector', '0003_blocklist_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweetmosaicsource',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tweetmosaicsource',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tweetmosaicsource',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='tweetmosaicsource',
+            name='region',
+            field=models.CharField(blank=True, db_index=True, help_text='country code, or US-<state>', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='twittermosaic',
+            name='region',
+            field=models.CharField(blank=True, help_text='only use tweets from this country (e.g. CH), or US state (e.g. US-OR)', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='twittermosaic',
+            name='bounding_box',
+            field=models.CharField(blank=True, help_text='only use located tweets within south,west,north,east (degrees)', max_length=128),
+        ),
+        migrations.RunPython(parse_geo, migrations.RunPython.noop),
+    ]
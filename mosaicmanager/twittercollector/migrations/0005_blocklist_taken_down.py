@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twittercollector', '0004_geo_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweeterblocklist',
+            name='taken_down',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,9 +1,16 @@
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.contrib.contenttypes.models import ContentType
 
 from social.apps.django_app.default.models import UserSocialAuth
 
-from mosaicrenderer.models import Mosaic, MosaicSourceImage
+from mosaicrenderer.models import (Mosaic, MosaicRender, MosaicSourceImage,
+                                   scheduler_check)
+
+from . import geo
 
 class TweeterBlocklist(models.Model):
     """
@@ -13,7 +20,24 @@ class TweeterBlocklist(models.Model):
     It should block them from all future renders
     """
     #this is the current maximum size twitter allows
-    username = models.CharField(max_length=15)
+    username = models.CharField(max_length=15, db_index=True)
+    #whether their tiles were repainted yet (see takedown.py)
+    taken_down = models.BooleanField(default=False, editable=False)
+
+    def save(self, *args, **kw):
+        #usernames are case-insensitive, and stored lowercased
+        self.username = self.username.lstrip('@').lower()
+        #(again, if the username was changed)
+        self.taken_down = False
+        super(TweeterBlocklist, self).save(*args, **kw)
+
+    @classmethod
+    def blocked_usernames(cls):
+        """
+        frozenset of blocked usernames, read from the database: the list
+        can change in any process (admin, takedown command...)
+        """
+        return frozenset(cls.objects.values_list('username', flat=True))
 
 
 class TweetMosaicSource(MosaicSourceImage):
@@ -23,11 +47,41 @@ class TweetMosaicSource(MosaicSourceImage):
     message = models.TextField(default="",
                                help_text="maybe not always the full message/post")
     
-    username = models.CharField(max_length=128)
+    #lowercased, like TweeterBlocklist.username
+    username = models.CharField(max_length=128, db_index=True)
 
     image_url = models.URLField(blank=True, help_text="url to IMAGE")
     geo = models.CharField(max_length=128)
 
+    #parsed from the tweet when collected (see geo.py), for region queries
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    geohash = models.CharField(max_length=12, blank=True, db_index=True)
+    region = models.CharField(max_length=8, blank=True, db_index=True,
+                              help_text="country code, or US-<state>")
+
+    @classmethod
+    def from_tweet(cls, data):
+        "Unsaved source from a tweet's json (as a dict)"
+        user = data.get('user') or {}
+        coordinates = (data.get('coordinates') or {}).get('coordinates')
+        if coordinates:
+            location = '%s,%s' % tuple(coordinates)
+        else:
+            location = user.get('location') or ''
+        (latitude, longitude, region) = geo.parse_tweet(data)
+        return cls(tweet_id=data.get('id_str', ''),
+                   user_id=user.get('id_str') or str(user.get('id', '')),
+                   username=user.get('screen_name', '').lower(),
+                   message=data.get('text', ''),
+                   image_url=user.get('profile_image_url_https')
+                             or user.get('profile_image_url') or '',
+                   geo=location[:128],
+                   latitude=latitude, longitude=longitude,
+                   geohash=geo.geohash(latitude, longitude)
+                           if latitude is not None else '',
+                   region=region[:8])
+
     
 class TwitterMosaic(Mosaic):
 
@@ -43,21 +97,119 @@ class TwitterMosaic(Mosaic):
         )
     )
 
+    region = models.CharField(
+        max_length=8, blank=True,
+        help_text="only use tweets from this country (e.g. CH), or US "
+        "state (e.g. US-OR)")
+    bounding_box = models.CharField(
+        max_length=128, blank=True,
+        help_text="only use located tweets within south,west,north,east "
+        "(degrees)")
+
+    def clean(self):
+        super(TwitterMosaic, self).clean()
+        if self.bounding_box:
+            try:
+                geo.parse_box(self.bounding_box)
+            except ValueError as e:
+                raise ValidationError({'bounding_box': str(e)})
+
+    def render_source_images(self):
+        "Sources of the mosaic within its region and bounding box, if any"
+        sources = super(TwitterMosaic, self).render_source_images()
+        if self.region:
+            #the country's states too
+            sources = sources.filter(
+                Q(tweetmosaicsource__region=self.region) |
+                Q(tweetmosaicsource__region__gt=self.region + '-',
+                  tweetmosaicsource__region__lt=self.region + '.'))
+        if self.bounding_box:
+            (south, west, north, east) = geo.parse_box(self.bounding_box)
+            #whole geohash cells, through the index, then the exact box
+            cells = Q()
+            for prefix in geo.box_prefixes(south, west, north, east):
+                (low, high) = geo.prefix_range(prefix)
+                cells |= Q(tweetmosaicsource__geohash__gte=low,
+                           tweetmosaicsource__geohash__lt=high)
+            sources = sources.filter(
+                cells, tweetmosaicsource__latitude__range=(south, north))
+            if west <= east:
+                sources = sources.filter(
+                    tweetmosaicsource__longitude__range=(west, east))
+            else:
+                sources = sources.filter(
+                    Q(tweetmosaicsource__longitude__gte=west) |
+                    Q(tweetmosaicsource__longitude__lte=east))
+        return sources
+
+    def excluded_source_ids(self):
+        """
+        Ids of this mosaic's sources showing the pictures of blocked
+        users, whoever sent them
+        """
+        #subqueries: the blocklist as it is when the render starts
+        blocked = TweetMosaicSource.objects.filter(
+            username__in=TweeterBlocklist.objects.values('username'))
+        return set(self.source_images.filter(
+            MosaicSourceImage.same_pictures(blocked))
+            .values_list('pk', flat=True))
+
     @classmethod
     def start_collectors(cls):
-        #start all collectors for active mosaics that are not running
-        pass
-    
+        """
+        Start all collectors for active mosaics that are not running
+        (or not healthy).  Mosaics sharing a collector account share
+        its process and stream.
+        """
+        from .collector import CollectorSupervisor
+        return CollectorSupervisor().check()
+
     def start_collector(self):
         """
-        Starts a collector process
+        Starts (or restarts) the collector process of this mosaic's
+        account, which also collects for its other active mosaics
         """
-        #inputs: collector token+secret + ?twitter creds + module_for_processing data
-        #plus run with creating a /tmp/pid
-        subprocess.Popen(['../foo.py'])
-        pass
+        from .collector import CollectorSupervisor
+        if self.collector_id is not None:
+            return CollectorSupervisor().start(self.collector_id)
 
     def collector_running(self):
-        "True if not running, False, if not"
-        return 0
+        "True if running (and healthy), False, if not"
+        from .collector import CollectorSupervisor
+        return (self.collector_id is not None
+                and CollectorSupervisor().running(self.collector_id))
     
+
+
+class BackfillCheckpoint(models.Model):
+    """
+    How far the historical search of a mosaic got, so that a backfill
+    continues where it stopped.  Tweet ids only go up with time:
+
+    max_id: the next search page is for tweets older than this
+    newest_id: the newest tweet seen by the current backfill
+    since_id: where the previous completed backfill started, i.e.
+              older tweets have been collected already
+    """
+    mosaic = models.OneToOneField(TwitterMosaic, related_name='backfill')
+    since_id = models.BigIntegerField(null=True, blank=True)
+    max_id = models.BigIntegerField(null=True, blank=True)
+    newest_id = models.BigIntegerField(null=True, blank=True)
+    completed = models.BooleanField(default=False)
+    tweet_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+@receiver(scheduler_check)
+def take_down_blocked(sender, **kwargs):
+    from .takedown import take_down_pending
+    take_down_pending()
+
+
+@receiver(post_save, sender=MosaicRender)
+def index_render(sender, instance, **kwargs):
+    #the "find yourself" index is built with the render, not by the
+    #first viewer searching
+    from mosaicrenderer.payloads import prebuild
+    from . import views  # registers the builder
+    transaction.on_commit(lambda: prebuild('people', instance))
@@ -0,0 +1,55 @@
+"""
+Taking a blocked user out of existing renders.
+
+Their SourcePositions are found through the indexes on
+TweetMosaicSource.username and SourcePosition.source_image, and only
+those tiles are repainted with the next best match -- no render needed.
+The tiles showing the same pictures, sent again by other users, are
+repainted too (see MosaicSourceImage.same_pictures).
+
+Blocklist entries are taken down by the render scheduler, at its next
+check (run_render_scheduler): an entry stays pending until its tiles
+are repainted, so a takedown interrupted by a restart is done again.
+"""
+from django.db import connection, transaction
+
+from mosaicrenderer.models import MosaicSourceImage, SourcePosition
+from mosaicrenderer.render import repaint_positions
+
+from .models import TweeterBlocklist, TweetMosaicSource
+
+
+def takedown(username):
+    "Repaint every tile showing the pictures of `username`; returns how many"
+    username = username.lstrip('@').lower()
+    sources = MosaicSourceImage.objects.filter(
+        MosaicSourceImage.same_pictures(
+            TweetMosaicSource.objects.filter(username=username)))
+    by_render = {}
+    for position in SourcePosition.objects.filter(
+            source_image__in=sources.values('pk')).select_related('render'):
+        by_render.setdefault(position.render, []).append(position)
+    for (render, positions) in by_render.items():
+        repaint_positions(render, positions)
+    return sum(len(positions) for positions in by_render.values())
+
+
+def take_down_pending():
+    """
+    Take down the blocklist entries not taken down yet; returns how many
+    tiles were repainted
+    """
+    repainted = 0
+    for pk in TweeterBlocklist.objects.filter(taken_down=False)\
+                                      .values_list('pk', flat=True):
+        with transaction.atomic():
+            #another scheduler may be on it
+            entry = TweeterBlocklist.objects.select_for_update(
+                skip_locked=connection.features
+                .has_select_for_update_skip_locked).filter(
+                    pk=pk, taken_down=False).first()
+            if entry is None:
+                continue
+            repainted += takedown(entry.username)
+            TweeterBlocklist.objects.filter(pk=pk).update(taken_down=True)
+    return repainted
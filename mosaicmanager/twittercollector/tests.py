@@ -1,3 +1,482 @@
-from django.test import TestCase
+import doctest
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from PIL import Image
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from social.apps.django_app.default.models import UserSocialAuth
+
+from mosaicrenderer import payloads
+from mosaicrenderer.models import scheduler_check
+from mosaicrenderer.render import render_mosaic
+
+from replay import Avatars, ReplayServer, TweetSource
+
+from . import geo
+from .backfill import TokenBucket
+from .buffer import SourceBuffer
+from .collector import (CollectorSupervisor, StreamCollector, StreamRouter,
+                        heartbeat_file, pid_file)
+from .models import TweeterBlocklist, TweetMosaicSource, TwitterMosaic
+from .takedown import take_down_pending, takedown
+
+
+def make_mosaic(collector, twitter_search, status=1, **fields):
+    return TwitterMosaic.objects.create(
+        slug=twitter_search.strip('#'), status=status, collector=collector,
+        twitter_search=twitter_search, minimum_image_count=1,
+        incremental_update_count=1, **fields)
+
+
+class ListBuffer(object):
+    "Stands in for SourceBuffer: keeps what is added"
+
+    def __init__(self, on_add=None):
+        self.added = []
+        self.on_add = on_add
+
+    def add(self, source, mosaic_ids=()):
+        self.added.append((source, mosaic_ids))
+        if self.on_add:
+            self.on_add(self)
+
+    def start_timer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def tweet(text, username='someone'):
+    return '{"id_str": "1", "text": "%s", "user": {"id": 2, ' \
+           '"screen_name": "%s"}}' % (text, username)
+
+
+class StreamRouterTest(TestCase):
+
+    def test_routes_by_phrase(self):
+        buffer = ListBuffer()
+        router = StreamRouter({1: '#cats, big dogs', 2: 'dogs'}, buffer)
+        router.on_data(tweet('Big #cats'))
+        router.on_data(tweet('dogs are big'))
+        router.on_data(tweet('birds'))
+        router.on_data('{"delete": {}}')
+        self.assertEqual([ids for (source, ids) in buffer.added],
+                         [[1], [1, 2]])
+        self.assertEqual((router.received, router.routed), (3, 2))
+
+    def test_blocked_users(self):
+        TweeterBlocklist.objects.create(username='@Troll')
+        buffer = ListBuffer()
+        router = StreamRouter({1: 'cats'}, buffer)
+        router.on_data(tweet('cats', username='troll'))
+        router.on_data(tweet('cats', username='someone'))
+        self.assertEqual([source.username for (source, ids) in buffer.added],
+                         ['someone'])
+
+
+@override_settings(TWITTERCOLLECTOR_RUN_DIR='/tmp/twittercollector-tests')
+class SourceBufferTest(TestCase):
+
+    def setUp(self):
+        self.mosaic = make_mosaic(None, '#cats')
+        self.flushed = []
+
+    def buffer(self, **kwargs):
+        return SourceBuffer(on_flush=self.flushed.append, **kwargs)
+
+    def add(self, buffer, count):
+        for i in range(count):
+            buffer.add(TweetMosaicSource(tweet_id=str(i),
+                                         username='user%d' % i),
+                       [self.mosaic.pk])
+
+    def test_flush_on_size(self):
+        buffer = self.buffer(max_size=3, max_wait=60)
+        self.add(buffer, 2)
+        self.assertEqual((len(buffer), TweetMosaicSource.objects.count()),
+                         (2, 0))
+        self.add(buffer, 1)
+        self.assertEqual((len(buffer), TweetMosaicSource.objects.count()),
+                         (0, 3))
+        self.assertEqual([len(batch) for batch in self.flushed], [3])
+        self.assertEqual(self.mosaic.source_images.count(), 3)
+        self.mosaic.refresh_from_db()
+        self.assertEqual(self.mosaic.source_count, 3)
+
+    def test_flush_on_age(self):
+        buffer = self.buffer(max_size=100, max_wait=0.05)
+        self.add(buffer, 1)
+        self.assertFalse(buffer.due())
+        time.sleep(0.1)
+        self.assertTrue(buffer.due())
+        #the next tweet takes the late one along
+        self.add(buffer, 1)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual([len(batch) for batch in self.flushed], [2])
+        self.assertFalse(buffer.due())
+
+    def test_bulk_inserts(self):
+        counts = []
+        for count in (5, 80):
+            buffer = self.buffer(max_size=count)
+            with CaptureQueriesContext(connection) as queries:
+                self.add(buffer, count)
+            counts.append(len(queries))
+        #as many queries for 80 sources as for 5 (SQLite takes up to 999
+        #values per insert)
+        self.assertEqual(counts[0], counts[1])
+        saved = [source for (source, ids) in self.flushed[1]]
+        self.assertEqual(
+            dict(TweetMosaicSource.objects.filter(
+                pk__in=[source.pk for source in saved])
+                .values_list('pk', 'username')),
+            dict((source.pk, source.username) for source in saved))
+        self.assertEqual(self.mosaic.source_images.count(), 85)
+
+
+class StreamCollectorTest(TransactionTestCase):
+    "A collector process streaming from replay.py instead of twitter"
+
+    def setUp(self):
+        user = User.objects.create(username='collector')
+        self.collector = UserSocialAuth.objects.create(
+            user=user, provider='twitter', uid='1', extra_data={})
+        self.server = ReplayServer(('127.0.0.1', 0),
+                                   TweetSource(users=10),
+                                   Avatars(colors=1), rate=200)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.stopping = True
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_collects_active_mosaics(self):
+        mosaic = make_mosaic(self.collector, '#cats')
+        make_mosaic(self.collector, '#dogs', status=0)
+        collector = StreamCollector(
+            self.collector.pk,
+            stream_url='http://127.0.0.1:%d/1.1/statuses/filter.json'
+                       % self.server.server_address[1],
+            reload_interval=1,
+            buffer=ListBuffer(on_add=lambda buffer: len(buffer.added) >= 5
+                              and collector.stop()))
+        runner = threading.Thread(target=collector.run)
+        runner.start()
+        runner.join(30)
+        self.assertFalse(runner.is_alive())
+        added = collector.buffer.added
+        self.assertGreaterEqual(len(added), 5)
+        self.assertEqual(set(tuple(ids) for (source, ids) in added),
+                         set([(mosaic.pk,)]))
+        self.assertTrue(all(source.message.startswith('#cats ')
+                            for (source, ids) in added))
+        self.assertTrue(os.path.exists(heartbeat_file(self.collector.pk)))
+
+
+class BlocklistTest(TestCase):
+
+    def test_excluded_at_render_time(self):
+        mosaic = make_mosaic(None, '#cats')
+        sources = [TweetMosaicSource.from_tweet(json.loads(
+            tweet('#cats', username=username)))
+            for username in ('troll', 'someone')]
+        for source in sources:
+            source.save()
+        mosaic.source_images.add(*sources)
+        self.assertEqual(mosaic.excluded_source_ids(), set())
+        #blocked by another process: no signal was sent in this one
+        TweeterBlocklist.objects.bulk_create(
+            [TweeterBlocklist(username='troll')])
+        self.assertEqual(mosaic.excluded_source_ids(), set([sources[0].pk]))
+        self.assertEqual(TweeterBlocklist.blocked_usernames(),
+                         frozenset(['troll']))
+
+    def test_same_pictures_excluded(self):
+        mosaic = make_mosaic(None, '#cats')
+        (troll, again, copy, other) = [
+            TweetMosaicSource(username=username, image_hash=image_hash)
+            for (username, image_hash) in (('troll', 'aa'), ('someone', None),
+                                           ('else', 'aa'), ('other', 'bb'))]
+        troll.save()
+        #a duplicate of the troll's picture, and the same picture unlinked
+        again.canonical = troll
+        for source in (again, copy, other):
+            source.save()
+        mosaic.source_images.add(troll, again, copy, other)
+        TweeterBlocklist.objects.create(username='troll')
+        self.assertEqual(mosaic.excluded_source_ids(),
+                         set([troll.pk, again.pk, copy.pk]))
+
+
+def located(username, latitude=None, longitude=None, place=None):
+    "Saved source of a tweet with coordinates or a place"
+    data = {'id_str': username, 'text': '#cats',
+            'user': {'id_str': username, 'screen_name': username}}
+    if latitude is not None:
+        data['coordinates'] = {'coordinates': [longitude, latitude]}
+    if place is not None:
+        (country, full_name) = place
+        data['place'] = {'country_code': country, 'full_name': full_name}
+    source = TweetMosaicSource.from_tweet(data)
+    source.save()
+    return source
+
+
+class GeoTest(TestCase):
+
+    def test_doctests(self):
+        self.assertEqual(doctest.testmod(geo).failed, 0)
+
+    def test_cover(self):
+        rng = random.Random(0)
+        for box in ((45.4, -122.8, 45.6, -122.5), (-40.0, -10.0, 60.0, 30.0),
+                    (46.94, 7.43, 46.96, 7.45), (-20.0, 170.0, -10.0, -170.0)):
+            (south, west, north, east) = box
+            prefixes = geo.box_prefixes(*box)
+            self.assertLessEqual(len(prefixes), 32)
+            width = (east - west) % 360
+            for i in range(200):
+                (latitude, longitude) = (rng.uniform(south, north),
+                                         rng.uniform(west, west + width))
+                if longitude > 180:
+                    longitude -= 360
+                hashed = geo.geohash(latitude, longitude)
+                self.assertTrue(any(hashed.startswith(prefix)
+                                    for prefix in prefixes), (box, hashed))
+
+    def test_filters(self):
+        mosaic = make_mosaic(None, '#cats')
+        mosaic.source_images.add(
+            located('portland', 45.52, -122.68, ('US', 'Portland, OR')),
+            located('seattle', 47.61, -122.33, ('US', 'Seattle, WA')),
+            located('bern', 46.95, 7.44, ('CH', 'Bern, Schweiz')),
+            #in the US, without coordinates
+            located('somewhere', place=('US', 'United States')),
+            located('fiji', -17.8, 178.0), located('samoa', -13.8, -171.8))
+
+        def usernames(region='', bounding_box=''):
+            (mosaic.region, mosaic.bounding_box) = (region, bounding_box)
+            return sorted(mosaic.render_source_images().values_list(
+                'tweetmosaicsource__username', flat=True))
+
+        self.assertEqual(len(usernames()), 6)
+        #a country includes its states
+        self.assertEqual(usernames('US'), ['portland', 'seattle', 'somewhere'])
+        self.assertEqual(usernames('US-OR'), ['portland'])
+        self.assertEqual(usernames(bounding_box='45.4,-122.8,45.6,-122.5'),
+                         ['portland'])
+        self.assertEqual(usernames(bounding_box='40,-125,50,10'),
+                         ['bern', 'portland', 'seattle'])
+        #across the antimeridian
+        self.assertEqual(usernames(bounding_box='-20,170,-10,-170'),
+                         ['fiji', 'samoa'])
+        self.assertEqual(usernames('CH', '45.4,-122.8,45.6,-122.5'), [])
+
+        mosaic.bounding_box = '45.6,-122.8,45.4,-122.5'
+        self.assertRaises(ValidationError, mosaic.clean)
+
+
+def png(color, size=(32, 32)):
+    output = io.BytesIO()
+    Image.new('RGB', size, color).save(output, 'PNG')
+    return ContentFile(output.getvalue())
+
+
+class RenderAttributionTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def source(self, username, color, canonical=None):
+        source = TweetMosaicSource(tweet_id=username, user_id=username,
+                                   username=username, geo='',
+                                   average_color='%d,%d,%d' % color,
+                                   canonical=canonical)
+        if canonical is None:
+            source.image.save('%s.png' % username, png(color), save=False)
+        source.save()
+        return source
+
+    def credited(self, render):
+        usernames = dict(TweetMosaicSource.objects.values_list('pk',
+                                                               'username'))
+        return [usernames[pk] for pk in render.sourceposition_set
+                .values_list('source_image_id', flat=True)]
+
+    def test_duplicates_keep_their_tweet(self):
+        mosaic = make_mosaic(None, '#cats')
+        mosaic.target_image.save('target.png', png((255, 0, 0), (64, 64)))
+        first = self.source('first', (255, 0, 0))
+        mosaic.source_images.add(
+            first, self.source('again', (255, 0, 0), canonical=first),
+            self.source('blue', (0, 0, 255)))
+        render = render_mosaic(mosaic, tiles=4)
+        credited = self.credited(render)
+        #the red picture is credited to both tweets that sent it
+        self.assertEqual(len(credited), 16)
+        self.assertTrue(set(['first', 'again']) <= set(credited))
+        self.assertLessEqual(abs(credited.count('first')
+                                 - credited.count('again')), 1)
+
+        TweeterBlocklist.objects.bulk_create(
+            [TweeterBlocklist(username='again')])
+        #their picture goes, whoever else sent it too
+        self.assertEqual(takedown('again'), 16 - credited.count('blue'))
+        self.assertEqual(self.credited(render), ['blue'] * 16)
+
+    def test_pending_takedowns(self):
+        mosaic = make_mosaic(None, '#cats')
+        mosaic.target_image.save('target.png', png((255, 0, 0), (64, 64)))
+        mosaic.source_images.add(self.source('troll', (255, 0, 0)),
+                                 self.source('blue', (0, 0, 255)))
+        render = render_mosaic(mosaic, tiles=4)
+        TweeterBlocklist.objects.create(username='@Troll')
+        self.assertIn('troll', self.credited(render))
+        #the render scheduler takes it down at its next check
+        scheduler_check.send(sender=None)
+        self.assertEqual(self.credited(render), ['blue'] * 16)
+        self.assertEqual(TweeterBlocklist.objects.get().taken_down, True)
+        self.assertEqual(take_down_pending(), 0)
+
+
+class PeopleIndexTest(TransactionTestCase):
+    "on_commit callbacks only run outside of TestCase's transaction"
+
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_built_with_the_render(self):
+        mosaic = make_mosaic(None, '#cats')
+        mosaic.target_image.save('target.png', png((255, 0, 0), (64, 64)))
+        for (username, color) in (('Alice', (255, 0, 0)),
+                                  ('bob', (0, 0, 255))):
+            source = TweetMosaicSource(tweet_id=username, user_id=username,
+                                       username=username.lower(), geo='')
+            source.image.save('%s.png' % username, png(color))
+            mosaic.source_images.add(source)
+        render = render_mosaic(mosaic, tiles=4)
+
+        #cached by the signal, before anyone asked for it
+        cached = cache.get(payloads.PAYLOAD_KEY % (
+            'people', payloads.version(render)['version']))
+        self.assertIsNotNone(cached)
+        index = json.loads(cached[0].decode('utf-8'))
+        self.assertEqual(index['names'], [['alice', 'Alice'], ['bob', 'bob']])
+        self.assertEqual(sorted(index['users']['Alice']
+                                + index['users']['bob']),
+                         [[x, y] for x in range(4) for y in range(4)])
+
+        response = self.client.get('/data/cats/find.json', {'q': '@AL'})
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {
+            'id': render.pk,
+            'users': [{'username': 'alice', 'user_id': 'Alice',
+                       'tiles': index['users']['Alice']}]})
+
+
+class TokenBucketTest(TestCase):
+
+    def timed_take(self, bucket):
+        started = time.time()
+        bucket.take()
+        return time.time() - started
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=20, capacity=3)
+        for i in range(3):
+            self.assertLess(self.timed_take(bucket), 0.02)
+        #empty: the next token comes in 1 / rate seconds
+        self.assertGreater(self.timed_take(bucket), 0.03)
+
+    def test_refill_is_capped(self):
+        bucket = TokenBucket(rate=1000, capacity=2)
+        time.sleep(0.05)
+        bucket._refill(time.time())
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_sync(self):
+        bucket = TokenBucket(rate=1000, capacity=10)
+        bucket.sync(remaining=1, reset=time.time() + 60)
+        self.assertLessEqual(bucket.tokens, 1.01)
+        #none left: wait for the server's reset, whatever the rate
+        bucket.sync(remaining=0, reset=time.time() + 0.2)
+        self.assertGreater(self.timed_take(bucket), 0.15)
+
+    def test_pause_until(self):
+        bucket = TokenBucket(rate=1000, capacity=10)
+        bucket.pause_until(time.time() + 0.2)
+        self.assertGreater(self.timed_take(bucket), 0.15)
+
+    def test_threads_share_the_rate(self):
+        bucket = TokenBucket(rate=100, capacity=1)
+        bucket.take()
+        started = time.time()
+        threads = [threading.Thread(target=bucket.take) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreater(time.time() - started, 0.08)
+
+
+@override_settings(TWITTERCOLLECTOR_RUN_DIR='/tmp/twittercollector-tests',
+                   TWITTERCOLLECTOR_HEARTBEAT_TIMEOUT=60)
+class CollectorSupervisorTest(TestCase):
+
+    def setUp(self):
+        for path in (pid_file(1), heartbeat_file(1)):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_running(self):
+        supervisor = CollectorSupervisor()
+        self.assertFalse(supervisor.running(1))
+        with open(pid_file(1), 'w') as f:
+            f.write(str(os.getpid()))
+        self.assertFalse(supervisor.running(1))
+        with open(heartbeat_file(1), 'w'):
+            pass
+        self.assertTrue(supervisor.running(1))
+        #stuck: alive, but no data for longer than the heartbeat timeout
+        stale = time.time() - 120
+        os.utime(heartbeat_file(1), (stale, stale))
+        self.assertFalse(supervisor.running(1))
+
+    def test_run_stops(self):
+        stop = threading.Event()
+        stop.set()
+        #no active mosaics: nothing to start
+        CollectorSupervisor().run(0, stop)
+        self.assertFalse(os.path.exists(pid_file(1)))
@@ -0,0 +1,12 @@
+from django.conf.urls import url
+
+from . import views
+
+urlpatterns = [
+    url(r'^(?P<slug>[\w-]+)/tweets\.json$', views.tweets_json,
+        name='mosaic-tweets'),
+    url(r'^(?P<slug>[\w-]+)/people\.json$', views.people_json,
+        name='mosaic-people'),
+    url(r'^(?P<slug>[\w-]+)/find\.json$', views.find_json,
+        name='mosaic-find'),
+]
@@ -1,3 +1,85 @@
-from django.shortcuts import render
+"""
+Who is on each tile of the latest render of a mosaic: its tweet and
+user, for viewers to link tiles to twitter, and to find themselves in
+the mosaic (see mosaicrenderer.payloads).
+"""
+import bisect
 
-# Create your views here.
+from django.http import Http404, JsonResponse
+
+from mosaicrenderer.payloads import payload_data, register, serve
+
+from .models import TweetMosaicSource
+
+#most users returned by a search
+FIND_LIMIT = 20
+
+
+def tweet_positions(render):
+    "[(x, y, {user_id, username, tweet_id})] of the tiles showing a tweet"
+    positions = list(render.sourceposition_set.values_list(
+        'x', 'y', 'source_image_id'))
+    tweets = dict((source['pk'], source)
+                  for source in TweetMosaicSource.objects.filter(
+                      pk__in=set(p[2] for p in positions))
+                  .values('pk', 'user_id', 'username', 'tweet_id'))
+    return [(x, y, tweets[pk]) for (x, y, pk) in positions if pk in tweets]
+
+
+@register('tweets')
+def tweets_data(render):
+    "[x, y, user id, username, tweet id] of each tile showing a tweet"
+    return {'id': render.pk,
+            'tiles': [[x, y, t['user_id'], t['username'], t['tweet_id']]
+                      for (x, y, t) in tweet_positions(render)]}
+
+
+@register('people')
+def people_data(render):
+    """
+    Inverted index of the render: the [x, y] tiles of each user id, and
+    [username, user id] sorted by username, for prefix searches
+    """
+    users = {}
+    names = set()
+    for (x, y, tweet) in tweet_positions(render):
+        users.setdefault(tweet['user_id'], []).append([x, y])
+        names.add((tweet['username'], tweet['user_id']))
+    return {'id': render.pk, 'users': users, 'names': sorted(names)}
+
+
+def find_people(index, query, limit=FIND_LIMIT):
+    "Users of `index` whose username starts with `query`, or with that id"
+    query = query.strip().lstrip('@').lower()
+    found = []
+    if query in index['users']:
+        found.append([None, query])
+    names = index['names']
+    #[query] sorts before every [query..., user_id] entry
+    start = bisect.bisect_left(names, [query])
+    for (username, user_id) in names[start:start + limit]:
+        if not username.startswith(query):
+            break
+        if user_id != query:
+            found.append([username, user_id])
+    return [{'username': username, 'user_id': user_id,
+             'tiles': index['users'][user_id]}
+            for (username, user_id) in found[:limit]]
+
+
+def tweets_json(request, slug):
+    return serve(request, 'tweets', slug)
+
+
+def people_json(request, slug):
+    return serve(request, 'people', slug)
+
+
+def find_json(request, slug):
+    "?q=<username prefix or user id>"
+    index = payload_data('people', slug)
+    if index is None:
+        raise Http404('no render of %s yet' % slug)
+    query = request.GET.get('q', '')
+    return JsonResponse({'id': index['id'],
+                         'users': find_people(index, query) if query else []})
@@ -40,12 +40,6 @@ save it to a disk.
 
 TODO:
 
-    - Use a KD-Tree for the internal logic of the ``ImageList`` object.
-
-    - Resize input if too large. Maybe we could implement an adaptive
-      way to compute the target size depending on the number of
-      specified tiles and zoom level.
-
     - In order to reduce the amount of work load, we could quantize
       target and source images.
 
@@ -60,21 +54,28 @@ TODO:
 """
 
 from __future__ import division
+import hashlib
+import io
 import itertools
 import json
 import math
 import multiprocessing
 import operator
+import os
 import random
+import sys
 import time
 from collections import namedtuple
 from optparse import OptionParser
 from optparse import OptionGroup
 from functools import partial
 
-import kdtree
+import numpy
 from PIL import Image
 
+from dedup import HashIndex, dhash
+from tilestore import TileStore
+
 
 def splitter(n, iterable):
     """Split `iterable` into `n` separate buckets.
@@ -125,6 +126,39 @@ def average_color(img):
             total_blue // num_pixels)
 
 
+#Pixels per side of a tile, when computing the tile colors of the target:
+#more would not change the average color much, and cost a lot more
+ANALYSIS_CELL_SIZE = 8
+
+#Width of the thumbnails of the sources used by previews (see ``Preview``),
+#and pixels per side of a tile when analyzing their targets
+PREVIEW_TILE_SIZE = 16
+PREVIEW_CELL_SIZE = 2
+
+#Bytes of color distances computed at once when matching (see
+#``distance_chunk``): about 100 target colors for 100k sources
+DISTANCE_BUDGET = 2 ** 26
+
+#Color distances ``approximate_match`` computes at most, at about 10ns
+#each: a fraction of a second
+APPROXIMATE_BUDGET = 3 * 10 ** 7
+
+
+def open_image(filename, store=None):
+    """Open an image from a file, an url or a ``TileStore``.
+
+    Like ``Image.open``, only the header is read: the size is known, and
+    ``draft`` can still be used before the pixels are decoded.
+
+    """
+    if store is not None:
+        return Image.open(store.open(filename))
+    if filename.startswith("http://") or filename.startswith("https://"):
+        import urllib, cStringIO
+        return Image.open(cStringIO.StringIO(urllib.urlopen(filename).read()))
+    return Image.open(filename)
+
+
 SerializableImage = namedtuple('SerializableImage',
                                'filename size mode data avg_color'.split())
 
@@ -143,20 +177,24 @@ class ImageWrapper(object):
         its filename, or import raw data from another in-memory object.
         If both the ``filename`` and ``blob`` fields are specified, then
         the in-memory data associated to the image, will be taken from
-        the blob.
+        the blob.  When a ``store`` (a ``TileStore``) is given, the
+        filename is the id of the image inside the store.
+
+        When the image is only going to be used at a smaller size, pass
+        it as ``draft``: JPEG images are then decoded at a reduced
+        scale (still at least that large), which is a lot faster.
 
         """
         self.filename = kwargs.pop('filename')
         self.blob = kwargs.pop('blob', None)
+        store = kwargs.pop('store', None)
+        draft = kwargs.pop('draft', None)
         _average_color = kwargs.pop('average_color', True)
         if self.blob is None:
             try:
-                if self.filename.startswith("http://") or self.filename.startswith("https://"):
-                    import urllib, cStringIO
-                    file = cStringIO.StringIO(urllib.urlopen(self.filename).read())
-                    self.blob = Image.open(file)
-                else:
-                    self.blob = Image.open(self.filename)
+                self.blob = open_image(self.filename, store)
+                if draft is not None:
+                    self.blob.draft('RGB', draft)
                 #convert to RGB or getcolors can return all sorts of things
                 #is this slow?
                 self.blob = self.blob.convert("RGB")
@@ -234,6 +272,10 @@ class ImageWrapper(object):
         """Paste given image over the current one."""
         self.blob.paste(image.blob, rect)
 
+    def dhash(self):
+        """Perceptual (difference) hash of the image, see ``dedup``."""
+        return dhash(self.blob)
+
     def serialize(self):
         """Convert the image wrapper into a `SerializableImage`."""
         return SerializableImage(self.filename, self.size, self.blob.mode,
@@ -242,10 +284,185 @@ class ImageWrapper(object):
     @staticmethod
     def deserialize(raw):
         """Create a new image wrapper from the given `SerializableImage`."""
-        return ImageWrapper(filename=raw.filename,
-                            blob=Image.frombytes(raw.mode,
-                                                 raw.size,
-                                                 raw.data))
+        img = ImageWrapper(filename=raw.filename,
+                           blob=Image.frombytes(raw.mode,
+                                                raw.size,
+                                                raw.data),
+                           average_color=False)
+        img._average_color = raw.avg_color
+        return img
+
+
+class SourceTable(object):
+    """Columnar table of source images.
+
+    Instead of an ``ImageWrapper`` per source, all of them share a few
+    arrays, one row per source:
+
+        - ``colors``: (N, 3) average colors
+        - ``ids``: (N,) index of the filename inside ``filenames``
+        - ``atlas``: (N, tile height, tile width, 3) tile pixels
+
+    Matching and rasterization only deal with row indices; filenames are
+    only looked up for the output.  Subsets (see ``take``) share the
+    filename table.
+
+    """
+
+    def __init__(self, filenames, colors, atlas, ids=None,
+                 fingerprints=None):
+        self.filenames = filenames
+        self.colors = numpy.asarray(colors, dtype=numpy.uint8).reshape(-1, 3)
+        self.atlas = atlas
+        self.ids = (numpy.arange(len(filenames), dtype=numpy.int32)
+                    if ids is None else ids)
+        self.fingerprints = fingerprints
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def tile_size(self):
+        """(width, height) of the tiles."""
+        return (self.atlas.shape[2], self.atlas.shape[1])
+
+    def filename(self, row):
+        return self.filenames[self.ids[row]]
+
+    def take(self, rows):
+        """Return the table restricted to `rows` (indices or mask)."""
+        return SourceTable(self.filenames, self.colors[rows],
+                           self.atlas[rows], ids=self.ids[rows],
+                           fingerprints=(None if self.fingerprints is None
+                                         else self.fingerprints[rows]))
+
+    def tile(self, row):
+        """Return the tile of `row` as an ``ImageWrapper``."""
+        return ImageWrapper(filename=self.filename(row),
+                            blob=Image.fromarray(self.atlas[row]),
+                            average_color=False)
+
+
+class RenderJob(object):
+    """Directory where a long render keeps the results of its stages, so
+    that it can resume where it was if the process gets killed.
+
+    A job is identified by the `params` of the render: when they change,
+    the results of the previous job in the directory are discarded --
+    only the files a job writes (see ``JOB_SUFFIXES``), anything else in
+    the directory is left alone.
+    Stages store their results under a name (``save_table``,
+    ``save_json``) or just record they are done (``mark_done``); files
+    are written aside and renamed, so a result is either complete or
+    missing.  The source table is kept as plain ``.npy`` files and
+    memory mapped when resuming.
+
+    """
+
+    #results, marks, tables and the files being written
+    JOB_SUFFIXES = ('.json', '.done', '.npy', '.tmp')
+
+    def __init__(self, directory, **params):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        key = hashlib.sha1(json.dumps(params, sort_keys=True)
+                           .encode('utf-8')).hexdigest()
+        #whether results of a previous run of the same job are there
+        self.resumed = self.load_json('job') == key
+        if not self.resumed:
+            for name in os.listdir(directory):
+                if name.endswith(self.JOB_SUFFIXES) \
+                   and os.path.isfile(self.path(name)):
+                    os.remove(self.path(name))
+            self.save_json('job', key)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _replace(self, name, write):
+        temporary = self.path(name + '.tmp')
+        with open(temporary, 'wb') as f:
+            write(f)
+        os.rename(temporary, self.path(name))
+
+    def load_json(self, name):
+        """Return the result `name`, or None if it isn't there yet."""
+        if not os.path.exists(self.path(name + '.json')):
+            return None
+        with open(self.path(name + '.json')) as f:
+            return json.load(f)
+
+    def save_json(self, name, value):
+        self._replace(name + '.json', lambda f: f.write(
+            json.dumps(value).encode('utf-8')))
+
+    def done(self, name):
+        return os.path.exists(self.path(name + '.done'))
+
+    def mark_done(self, name):
+        self._replace(name + '.done', lambda f: None)
+
+    def load_table(self):
+        """Return the saved (``SourceTable``, duplicates), or None."""
+        meta = self.load_json('table')
+        if meta is None:
+            return None
+        arrays = dict((name, numpy.load(self.path('table-%s.npy' % name),
+                                        mmap_mode='r' if name == 'atlas'
+                                        else None))
+                      for name in meta['arrays'])
+        table = SourceTable(meta['filenames'], arrays['colors'],
+                            arrays['atlas'], ids=arrays['ids'],
+                            fingerprints=arrays.get('fingerprints'))
+        return (table, meta['duplicates'])
+
+    def save_table(self, table, duplicates):
+        arrays = {'colors': table.colors, 'atlas': table.atlas,
+                  'ids': table.ids}
+        if table.fingerprints is not None:
+            arrays['fingerprints'] = table.fingerprints
+        for (name, array) in arrays.items():
+            self._replace('table-%s.npy' % name,
+                          partial(numpy.save, arr=array))
+        #written last: the table is there once its meta data is
+        self.save_json('table', {'filenames': table.filenames,
+                                 'duplicates': duplicates,
+                                 'arrays': sorted(arrays)})
+
+
+def squared_distances(colors, palette, palette_norms=None):
+    """Return the squared distances between each of `colors` and each of
+    `palette` (pass ``squared_norms(palette)`` when searching the same
+    palette again), as |a|^2 - 2 a.b + |b|^2: a single matrix product,
+    the result is the only (len(colors), len(palette)) array allocated.
+
+    >>> squared_distances([(0, 0, 0), (1, 2, 2)], [(0, 0, 0), (3, 4, 0)])
+    array([[ 0., 25.],
+           [ 9., 12.]])
+    """
+    colors = numpy.asarray(colors, dtype=numpy.float64).reshape(-1, 3)
+    palette = numpy.asarray(palette, dtype=numpy.float64).reshape(-1, 3)
+    if palette_norms is None:
+        palette_norms = squared_norms(palette)
+    distances = numpy.dot(colors, palette.T)
+    distances *= -2
+    distances += palette_norms[None, :]
+    distances += squared_norms(colors)[:, None]
+    #rounding can take exact matches slightly below zero
+    return numpy.maximum(distances, 0, out=distances)
+
+
+def squared_norms(colors):
+    colors = numpy.asarray(colors, dtype=numpy.float64).reshape(-1, 3)
+    return numpy.einsum('ij,ij->i', colors, colors)
+
+
+def distance_chunk(palette_size):
+    """Return how many colors to search at once in a palette of
+    `palette_size` colors, for their distances to stay within
+    ``DISTANCE_BUDGET`` bytes."""
+    return max(1, DISTANCE_BUDGET // (8 * max(1, palette_size)))
 
 
 class ImageList(object):
@@ -256,44 +473,77 @@ class ImageList(object):
     queries asking for similar images, where the similarity metric is
     based on the average color.
 
+    Each image is used once, until all of them have been: then all of
+    them are available again.  Searches return row indices of the
+    `colors` array.
+
     """
 
-    def __init__(self, tile_image_list):
+    def __init__(self, colors):
         """Initialize the internal list of images."""
-        self._used = []
-        self._img_kd_tree = kdtree.create(
-            tile_image_list, dimensions=3)
+        self._colors = numpy.asarray(colors, dtype=numpy.float32)
+        self._norms = squared_norms(self._colors)
+        self._used = numpy.zeros(len(self._colors), dtype=bool)
+        self._available = len(self._colors)
+        #bumped on reset, to know precomputed distances are stale
+        self._generation = 0
 
     def _reset(self):
         #for when we have to re-use images (sparingly)
-        if len(self._used):
-            self._img_kd_tree = kdtree.create(self._used, dimensions=3)
-            self._used = []
+        self._used[:] = False
+        self._available = len(self._colors)
+        self._generation += 1
+
+    def _distances(self, colors):
+        distances = squared_distances(colors, self._colors, self._norms)
+        distances[:, self._used] = numpy.inf
+        return distances
+
+    def _take(self, row):
+        self._used[row] = True
+        self._available -= 1
+        if not self._available:
+            self._reset()
+        return row
 
-    stime = 0.0
-    rtime = 0.0
-            
     def search(self, color, whenskip=0, skip_list=[]):
         """Search the most similar image in terms of average color."""
-        if len(self._used) and \
-           (self._img_kd_tree.data is None or len(self._img_kd_tree.data) == 0):
+        if not len(self._colors):
+            return None
+        return self._take(int(numpy.argmin(self._distances([color])[0])))
+
+    def reserve(self, rows):
+        """Mark `rows` as used, as if they had been found by searches
+        (e.g. tiles kept from a previous match)."""
+        rows = numpy.unique(numpy.asarray(rows, dtype=numpy.int64))
+        self._available -= int(numpy.count_nonzero(~self._used[rows]))
+        self._used[rows] = True
+        if not self._available:
             self._reset()
 
-        
-        #t = time.time()
-        #this is superslow
-        found_tileimages = self._img_kd_tree.search_nn(color)
-        #TODO: switch the approach here to matching tiles to the best placement rather than the reverse
-        #self.stime = self.stime + time.time() - t
-        if len(found_tileimages) > 0:
-            tileimage = found_tileimages[0]
-            imagewrapper = tileimage.data
-            #t= time.time()
-            self._img_kd_tree.remove(imagewrapper, tileimage)
-            #self.rtime = self.rtime + time.time() - t
-            self._used.append(imagewrapper)
-
-            return imagewrapper.filename
+    def match(self, colors, chunk=None):
+        """Search images for all `colors`, in order: same results as
+        calling ``search`` for each of them, but the distances are
+        computed for `chunk` colors at a time (by default, as many as
+        ``distance_chunk`` allows)."""
+        colors = numpy.asarray(colors, dtype=numpy.float32).reshape(-1, 3)
+        result = numpy.empty(len(colors), dtype=numpy.int64)
+        if not len(self._colors):
+            result[:] = -1
+            return result
+        chunk = chunk or distance_chunk(len(self._colors))
+        for start in range(0, len(colors), chunk):
+            block = colors[start:start + chunk]
+            generation = self._generation
+            best = numpy.argmin(self._distances(block), axis=1)
+            for (offset, row) in enumerate(best):
+                if self._used[row] or self._generation != generation:
+                    #taken by a previous color of the block, or all
+                    #images became available again meanwhile
+                    row = numpy.argmin(self._distances(
+                        block[offset:offset + 1])[0])
+                result[start + offset] = self._take(int(row))
+        return result
 
 
 def lattice(width, height, rects_width, rects_height=None):
@@ -321,75 +571,364 @@ def lattice(width, height, rects_width, rects_height=None):
                    x_offset + tile_width, y_offset + tile_height)
 
 
-def _load_raw_tiles(filenames, ratio, size):
+def zoom_for(width, height, zoom=1, output_size=None, memory_budget=None):
+    """Return the zoom factor for a mosaic of a `width` x `height`
+    target, limited so that the mosaic fits in `output_size` (maximum
+    width and height) and takes at most `memory_budget` bytes (RGB).
+
+    >>> zoom_for(1000, 500, zoom=2, output_size=(500, 500))
+    0.5
+    >>> zoom_for(1000, 1000, memory_budget=3 * 250000)
+    0.5
+    """
+    if output_size is not None:
+        zoom = min(zoom, output_size[0] / width, output_size[1] / height)
+    if memory_budget is not None:
+        zoom = min(zoom, math.sqrt(memory_budget / 3 / (width * height)))
+    return zoom
+
+
+def load_target(filename, tiles_x, tiles_y, cell_size=ANALYSIS_CELL_SIZE):
+    """Load the target image at just the size needed to compute the
+    colors of a `tiles_x` x `tiles_y` lattice: `cell_size` pixels per
+    side of each tile.
+
+    JPEG targets are decoded directly at a reduced scale, so huge photos
+    cost about as much as small ones.
+
+    """
+    img = open_image(filename)
+    (width, height) = img.size
+    size = (max(tiles_x, min(width, tiles_x * cell_size)),
+            max(tiles_y, min(height, tiles_y * cell_size)))
+    img.draft('RGB', size)
+    img = img.convert('RGB')
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS)
+    return ImageWrapper(filename=filename, blob=img, average_color=False)
+
+
+def grid_colors(img, tiles_x, tiles_y):
+    """Return the average colors of the tiles of the lattice of `img`
+    (an ``ImageWrapper``), row by row, in a single array operation.
+
+    Same colors as the ``avg_color`` of each rectangle of ``lattice``.
+
+    """
+    (width, height) = img.size
+    (cell_width, cell_height) = (width // tiles_x, height // tiles_y)
+    pixels = numpy.asarray(img.blob, dtype=numpy.uint32)[
+        :tiles_y * cell_height, :tiles_x * cell_width]
+    sums = pixels.reshape(tiles_y, cell_height, tiles_x, cell_width, 3)\
+                 .sum(axis=(1, 3)).reshape(-1, 3)
+    return [tuple(color) for color in
+            (sums // (cell_width * cell_height)).tolist()]
+
+
+class Overlay(object):
+    """The target, blended with `opacity` over a mosaic.
+
+    Viewers used to stack the target over the mosaic themselves; the
+    blend is done while rasterizing instead, one band or region at a
+    time (see ``blend``), so that there is a single image to download.
+    The target is decoded once, at about `size` (the largest output) if
+    it is larger than that.
+
+    """
+
+    def __init__(self, filename, opacity, size=None):
+        img = open_image(filename)
+        if size is not None:
+            img.draft('RGB', size)
+        self._image = img.convert('RGB')
+        self.opacity = opacity
+
+    def blend(self, pixels, box, size):
+        """Return `pixels`, the (height, width, 3) array of the `box`
+        (left, top, right, bottom) of a `size` (width, height) image,
+        with the target composited over it."""
+        (left, top, right, bottom) = box
+        (scale_x, scale_y) = (self._image.size[0] / size[0],
+                              self._image.size[1] / size[1])
+        overlay = self._image.transform(
+            (right - left, bottom - top), Image.EXTENT,
+            (left * scale_x, top * scale_y, right * scale_x, bottom * scale_y),
+            Image.BILINEAR)
+        alpha = int(round(self.opacity * 256))
+        return ((pixels.astype(numpy.uint16) * (256 - alpha)
+                 + numpy.asarray(overlay, dtype=numpy.uint16) * alpha)
+                >> 8).astype(numpy.uint8)
+
+
+def _load_raw_tiles(filenames, ratio, size, store=None, fingerprint=False):
+    if store is not None:
+        store = TileStore(store)
     def func(filename):
-        img = ImageWrapper(filename=filename)
+        img = ImageWrapper(filename=filename, store=store, draft=size,
+                           average_color=False)
+        #hashed before cropping, so that differently framed copies of
+        #the same picture still look alike
+        hashed = img.dhash() if fingerprint else None
         img.reratio(ratio)
         img.resize(size)
-        return img.serialize()
-    return [func(filename) for filename in filenames]
+        img._average_color = average_color(img)
+        return (img.serialize(), hashed)
+    try:
+        return [func(filename) for filename in filenames]
+    finally:
+        if store is not None:
+            store.close()
 
 
-def load_raw_tiles(filenames, ratio, size, pool, workers):
-    raws = flatten(pool.map(partial(_load_raw_tiles, ratio=ratio, size=size),
-                            splitter(workers, filenames)))
-    return [ImageWrapper.deserialize(raw) for raw in raws]
+def load_raw_tiles(filenames, ratio, size, pool, workers, store=None,
+                   fingerprint=False):
+    """Load, crop and resize the source images into a ``SourceTable``.
 
+    With a `store` (path of a ``TileStore``) `filenames` are ids inside
+    the store; they are loaded in data file order, so each worker reads
+    a contiguous part of the store.  The rows of the table are in
+    loading order.
 
-def _extract_average_colors(filename, rectangles):
-    """Extract from `img` multiple tiles covering areas described by
-    `rectangles`"""
-    img = ImageWrapper(filename=filename)
-    return [img.crop(rect).avg_color for rect in rectangles]
+    With `fingerprint`, the perceptual hashes of the images are kept as
+    the ``fingerprints`` of the table.
 
+    """
+    if store is not None:
+        with TileStore(store) as tile_store:
+            filenames = tile_store.sorted(filenames)
+    filenames = list(filenames)
+    (width, height) = size
+    atlas = numpy.empty((len(filenames), height, width, 3), dtype=numpy.uint8)
+    colors = numpy.empty((len(filenames), 3), dtype=numpy.uint8)
+    fingerprints = numpy.zeros(len(filenames), dtype=numpy.uint64)
+    #smaller chunks than workers: tiles are copied into the atlas as soon
+    #as a chunk is done, instead of all of them being held twice at once
+    chunks = pool.imap(partial(_load_raw_tiles, ratio=ratio, size=size,
+                               store=store, fingerprint=fingerprint),
+                       splitter(workers * 4, filenames))
+    for (row, (raw, hashed)) in enumerate(flatten(chunks)):
+        atlas[row] = numpy.frombuffer(raw.data, dtype=numpy.uint8)\
+                          .reshape(height, width, 3)
+        colors[row] = raw.avg_color
+        if hashed is not None:
+            fingerprints[row] = hashed
+    return SourceTable(filenames, colors, atlas,
+                       fingerprints=fingerprints if fingerprint else None)
+
+
+def collapse_duplicates(table, max_distance=4):
+    """Keep one row per group of near-identical images.
+
+    Return the table of canonical images and a ``{duplicate filename:
+    canonical filename}`` dictionary.  The table needs fingerprints.
+
+    """
+    index = HashIndex(max_distance)
+    (keep, duplicates) = ([], {})
+    for row in sorted(range(len(table)), key=table.filename):
+        filename = table.filename(row)
+        canonical = index.add(int(table.fingerprints[row]), filename)
+        if canonical == filename:
+            keep.append(row)
+        else:
+            duplicates[filename] = canonical
+    return (table.take(numpy.array(sorted(keep), dtype=numpy.int64)),
+            duplicates)
+
+
+class OutputSpec(namedtuple('OutputSpec',
+                             'destination scale max_size format quality')):
+    """One output of a mosaic: `scale` of its full size (at most 1),
+    further reduced to fit `max_size` (width, height) if given; `format`
+    and `quality` are passed to PIL (default: guessed from the name of
+    `destination`, and PIL's default quality)."""
+
+    def __new__(cls, destination, scale=1, max_size=None, format=None,
+                quality=None):
+        return super(OutputSpec, cls).__new__(cls, destination, scale,
+                                              max_size, format, quality)
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse a DESTINATION[:SCALE|WIDTHxHEIGHT[:QUALITY]] string.
+        >>> OutputSpec.parse('web.jpg:800x600:85')
+        OutputSpec(destination='web.jpg', scale=1, max_size=(800, 600), format=None, quality=85)
+        >>> OutputSpec.parse('print.png')
+        OutputSpec(destination='print.png', scale=1, max_size=None, format=None, quality=None)
+        """
+        parts = spec.split(':')
+        (scale, max_size, quality) = (1, None, None)
+        if len(parts) > 1 and parts[1]:
+            if 'x' in parts[1]:
+                max_size = tuple(int(v) for v in parts[1].split('x'))
+            else:
+                scale = float(parts[1])
+        if len(parts) > 2 and parts[2]:
+            quality = int(parts[2])
+        return cls(parts[0], scale, max_size, None, quality)
+
+    def tile_size(self, tile_size, tiles):
+        """Return the size of the tiles of this output, for a mosaic of
+        `tiles` (tiles_x, tiles_y) tiles of `tile_size`."""
+        scale = self.scale
+        if self.max_size is not None:
+            scale = min(scale,
+                        self.max_size[0] / (tile_size[0] * tiles[0]),
+                        self.max_size[1] / (tile_size[1] * tiles[1]))
+        if scale > 1:
+            raise ValueError("%s can't be larger than the mosaic: render "
+                             "it with a larger zoom" % self.destination)
+        return (max(1, int(tile_size[0] * scale)),
+                max(1, int(tile_size[1] * scale)))
+
+
+def color_shifts(tile_colors, target_colors, strength):
+    """Return the (N, 3) shifts moving the average color of each tile
+    `strength` (0 to 1) of the way towards the color of its cell.
+    >>> color_shifts([(100, 0, 0)], [(200, 50, 0)], 0.5).tolist()
+    [[50, 25, 0]]
+    """
+    return numpy.rint(strength * (numpy.asarray(target_colors, numpy.float32)
+                                  - numpy.asarray(tile_colors, numpy.float32))
+                      ).astype(numpy.int16)
 
-def extract_average_colors(img, rectangles, pool, workers):
-    """Convert input image into a matrix of tiles_per_size.
 
-    Return a matrix composed by tile-objects, i.e. dictionaries,
-    containing useful information for the final mosaic.
+def _assemble(atlas, indices, tiles, overlay=None, shifts=None,
+              origin=(0, 0), full_size=None):
+    """Return the image of the tiles `indices` of `atlas`, laid out on a
+    lattice of `tiles` (tiles_x, tiles_y) tiles, with `shifts` added to
+    the colors of the tiles and `overlay` blended over it.
 
-    In our particular case we are in need of the average color of the
-    region representing a specific tile. For compatibility with the
-    objects used for the ``ImageList`` we set the filename and blob
-    fields either.
+    The image may be a part of a larger mosaic (see ``pyramid``): the
+    one at `origin` (left, top) inside a mosaic of `full_size` (width,
+    height), which is what the overlay is blended over.
 
     """
-    return flatten(pool.map(partial(_extract_average_colors, img.filename),
-                            splitter(workers, rectangles)))
+    (tiles_x, tiles_y) = tiles
+    (height, width) = atlas.shape[1:3]
+    size = (tiles_x * width, tiles_y * height)
+    (left, top) = origin
+    pixels = numpy.empty((size[1], size[0], 3), dtype=numpy.uint8)
+    for row in range(tiles_y):
+        band = atlas[indices[row * tiles_x:(row + 1) * tiles_x]]
+        if shifts is not None:
+            band = numpy.clip(
+                band + shifts[row * tiles_x:(row + 1) * tiles_x,
+                              None, None, :],
+                0, 255).astype(numpy.uint8)
+        #(column, y, x, rgb) -> (y, column, x, rgb): the tiles of a row of
+        #the lattice side by side
+        band = band.transpose(1, 0, 2, 3).reshape(height, size[0], 3)
+        if overlay is not None:
+            band = overlay.blend(band, (left, top + row * height,
+                                        left + size[0],
+                                        top + (row + 1) * height),
+                                 full_size or size)
+        pixels[row * height:(row + 1) * height] = band
+    return Image.fromarray(pixels, 'RGB')
+
+
+def _downscale(atlas, size):
+    """Return `atlas` with its tiles resized to `size` (width, height)."""
+    result = numpy.empty((len(atlas), size[1], size[0], 3), dtype=numpy.uint8)
+    for (i, tile) in enumerate(atlas):
+        result[i] = numpy.asarray(Image.fromarray(tile, 'RGB')
+                                       .resize(size, Image.LANCZOS))
+    return result
 
-def _search_matching_images(image_list, whenskip, avg_colors):
-    """Gets the name of tiles that best match the given list of colors."""
-    x = [image_list.search(color, whenskip) for color in avg_colors]
-    #print ('time searching', image_list.stime, image_list.rtime)
-    return x
 
+class Mosaic(object):
+    """The mosaic, as rows of a ``SourceTable`` laid out on a lattice of
+    `tiles` (tiles_x, tiles_y) tiles; the image is only assembled when
+    shown or saved, with the target blended over it if there is an
+    `overlay`.
 
-def search_matching_images(image_list, avg_colors, pool, workers, whenskip=0):
-    smi = partial(_search_matching_images, image_list, whenskip)
-    return flatten(pool.map(smi,
-                            splitter(workers, avg_colors)))
+    With a `correction` (0 to 1), the colors of the tiles are shifted
+    towards the colors of their cells of the target (the
+    ``target_colors`` of the `layout`): that much of the difference
+    between their average colors is added to each tile.
 
+    """
 
-class Mosaic(object):
-    def __init__(self, mosaic, tiles):
-        self._mosaic = mosaic
+    def __init__(self, table, indices, tiles, layout=None, overlay=None,
+                 correction=0):
+        self._table = table
+        self._indices = numpy.asarray(indices, dtype=numpy.int64)
         self._tiles = tiles
-        self._initialized = False
+        self.overlay = overlay
+        self.correction = correction
+        self._image = None
+        #rectangles, best matching source per rectangle, sizes... the
+        #data also dumped to the json file
+        self.layout = layout or {}
+
+    def _shifts(self):
+        if not self.correction:
+            return None
+        return color_shifts(self._table.colors[self._indices],
+                            self.layout['target_colors'], self.correction)
 
     def _initialize(self):
-        if not self._initialized:
-            for (rect, img) in self._tiles:
-                self._mosaic.paste(img, rect)
-            self._initialized = True
+        if self._image is None:
+            self._image = _assemble(self._table.atlas, self._indices,
+                                    self._tiles, self.overlay,
+                                    self._shifts())
+        return self._image
+
+    def blended(self, overlay):
+        """Return the same mosaic, with `overlay` blended over it."""
+        return Mosaic(self._table, self._indices, self._tiles,
+                      layout=self.layout, overlay=overlay,
+                      correction=self.correction)
 
     def show(self):
-        self._initialize()
-        self._mosaic.blob.show()
+        self._initialize().show()
+
+    def save(self, destination, format=None):
+        self._initialize().save(destination, format)
+
+    def save_all(self, specs, threads=None):
+        """Save several outputs (``OutputSpec``) of the mosaic at once.
 
-    def save(self, destination):
-        self._initialize()
-        self._mosaic.blob.save(destination)
+        The tiles are matched once for all outputs: each one is only
+        assembled from the tiles at its size, and smaller tiles are
+        downscaled from the smallest larger ones already computed, for
+        the tiles actually used only.  Outputs are encoded in parallel
+        (PIL releases the GIL while encoding).
+
+        """
+        from multiprocessing.pool import ThreadPool
+        if not specs:
+            return
+        full_size = self._table.tile_size
+        sizes = [spec.tile_size(full_size, self._tiles) for spec in specs]
+        rows = numpy.unique(self._indices)
+        indices = numpy.searchsorted(rows, self._indices)
+        atlases = {full_size: self._table.atlas[rows]}
+        for size in sorted(set(sizes), reverse=True):
+            if size not in atlases:
+                larger = min(s for s in atlases
+                             if s[0] >= size[0] and s[1] >= size[1])
+                atlases[size] = _downscale(atlases[larger], size)
+
+        shifts = self._shifts()
+
+        def encode(job):
+            (spec, size) = job
+            image = _assemble(atlases[size], indices, self._tiles,
+                              self.overlay, shifts)
+            options = {}
+            if spec.quality is not None:
+                options['quality'] = spec.quality
+            image.save(spec.destination, spec.format, **options)
+
+        pool = ThreadPool(threads or
+                          min(len(specs), multiprocessing.cpu_count()))
+        try:
+            pool.map(encode, list(zip(specs, sizes)))
+        finally:
+            pool.close()
+            pool.join()
 
 
 def skymosaic(target, sources, strategy, loader):
@@ -444,7 +983,9 @@ def skymosaic(target, sources, strategy, loader):
     pass
 
 
-def mosaicify(target, sources, tiles=None, zoom=1, jsonfile=None):
+def mosaicify(target, sources, tiles=None, zoom=1, jsonfile=None, store=None,
+              exclude=None, dedup=False, output_size=None, memory_budget=None,
+              opacity=0, correction=0, job_dir=None):
     """Create mosaic of photos.
 
     The function wraps all process of the creation of a mosaic, given
@@ -473,27 +1014,121 @@ def mosaicify(target, sources, tiles=None, zoom=1, jsonfile=None):
 
     When done, show the result on screen or dump it on the disk.
 
+    If the source images have been packed inside a ``TileStore``, pass
+    its path as `store`, and their ids as `sources`.
+
+    Sources contained in `exclude` (e.g. images of blocked users) are
+    masked out before anything is loaded or indexed.
+
+    With `dedup`, near-identical source images (same picture, other
+    encoding or size) are collapsed into one before indexing; the
+    ``duplicates`` entry of the layout tells which were dropped.
+
+    The zoom is reduced if needed, for the mosaic to fit `output_size`
+    (maximum width and height, in pixels) and `memory_budget` (bytes).
+    The target itself is only decoded at the resolution needed to
+    analyze the lattice (see ``load_target``).
+
+    With an `opacity`, the target is blended over the mosaic (see
+    ``Overlay``).  With a `correction`, the colors of the tiles are
+    shifted towards the target (see ``Mosaic``).  With a `job_dir`, a
+    killed render resumes where it was (see ``mosaicify_batch``).
+
+    To create mosaics of several targets out of the same sources, use
+    ``mosaicify_batch``: sources are only loaded once.
+
     """
-    # Load the target image into memory
+    (mosaic,) = mosaicify_batch([target], sources, tiles=tiles, zoom=zoom,
+                                store=store, exclude=exclude, dedup=dedup,
+                                output_size=output_size,
+                                memory_budget=memory_budget,
+                                opacity=opacity, correction=correction,
+                                job_dir=job_dir)
+    #TODO: move this out
+    if jsonfile:
+        with open(jsonfile, 'w') as jf:
+            jf.write(json.dumps(mosaic.layout))
+    return mosaic
 
-    mosaic = ImageWrapper(filename=target)
-            
-    # Generate the list of rectangles identifying mosaic tiles
-    (original_width, original_height) = mosaic.size
 
-    tiles_height = None
+def target_lattice(size, source_count, tiles=None):
+    """Return the (tiles_x, tiles_y) lattice of a target of `size`:
+    `tiles` per side, or as many tiles as sources, about square."""
+    (width, height) = size
     if tiles is None:
         #max width with # tiles used
-        tiles = int(original_width * math.sqrt(len(sources)) / math.sqrt(original_width * original_height))
-        tiles_height = int(original_height * tiles / original_width)
-        print('tile dims:', tiles, tiles_height)
-    else:
-        tiles = int(tiles)
-    rectangles = list(lattice(original_width, original_height, tiles, tiles_height))
+        tiles = int(width * math.sqrt(source_count) / math.sqrt(width * height))
+        return (tiles, int(height * tiles / width))
+    return (int(tiles), int(tiles))
+
+
+def match_target(target, colors, tiles_x, tiles_y):
+    """Compute the colors of the `tiles_x` x `tiles_y` tiles of `target`
+    and match them against the source `colors`.
+
+    Return the matched source rows and the colors of the tiles.
+
+    """
+    target_colors = grid_colors(load_target(target, tiles_x, tiles_y),
+                                tiles_x, tiles_y)
+    rows = ImageList(colors).match(target_colors)
+    return (rows, target_colors)
+
+
+def _match_target(colors, job):
+    return match_target(job[0], colors, *job[1:])
+
+
+def mosaicify_batch(targets, sources, tiles=None, zoom=1, store=None,
+                    exclude=None, dedup=False, output_size=None,
+                    memory_budget=None, opacity=0, correction=0,
+                    job_dir=None):
+    """Create one mosaic per target, out of the same source images.
+
+    Sources are loaded, thumbnailed and indexed once; then each target
+    only costs the analysis of its lattice and the matching, which run
+    in parallel.  All the mosaics share the tiles in memory.
+
+    Tiles have the same size in all the mosaics: the size ``mosaicify``
+    would use for the first target.  The lattices of the other targets
+    have `tiles` columns (or as many tiles as sources), and as many rows
+    as needed for their ratio.
+
+    With a `job_dir`, the loaded sources and the matches are kept in its
+    ``render`` subdirectory (see ``RenderJob``): if the process is
+    killed, running it again with the same arguments resumes from there.
+
+    Options are the ones of ``mosaicify``; return the list of ``Mosaic``.
+
+    """
+    if exclude:
+        sources = [s for s in sources if s not in exclude]
+    sources = list(sources)
+
+    # Only read the size of the targets for now
+    sizes = [open_image(target).size for target in targets]
+
+    (tiles_x, tiles_y) = target_lattice(sizes[0], len(sources), tiles)
+    print('tile dims:', tiles_x, tiles_y)
 
     # Compute the size of the tiles after the zoom factor has been applied
-    (zoomed_tile_width, zoomed_tile_height) = (zoom * original_width // tiles,
-                                               zoom * original_height // tiles_height)
+    (zoomed_tile_width, zoomed_tile_height) = zoomed_tile_size(
+        sizes[0], (tiles_x, tiles_y), zoom, output_size, memory_budget)
+
+    lattices = [(tiles_x, tiles_y)]
+    for (width, height) in sizes[1:]:
+        columns = target_lattice((width, height), len(sources), tiles)[0]
+        rows = int(round(height * columns * zoomed_tile_width
+                         / (width * zoomed_tile_height)))
+        lattices.append((max(1, columns), max(1, rows)))
+
+    job = None
+    if job_dir is not None:
+        job = RenderJob(os.path.join(job_dir, 'render'),
+                        sources=sorted(sources), store=store,
+                        dedup=dedup, targets=list(targets),
+                        lattices=lattices,
+                        tile_size=(zoomed_tile_width, zoomed_tile_height))
 
     # Initialize the pool of workers
     workers = multiprocessing.cpu_count()
@@ -501,70 +1136,418 @@ def mosaicify(target, sources, tiles=None, zoom=1, jsonfile=None):
 
     # Load tiles into memory and resize them accordingly
     #slowish
-    source_tiles = dict(zip(sources,
-                            load_raw_tiles(sources,
-                                           mosaic.ratio,
-                                           (zoomed_tile_width,
-                                            zoomed_tile_height),
-                                           pool,
-                                           workers)))
-
-    # TODO: source_objects tracked to position (and not indexed by filename)
-    
-    # Indicize all the source images by their average color
-    source_list = ImageList(list(source_tiles.values()))
-    #t.append(time.time())
-    #print('4time ', t[-1]-t[-2], t[-1]-t[0])
-            
-
-    #ratio of how many tiles we need vs how many we want
-    # if >1, then the primary challenge is finding the sorted match
-    # if <1 then the primary challenge is to use what we have, and then repeat
-    avail2needed = float(len(source_tiles)) / len(rectangles)
-
-    print('amt', len(source_tiles), len(rectangles))
-
-    # Compute the average color of each mosaic tile
-    mosaic_avg_colors = list(extract_average_colors(mosaic, rectangles, pool,
-                                                    workers))
+    resumed = job.load_table() if job is not None else None
+    if resumed is not None:
+        (loaded, duplicates) = resumed
+    else:
+        loaded = load_raw_tiles(sources,
+                                zoomed_tile_width / zoomed_tile_height,
+                                (zoomed_tile_width, zoomed_tile_height),
+                                pool,
+                                workers,
+                                store=store,
+                                fingerprint=dedup)
+        duplicates = {}
+        if dedup:
+            (loaded, duplicates) = collapse_duplicates(loaded)
+        if job is not None:
+            job.save_table(loaded, duplicates)
+
+    print('amt', len(loaded), [x * y for (x, y) in lattices])
+
+    # Find which source image best fits each tile of each target
+    matches = [job.load_json('match-%d' % i) if job is not None else None
+               for i in range(len(targets))]
+    missing = [i for (i, match) in enumerate(matches) if match is None]
+    pending = [(targets[i],) + lattices[i] for i in missing]
+    if len(pending) > 1:
+        found = pool.imap(partial(_match_target, loaded.colors), pending)
+    else:
+        found = (_match_target(loaded.colors, args) for args in pending)
+    for (i, (rows, target_colors)) in zip(missing, found):
+        matches[i] = (list(map(int, rows)), target_colors)
+        if job is not None:
+            job.save_json('match-%d' % i, matches[i])
 
     # Shut down the pool of workers
     pool.close()
     pool.join()
 
-    # Find which source image best fits each mosaic tile
-    #slowslow 62sec for 5000 images
-    best_matching_imgs = list(_search_matching_images(source_list,
-                                                      avail2needed,
-                                                      mosaic_avg_colors,
-                                                      ))
+    return [_mosaic(loaded, target, grid,
+                    (zoomed_tile_width, zoomed_tile_height),
+                    best_matching, target_colors, duplicates,
+                    opacity, correction)
+            for (target, grid, (best_matching, target_colors))
+            in zip(targets, lattices, matches)]
+
+
+def load_matched(matched, tile_size, store=None):
+    """Load only the sources used by mosaics, at `tile_size`.
+
+    `matched` holds the filenames matched to the tiles of each mosaic;
+    return the ``SourceTable`` of the sources used, and the rows of the
+    tiles of each mosaic inside it.
 
+    """
+    used = sorted(set(filename for filenames in matched
+                      for filename in filenames))
+    workers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    try:
+        table = load_raw_tiles(used, tile_size[0] / tile_size[1], tile_size,
+                               pool, workers, store=store)
+    finally:
+        pool.close()
+        pool.join()
+    #the store loads in its own order
+    positions = dict((filename, row)
+                     for (row, filename) in enumerate(table.filenames))
+    return (table, [[positions[filename] for filename in filenames]
+                    for filenames in matched])
+
+
+def mosaicify_index(targets, colors, tiles=None, zoom=1, store=None,
+                    duplicates=None, output_size=None, memory_budget=None,
+                    opacity=0, correction=0, job_dir=None):
+    """Create one mosaic per target, out of indexed sources (see
+    ``sourceindex``).
+
+    `colors` is ``{source: average color}``, as indexed: the tiles are
+    matched against these, without opening any source, then only the
+    sources the mosaics use are loaded.  `duplicates` (``{duplicate:
+    canonical}``, already left out of `colors`) goes in the layouts.
+
+    Lattices and tile size are the ones of ``mosaicify_batch``, and so
+    is resuming from `job_dir`; other options are the ones of
+    ``mosaicify``.  Return the list of ``Mosaic``.
+
+    """
+    sources = sorted(colors)
+    palette = numpy.array([colors[source] for source in sources],
+                          dtype=numpy.uint8).reshape(-1, 3)
+    sizes = [open_image(target).size for target in targets]
+    (tiles_x, tiles_y) = target_lattice(sizes[0], len(sources), tiles)
+    tile_size = zoomed_tile_size(sizes[0], (tiles_x, tiles_y), zoom,
+                                 output_size, memory_budget)
+    lattices = [(tiles_x, tiles_y)]
+    for (width, height) in sizes[1:]:
+        columns = target_lattice((width, height), len(sources), tiles)[0]
+        rows = int(round(height * columns * tile_size[0]
+                         / (width * tile_size[1])))
+        lattices.append((max(1, columns), max(1, rows)))
+
+    job = None
+    if job_dir is not None:
+        job = RenderJob(os.path.join(job_dir, 'render'), sources=sources,
+                        colors=palette.tolist(), store=store,
+                        targets=list(targets), lattices=lattices,
+                        tile_size=tile_size)
+
+    matches = []
+    for (i, (target, grid)) in enumerate(zip(targets, lattices)):
+        match = job.load_json('match-%d' % i) if job is not None else None
+        if match is None:
+            (rows, target_colors) = match_target(target, palette, *grid)
+            match = (list(map(int, rows)), target_colors)
+            if job is not None:
+                job.save_json('match-%d' % i, match)
+        matches.append(match)
+
+    loaded = job.load_table() if job is not None else None
+    if loaded is not None:
+        (table, indices) = (loaded[0], job.load_json('indices'))
+    else:
+        (table, indices) = load_matched(
+            [[sources[row] for row in rows]
+             for (rows, target_colors) in matches], tile_size, store=store)
+        if job is not None:
+            #before the table: the table is only there with them
+            job.save_json('indices', indices)
+            job.save_table(table, {})
+    return [_mosaic(table, target, grid, tile_size, rows, target_colors,
+                    duplicates or {}, opacity, correction)
+            for (target, grid, rows, (matched, target_colors))
+            in zip(targets, lattices, indices, matches)]
+
+
+def zoomed_tile_size(size, tiles, zoom=1, output_size=None,
+                     memory_budget=None):
+    """Return the size of the tiles of a mosaic of the `size` target,
+    on a `tiles` (tiles_x, tiles_y) lattice (see ``zoom_for``)."""
+    (width, height) = size
+    zoom = zoom_for(width, height, zoom, output_size, memory_budget)
+    return (max(1, int(zoom * width // tiles[0])),
+            max(1, int(zoom * height // tiles[1])))
+
+
+def _mosaic(table, target, tiles, tile_size, best_matching, target_colors,
+            duplicates, opacity=0, correction=0):
+    """Return the ``Mosaic`` of `target` for rows `best_matching` of
+    `table`, with its layout."""
+    (tiles_x, tiles_y) = tiles
     # Apply the zoom factor
-    (zoomed_width, zoomed_height) = (tiles * zoomed_tile_width,
-                                     tiles_height * zoomed_tile_height)
-    mosaic.resize((zoomed_width, zoomed_height))
-    rectangles = list(lattice(zoomed_width, zoomed_height, tiles))
+    (zoomed_width, zoomed_height) = (tiles_x * tile_size[0],
+                                     tiles_y * tile_size[1])
+    layout = {
+        'rectangles': list(lattice(zoomed_width, zoomed_height,
+                                   tiles_x, tiles_y)),
+        'best_matching': [table.filename(row) for row in best_matching],
+        'width': zoomed_width,
+        'height': zoomed_height,
+        'tiles_x': tiles_x,
+        'tiles_y': tiles_y,
+        'target_colors': target_colors,
+        'duplicates': duplicates,
+        'target': target,
+    }
+    overlay = None
+    if opacity:
+        overlay = Overlay(target, opacity, (zoomed_width, zoomed_height))
+    return Mosaic(table, best_matching, tiles, layout=layout,
+                  overlay=overlay, correction=correction)
+
+
+def mosaicify_frames(frames, sources, tiles=None, zoom=1, store=None,
+                     exclude=None, dedup=False, output_size=None,
+                     memory_budget=None, opacity=0, correction=0,
+                     threshold=16):
+    """Create mosaics of a sequence of target `frames` (e.g. the frames
+    of a video, all of the same size), out of the same source images.
+
+    Sources are loaded once.  Each frame is matched starting from the
+    previous one: a tile keeps its source as long as the color of the
+    target there stays within `threshold` (distance in RGB) of the color
+    it was matched for, so still parts of the video don't flicker, and
+    only the tiles that changed are matched again.
+
+    Options are the ones of ``mosaicify``; mosaics are generated one
+    frame at a time.
 
-    #TODO: move this out
-    if jsonfile:
-        with open(jsonfile, 'w') as jf:
-            jf.write(json.dumps({
-                'rectangles':rectangles,
-                'best_matching': best_matching_imgs,
-                'width': zoomed_width,
-                'height': zoomed_height,
-            }))
+    """
+    frames = list(frames)
+    if exclude:
+        sources = [s for s in sources if s not in exclude]
+    sources = list(sources)
+
+    size = open_image(frames[0]).size
+    (tiles_x, tiles_y) = target_lattice(size, len(sources), tiles)
+    tile_size = zoomed_tile_size(size, (tiles_x, tiles_y), zoom,
+                                 output_size, memory_budget)
+
+    workers = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    try:
+        loaded = load_raw_tiles(sources, tile_size[0] / tile_size[1],
+                                tile_size, pool, workers, store=store,
+                                fingerprint=dedup)
+    finally:
+        pool.close()
+        pool.join()
+    duplicates = {}
+    if dedup:
+        (loaded, duplicates) = collapse_duplicates(loaded)
+
+    (rows, matched_colors) = (None, None)
+    for frame in frames:
+        target_colors = grid_colors(load_target(frame, tiles_x, tiles_y),
+                                    tiles_x, tiles_y)
+        colors = numpy.asarray(target_colors, dtype=numpy.float32)
+        if rows is None:
+            rows = ImageList(loaded.colors).match(colors)
+            matched_colors = colors
+        else:
+            changed = numpy.sum((colors - matched_colors) ** 2, axis=1) \
+                > threshold ** 2
+            if changed.any():
+                image_list = ImageList(loaded.colors)
+                image_list.reserve(rows[~changed])
+                rows = rows.copy()
+                rows[changed] = image_list.match(colors[changed])
+                matched_colors = matched_colors.copy()
+                matched_colors[changed] = colors[changed]
+        yield _mosaic(loaded, frame, (tiles_x, tiles_y), tile_size, rows,
+                      target_colors, duplicates, opacity, correction)
+
+
+def approximate_match(colors, target_colors, bits=5, chunk=None,
+                      budget=APPROXIMATE_BUDGET):
+    """Return, for each of `target_colors`, the row of the closest of
+    `colors`, tiles being allowed to repeat.
+
+    Target colors are quantized to `bits` per channel, and each distinct
+    quantized color is searched once: a lattice costs about as much as
+    its number of distinct colors, not of tiles.  Fewer bits are used
+    while the distinct colors times `colors` are more than `budget`
+    distances, so noisy targets and large sources don't cost more.
+    Distances are computed for `chunk` of them at a time (see
+    ``ImageList.match``).
+
+    >>> approximate_match([(0, 0, 0), (250, 250, 250)],
+    ...                   [(10, 10, 10), (240, 255, 250), (5, 0, 0)]).tolist()
+    [0, 1, 0]
+    """
+    palette = numpy.asarray(colors, dtype=numpy.float32).reshape(-1, 3)
+    target_colors = numpy.asarray(target_colors, dtype=numpy.int64)\
+                         .reshape(-1, 3)
+    if not len(palette):
+        return numpy.full(len(target_colors), -1, dtype=numpy.int64)
+    while True:
+        quantized = target_colors >> (8 - bits)
+        keys = (quantized[:, 0] << (2 * bits)) | (quantized[:, 1] << bits) \
+            | quantized[:, 2]
+        (unique, inverse) = numpy.unique(keys, return_inverse=True)
+        if bits == 1 or len(unique) * len(palette) <= budget:
+            break
+        bits -= 1
+    mask = (1 << bits) - 1
+    #centers of the quantized cells
+    centers = (numpy.stack([unique >> (2 * bits), (unique >> bits) & mask,
+                            unique & mask], axis=1) << (8 - bits))\
+        .astype(numpy.float32) + (1 << (8 - bits)) / 2
+    best = numpy.empty(len(unique), dtype=numpy.int64)
+    norms = squared_norms(palette)
+    chunk = chunk or distance_chunk(len(palette))
+    for start in range(0, len(unique), chunk):
+        best[start:start + chunk] = numpy.argmin(squared_distances(
+            centers[start:start + chunk], palette, norms), axis=1)
+    return best[inverse.reshape(-1)]
+
+
+class Preview(object):
+    """Quick, low resolution mosaics of the same sources, for trying out
+    targets, tiles and zoom before rendering for real.
+
+    Sources are only loaded once, as thumbnails ``PREVIEW_TILE_SIZE``
+    pixels wide (JPEG sources are decoded at a reduced scale), and kept
+    per tile ratio -- in `cache_dir` too if given, so later sessions
+    start from them (see ``RenderJob``).  A preview (``mosaic``) then
+    only analyzes the target at ``PREVIEW_CELL_SIZE`` pixels per tile
+    and matches its colors approximately (see ``approximate_match``):
+    the colors of the target are coarsened until matching them costs
+    less than ``APPROXIMATE_BUDGET`` distances, so a preview takes a
+    fraction of a second even for noisy targets and 100k sources.
+
+    Once the settings are good, ``render`` refines the same lattice into
+    the full mosaic: tiles are matched exactly against the colors of the
+    thumbnails, and only the sources actually used are loaded at full
+    size.
+
+    Options are the ones of ``mosaicify``.
 
-    m = Mosaic(mosaic, zip(rectangles,
-                           map(source_tiles.get,
-                               best_matching_imgs)))
-            
-    return m
+    """
+
+    def __init__(self, sources, store=None, exclude=None, dedup=False,
+                 cache_dir=None):
+        if exclude:
+            sources = [s for s in sources if s not in exclude]
+        self.sources = sorted(sources)
+        self.store = store
+        self.dedup = dedup
+        self.cache_dir = cache_dir
+        #thumbnail size: (SourceTable, duplicates)
+        self._thumbnails = {}
+
+    def _lattice(self, target, tiles=None, zoom=1, output_size=None,
+                 memory_budget=None):
+        size = open_image(target).size
+        grid = target_lattice(size, len(self.sources), tiles)
+        return (grid, zoomed_tile_size(size, grid, zoom, output_size,
+                                       memory_budget))
+
+    def thumbnails(self, ratio):
+        """Return the thumbnails (``SourceTable``) of the sources for
+        tiles of `ratio` (width / height), and the duplicates dropped."""
+        size = (PREVIEW_TILE_SIZE,
+                max(1, int(round(PREVIEW_TILE_SIZE / ratio))))
+        if size not in self._thumbnails:
+            job = None
+            if self.cache_dir is not None:
+                job = RenderJob(os.path.join(self.cache_dir,
+                                             'thumbnails-%dx%d' % size),
+                                sources=self.sources, store=self.store,
+                                dedup=self.dedup)
+            loaded = job.load_table() if job is not None else None
+            if loaded is None:
+                workers = multiprocessing.cpu_count()
+                pool = multiprocessing.Pool(workers)
+                try:
+                    table = load_raw_tiles(self.sources, size[0] / size[1],
+                                           size, pool, workers,
+                                           store=self.store,
+                                           fingerprint=self.dedup)
+                finally:
+                    pool.close()
+                    pool.join()
+                loaded = (table, {})
+                if self.dedup:
+                    loaded = collapse_duplicates(table)
+                if job is not None:
+                    job.save_table(*loaded)
+            self._thumbnails[size] = loaded
+        return self._thumbnails[size]
+
+    def mosaic(self, target, tiles=None, zoom=1, output_size=None,
+               memory_budget=None, opacity=0, correction=0):
+        """Return a preview of the mosaic of `target`, made of the
+        thumbnails.  Its layout has the lattice and tile size the full
+        render would have, and ``preview`` set."""
+        ((tiles_x, tiles_y), tile_size) = self._lattice(
+            target, tiles, zoom, output_size, memory_budget)
+        (table, duplicates) = self.thumbnails(tile_size[0] / tile_size[1])
+        target_colors = grid_colors(
+            load_target(target, tiles_x, tiles_y, PREVIEW_CELL_SIZE),
+            tiles_x, tiles_y)
+        rows = approximate_match(table.colors, target_colors)
+        mosaic = _mosaic(table, target, (tiles_x, tiles_y),
+                         table.tile_size, rows, target_colors, duplicates,
+                         opacity, correction)
+        mosaic.layout.update(preview=True, tile_size=tile_size)
+        return mosaic
+
+    def render(self, target, tiles=None, zoom=1, output_size=None,
+               memory_budget=None, opacity=0, correction=0):
+        """Return the full mosaic of `target`, as ``mosaicify`` would,
+        out of the thumbnails already loaded."""
+        ((tiles_x, tiles_y), tile_size) = self._lattice(
+            target, tiles, zoom, output_size, memory_budget)
+        (table, duplicates) = self.thumbnails(tile_size[0] / tile_size[1])
+        target_colors = grid_colors(load_target(target, tiles_x, tiles_y),
+                                    tiles_x, tiles_y)
+        rows = ImageList(table.colors).match(target_colors)
+        (full, (indices,)) = load_matched(
+            [[table.filename(row) for row in rows]], tile_size,
+            store=self.store)
+        return _mosaic(full, target, (tiles_x, tiles_y), tile_size, indices,
+                       target_colors, duplicates, opacity, correction)
+
+
+def mosaicify_preview(targets, sources, tiles=None, zoom=1, store=None,
+                      exclude=None, dedup=False, output_size=None,
+                      memory_budget=None, opacity=0, correction=0,
+                      cache_dir=None):
+    """Return a preview (see ``Preview``) of the mosaic of each target.
+
+    Options are the ones of ``mosaicify_batch``; the thumbnails of the
+    sources are kept in `cache_dir`, if given, for the next previews.
+
+    """
+    preview = Preview(sources, store=store, exclude=exclude, dedup=dedup,
+                      cache_dir=cache_dir)
+    return [preview.mosaic(target, tiles=tiles, zoom=zoom,
+                           output_size=output_size,
+                           memory_budget=memory_budget, opacity=opacity,
+                           correction=correction)
+            for target in targets]
 
 
 def _build_parser():
     """Return a command-line arguments parser."""
-    usage = "Usage: %prog [-t TILES] [-z ZOOM] [-o OUTPUT] IMAGE1 ..."
+    usage = "Usage: %prog [-t TILES] [-z ZOOM] [-p] [-o OUTPUT] IMAGE1 ...\n" \
+            "       %prog -T TARGET [-T TARGET ...] [-o OUTPUT] IMAGE1 ...\n" \
+            "       %prog -F FRAMES_DIR -o OUTPUT_{name}.jpg IMAGE1 ...\n" \
+            "       %prog index [--thumbnails PIXELS] INDEX SOURCE_DIR|IMAGE " \
+            "...\n" \
+            "       %prog render INDEX [-T TARGET ...] [-o OUTPUT] TARGET ..."
     parser = OptionParser(usage=usage)
 
     config = OptionGroup(parser, "Configuration Options")
@@ -572,12 +1555,65 @@ def _build_parser():
                       help="Number of tiles per side -- defaults to maxing # by sources.", metavar="TILES")
     config.add_option("-z", "--zoom", dest="zoom", default="1",
                       help="Zoom level of the mosaic.", metavar="ZOOM")
+    config.add_option("--max-size", dest="max_size", default=None,
+                      help="Maximum WIDTHxHEIGHT of the mosaic (lowers "
+                      "the zoom if needed).", metavar="SIZE")
+    config.add_option("--memory", dest="memory", default=None,
+                      help="Maximum memory for the mosaic image, in MB "
+                      "(lowers the zoom if needed).", metavar="MB")
+    config.add_option("--opacity", dest="opacity", default="0",
+                      help="blend the target over the mosaic with this "
+                      "opacity (0 to 1)", metavar="OPACITY")
+    config.add_option("--correction", dest="correction", default="0",
+                      help="shift the colors of the tiles towards the "
+                      "target by this much (0 to 1)", metavar="STRENGTH")
+    config.add_option("-T", "--target", dest="targets", default=[],
+                      action="append",
+                      help="target image (repeat for a mosaic of each, out "
+                      "of the same sources); all IMAGEs are then sources",
+                      metavar="TARGET")
+    config.add_option("--job", dest="job_dir", default=None,
+                      help="keep the progress of the render in this "
+                      "directory, to resume it if it gets interrupted",
+                      metavar="DIRECTORY")
+    config.add_option("-F", "--frames", dest="frames", default=None,
+                      help="make a mosaic of each image of this directory "
+                      "(e.g. video frames), keeping tiles from one frame to "
+                      "the next; all IMAGEs are then sources",
+                      metavar="DIRECTORY")
+    config.add_option("--threshold", dest="threshold", default="16",
+                      help="with --frames, color change (RGB distance) "
+                      "after which a tile is matched again",
+                      metavar="DISTANCE")
+    config.add_option("-p", "--preview", dest="preview", default=False,
+                      action="store_true",
+                      help="quickly render a low resolution preview (the "
+                      "thumbnails of the sources are kept in the --job "
+                      "DIRECTORY, for the next previews)")
     config.add_option("-o", "--output", dest="output", default=None,
-                      help="Save output instead of showing it.",
+                      help="Save output instead of showing it ({name} is "
+                      "replaced by the target name).",
                       metavar="OUTPUT")
+    config.add_option("-O", "--extra-output", dest="outputs", default=[],
+                      action="append",
+                      help="also save the mosaic as OUTPUT[:SCALE|WxH"
+                      "[:QUALITY]], e.g. web.jpg:1200x1200:85 (repeatable, "
+                      "{name} is replaced by the target name)",
+                      metavar="SPEC")
     config.add_option("-j", "--json", dest="jsonfile", default=None,
-                      help="output file for json data on rectangles",
+                      help="output file for json data on rectangles "
+                      "({name} is replaced by the target name)",
                       metavar="JSON")
+    config.add_option("-s", "--store", dest="store", default=None,
+                      help="read source images from a packed tile store "
+                      "(sources are ids inside it -- defaults to all of them)",
+                      metavar="STORE")
+    config.add_option("-x", "--exclude", dest="exclude", default=None,
+                      help="file listing sources not to use, one per line",
+                      metavar="EXCLUDE")
+    config.add_option("-d", "--dedup", dest="dedup", default=False,
+                      action="store_true",
+                      help="use only one of near-identical source images")
     parser.add_option_group(config)
 
     return parser
@@ -585,25 +1621,133 @@ def _build_parser():
 
 def _main():
     """Run the command-line interface."""
+    if sys.argv[1:2] == ['index']:
+        import sourceindex
+        return sourceindex._main(sys.argv[2:],
+                                 prog='%s index' % sys.argv[0])
     parser = _build_parser()
     (options, args) = parser.parse_args()
 
-    if not args:
+    #with an index (see sourceindex), all IMAGEs are targets
+    index = None
+    if args[:1] == ['render']:
+        if len(args) < 2:
+            parser.error("render needs an INDEX")
+        import sourceindex
+        index = sourceindex.SourceIndex(args[1])
+        (options.targets, args) = (options.targets + args[2:], [])
+        if not (options.targets or options.frames):
+            parser.error("render needs a TARGET")
+
+    if not args and not ((options.targets or options.frames)
+                         and (options.store or index is not None)):
         parser.print_help()
         exit(1)
 
-    mosaic = mosaicify(
-        target=args[0],
-        sources=set(args[1:] or args),
-        tiles=options.tiles,
-        zoom=int(options.zoom),
-        jsonfile=options.jsonfile
-    )
-
-    if options.output is None:
-        mosaic.show()
+    if options.frames:
+        targets = sorted(os.path.join(options.frames, name)
+                         for name in os.listdir(options.frames)
+                         if name.rsplit('.', 1)[-1].lower()
+                         in ('jpg', 'jpeg', 'png'))
+        sources = args
+    elif options.targets:
+        (targets, sources) = (options.targets, args)
+    else:
+        (targets, sources) = (args[:1], args[1:])
+    if index is not None:
+        sources = []
+    elif options.store and not sources:
+        with TileStore(options.store) as store:
+            sources = store.ids()
+    sources = sources or args
+    for path in [options.output, options.jsonfile] + options.outputs:
+        if len(targets) > 1 and path and '{name}' not in path:
+            parser.error("%s would be overwritten by each target: add "
+                         "{name} to it" % path)
+
+    exclude = None
+    if options.exclude:
+        with open(options.exclude) as f:
+            exclude = set(line.strip() for line in f if line.strip())
+
+    output_size = (tuple(int(v) for v in options.max_size.split('x'))
+                   if options.max_size else None)
+    memory_budget = (float(options.memory) * 2 ** 20
+                     if options.memory else None)
+    (store, dedup) = (options.store, options.dedup)
+    if index is not None:
+        #known from the index: duplicates aren't even loaded
+        duplicates = index.duplicates() if dedup else {}
+        (dedup, exclude) = (False, set(duplicates) | (exclude or set()))
+        sources = [key for key in index.ids() if key not in exclude]
+        #the tiles of the first target, as mosaicify_batch sizes them
+        size = open_image(targets[0]).size
+        tile_size = zoomed_tile_size(
+            size, target_lattice(size, len(sources), options.tiles),
+            float(options.zoom), output_size, memory_budget)
+        store = index.store_for(tile_size) or store
+
+    if options.preview:
+        (create, extra) = (mosaicify_preview, {'cache_dir': options.job_dir})
+    elif options.frames:
+        (create, extra) = (mosaicify_frames,
+                           {'threshold': float(options.threshold)})
     else:
-        mosaic.save(options.output)
+        (create, extra) = (mosaicify_batch, {'job_dir': options.job_dir})
+    if index is not None and create is mosaicify_batch:
+        #matched against the colors of the index: only the sources
+        #used are loaded
+        mosaics = mosaicify_index(
+            targets,
+            dict((key, index.entries[key]['color']) for key in sources),
+            tiles=options.tiles,
+            zoom=float(options.zoom),
+            store=store,
+            duplicates=duplicates,
+            output_size=output_size,
+            memory_budget=memory_budget,
+            opacity=float(options.opacity),
+            correction=float(options.correction),
+            job_dir=options.job_dir
+        )
+    else:
+        mosaics = create(
+            targets,
+            sources=set(sources),
+            tiles=options.tiles,
+            zoom=float(options.zoom),
+            output_size=output_size,
+            memory_budget=memory_budget,
+            store=store,
+            exclude=exclude,
+            dedup=dedup,
+            opacity=float(options.opacity),
+            correction=float(options.correction),
+            **extra
+        )
+
+    for (target, mosaic) in zip(targets, mosaics):
+        name = os.path.splitext(os.path.basename(target))[0]
+        if options.jsonfile:
+            with open(options.jsonfile.replace('{name}', name), 'w') as jf:
+                jf.write(json.dumps(mosaic.layout))
+        specs = [OutputSpec.parse(spec.replace('{name}', name))
+                 for spec in options.outputs]
+        if options.output is not None:
+            specs.insert(0, OutputSpec(options.output.replace('{name}', name)))
+        if not specs:
+            mosaic.show()
+        elif options.job_dir and not options.preview:
+            #skip the outputs saved before being interrupted
+            job = RenderJob(os.path.join(options.job_dir, 'outputs', name),
+                            specs=specs, layout=mosaic.layout)
+            pending = [i for i in range(len(specs))
+                       if not job.done('output-%d' % i)]
+            mosaic.save_all([specs[i] for i in pending])
+            for i in pending:
+                job.mark_done('output-%d' % i)
+        else:
+            mosaic.save_all(specs)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""Sharded rendering of large mosaics, into Deep Zoom pyramids.
+
+A print sized mosaic doesn't fit in memory as one image, let alone its
+tiles at full size: ``Mosaic.save`` is out of the question.  Instead,
+the mosaic is matched as usual at a small zoom (only the colors matter
+for matching), and its layout -- what ``mosaicify`` dumps to json -- is
+rendered here at any tile size, region by region.
+
+The mosaic is split in square regions of `region_size` pixels, aligned
+on the tiles of the pyramid.  Each region is rendered on its own: the
+sources it covers are loaded and resized, then the region is cut into
+the tiles of the deepest level of the pyramid.  Regions are independent
+jobs (``render_region`` only needs the layout, a shared directory and
+the sources), run by the workers of a pool.  The upper levels are then
+built level by level, each tile out of its (at most four) children.
+Nothing larger than a region is ever held in memory.
+
+The output is a Deep Zoom image (``<name>.dzi`` plus a ``<name>_files``
+directory), which OpenSeadragon and friends display directly:
+
+    python osaic.py -z 0.1 -j layout.json -o preview.jpg target.jpg images2/*
+    python pyramid.py layout.json print.dzi --tile-size 200x200
+
+"""
+
+from __future__ import division
+import json
+import math
+import multiprocessing
+import os
+import shutil
+from functools import partial
+from optparse import OptionParser
+
+import numpy
+from PIL import Image
+
+import osaic
+from tilestore import TileStore
+
+#Side of the tiles of the pyramid, in pixels
+TILE_SIZE = 256
+
+DZI_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                'TileSize="%(tile_size)d" Overlap="0" Format="%(format)s">'
+                '<Size Width="%(width)d" Height="%(height)d"/></Image>\n')
+
+
+def levels(width, height):
+    """Return the number of levels of the pyramid of an image.
+    >>> levels(1000, 600)
+    11
+    """
+    return int(math.ceil(math.log(max(width, height), 2))) + 1
+
+
+def level_size(width, height, level, top):
+    """Return the size of `level`, `top` being the deepest level.
+    >>> level_size(1000, 600, 9, 10)
+    (500, 300)
+    """
+    scale = 2 ** (top - level)
+    return (int(math.ceil(width / scale)), int(math.ceil(height / scale)))
+
+
+def tile_path(directory, level, column, row, format):
+    return os.path.join(directory, str(level),
+                        '%d_%d.%s' % (column, row, format))
+
+
+def save_tile(image, path):
+    #written aside then renamed: a tile that is there is complete
+    image.save(path + '.tmp', 'JPEG' if path.endswith('.jpg') else None)
+    os.rename(path + '.tmp', path)
+
+
+def regions(width, height, region_size):
+    """Split a `width` x `height` image in boxes of at most `region_size`
+    pixels per side (a multiple of ``TILE_SIZE``).
+    >>> list(regions(600, 300, 512))
+    [(0, 0, 512, 300), (512, 0, 600, 300)]
+    """
+    region_size = max(TILE_SIZE, region_size // TILE_SIZE * TILE_SIZE)
+    for top in range(0, height, region_size):
+        for left in range(0, width, region_size):
+            yield (left, top, min(width, left + region_size),
+                   min(height, top + region_size))
+
+
+def mosaic_size(layout, tile_size):
+    """Return the size of the mosaic of `layout` with tiles of
+    `tile_size` (width, height).
+    >>> mosaic_size({'tiles_x': 4, 'tiles_y': 2}, (150, 100))
+    (600, 200)
+    """
+    return (layout['tiles_x'] * tile_size[0],
+            layout['tiles_y'] * tile_size[1])
+
+
+_overlays = {}
+
+
+def _overlay(target, opacity, size):
+    #the target is decoded once per worker, not once per region
+    key = (target, opacity, size)
+    if key not in _overlays:
+        _overlays[key] = osaic.Overlay(target, opacity, size)
+    return _overlays[key]
+
+
+def render_region(job, layout, tile_size, directory, format='jpg',
+                  store=None, opacity=0, correction=0):
+    """Render the `job` box (left, top, right, bottom) of the mosaic of
+    `layout`, and save it as tiles of the deepest level of the pyramid
+    inside `directory`.  With an `opacity`, the target of the layout is
+    blended over the region; with a `correction`, the colors of the tiles
+    are shifted towards the target (see ``osaic.Mosaic``).  Return the
+    box and the number of tiles saved."""
+    (left, top, right, bottom) = job
+    (width, height) = mosaic_size(layout, tile_size)
+    (tile_width, tile_height) = tile_size
+    tiles_x = layout['tiles_x']
+    #only the cells of the lattice the region covers
+    columns = range(left // tile_width,
+                    min(tiles_x, -(-right // tile_width)))
+    rows = range(top // tile_height,
+                 min(layout['tiles_y'], -(-bottom // tile_height)))
+    cells = [row * tiles_x + column for row in rows for column in columns]
+    filenames = [layout['best_matching'][cell] for cell in cells]
+    used = sorted(set(filename for filename in filenames
+                      if filename is not None))
+    #the last row of the atlas is left black for cells without a source
+    atlas = numpy.zeros((len(used) + 1, tile_height, tile_width, 3),
+                        dtype=numpy.uint8)
+    colors = numpy.zeros((len(used) + 1, 3))
+    if store is not None:
+        store = TileStore(store)
+    try:
+        for (row, filename) in enumerate(used):
+            img = osaic.ImageWrapper(filename=filename, store=store,
+                                     draft=tile_size, average_color=False)
+            img.reratio(tile_width / tile_height)
+            img.resize(tile_size)
+            atlas[row] = numpy.asarray(img.blob.convert('RGB'))
+            colors[row] = osaic.average_color(img)
+    finally:
+        if store is not None:
+            store.close()
+    rows_of = dict((filename, row) for (row, filename) in enumerate(used))
+    indices = numpy.array([rows_of.get(filename, len(used))
+                           for filename in filenames], dtype=numpy.int64)
+
+    shifts = None
+    if correction:
+        target_colors = [layout['target_colors'][cell] for cell in cells]
+        shifts = osaic.color_shifts(colors[indices], target_colors,
+                                    correction)
+        shifts[indices == len(used)] = 0
+    overlay = None
+    if opacity:
+        overlay = _overlay(layout['target'], opacity, (width, height))
+    origin = (columns[0] * tile_width, rows[0] * tile_height)
+    region = osaic._assemble(atlas, indices, (len(columns), len(rows)),
+                             overlay, shifts, origin, (width, height))
+    region = region.crop((left - origin[0], top - origin[1],
+                          right - origin[0], bottom - origin[1]))
+
+    level = levels(width, height) - 1
+    count = 0
+    for y in range(top, bottom, TILE_SIZE):
+        for x in range(left, right, TILE_SIZE):
+            box = (x - left, y - top, min(right, x + TILE_SIZE) - left,
+                   min(bottom, y + TILE_SIZE) - top)
+            save_tile(region.crop(box), tile_path(directory, level,
+                                                  x // TILE_SIZE,
+                                                  y // TILE_SIZE, format))
+            count += 1
+    return (job, count)
+
+
+def reduce_tile(job, directory, format='jpg'):
+    """Build the `job` (level, column, row, width, height) tile of the
+    pyramid inside `directory`, out of its children in the level below."""
+    (level, column, row, width, height) = job
+    path = tile_path(directory, level, column, row, format)
+    if os.path.exists(path):
+        #done before the render was interrupted
+        return
+    children = Image.new('RGB', (width * 2, height * 2))
+    (right, bottom) = (0, 0)
+    for (dx, dy) in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        child_path = tile_path(directory, level + 1, column * 2 + dx,
+                               row * 2 + dy, format)
+        if os.path.exists(child_path):
+            child = Image.open(child_path)
+            children.paste(child, (dx * TILE_SIZE, dy * TILE_SIZE))
+            right = max(right, dx * TILE_SIZE + child.size[0])
+            bottom = max(bottom, dy * TILE_SIZE + child.size[1])
+    save_tile(children.crop((0, 0, right, bottom)).resize(
+        (width, height), Image.LANCZOS), path)
+
+
+def render_pyramid(layout, destination, tile_size, store=None,
+                   region_size=4096, pool=None, workers=None, opacity=0,
+                   correction=0):
+    """Render the mosaic of `layout` as a Deep Zoom image at
+    `destination` (``<name>.dzi``), with tiles of `tile_size` (width,
+    height), and the target blended over it with `opacity`; tiles are
+    shifted towards the colors of the target by `correction`.
+
+    Regions are rendered by `pool` (anything with ``imap_unordered``, by
+    default a process pool of `workers`).  Return the size of the image.
+
+    Progress is kept inside the pyramid directory (see
+    ``osaic.RenderJob``): rendering the same layout again after being
+    interrupted only renders the regions and levels that are missing.
+
+    """
+    format = 'jpg'
+    (width, height) = mosaic_size(layout, tile_size)
+    directory = os.path.splitext(destination)[0] + '_files'
+    top = levels(width, height) - 1
+    job = osaic.RenderJob(os.path.join(directory, 'job'), layout=layout,
+                          tile_size=tile_size, opacity=opacity,
+                          correction=correction,
+                          region_size=region_size, format=format)
+    for level in range(top + 1):
+        path = os.path.join(directory, str(level))
+        if not job.resumed and os.path.isdir(path):
+            #tiles of another mosaic
+            shutil.rmtree(path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    try:
+        #the deepest level, region by region
+        pending = [box for box in regions(width, height, region_size)
+                   if not job.done('region-%d-%d' % box[:2])]
+        for (box, count) in pool.imap_unordered(
+                partial(render_region, layout=layout, tile_size=tile_size,
+                        directory=directory, format=format, store=store,
+                        opacity=opacity, correction=correction), pending):
+            job.mark_done('region-%d-%d' % box[:2])
+        #then each level out of the one below
+        for level in range(top - 1, -1, -1):
+            if job.done('level-%d' % level):
+                continue
+            (level_width, level_height) = level_size(width, height,
+                                                     level, top)
+            tiles = [(level, column, row,
+                     min(TILE_SIZE, level_width - column * TILE_SIZE),
+                     min(TILE_SIZE, level_height - row * TILE_SIZE))
+                    for row in range(int(math.ceil(level_height / TILE_SIZE)))
+                    for column in range(
+                        int(math.ceil(level_width / TILE_SIZE)))]
+            for tile in pool.imap_unordered(
+                    partial(reduce_tile, directory=directory, format=format),
+                    tiles, chunksize=16):
+                pass
+            job.mark_done('level-%d' % level)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    with open(destination, 'w') as f:
+        f.write(DZI_TEMPLATE % {'tile_size': TILE_SIZE, 'format': format,
+                                'width': width, 'height': height})
+    return (width, height)
+
+
+def _main():
+    parser = OptionParser(usage="Usage: %prog [options] LAYOUT.json "
+                          "OUTPUT.dzi")
+    parser.add_option("--tile-size", dest="tile_size", default=None,
+                      help="WIDTHxHEIGHT of the tiles of the mosaic "
+                      "(defaults to the size in the layout)", metavar="SIZE")
+    parser.add_option("-s", "--store", dest="store", default=None,
+                      help="read source images from a packed tile store",
+                      metavar="STORE")
+    parser.add_option("--region-size", dest="region_size", default="4096",
+                      help="side of the regions rendered by each job, in "
+                      "pixels", metavar="PIXELS")
+    parser.add_option("--opacity", dest="opacity", default="0",
+                      help="blend the target over the mosaic with this "
+                      "opacity (0 to 1)", metavar="OPACITY")
+    parser.add_option("--correction", dest="correction", default="0",
+                      help="shift the colors of the tiles towards the "
+                      "target by this much (0 to 1)", metavar="STRENGTH")
+    parser.add_option("-w", "--workers", dest="workers", default=None,
+                      help="number of worker processes", metavar="N")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_help()
+        exit(1)
+
+    with open(args[0]) as f:
+        layout = json.load(f)
+    if options.tile_size:
+        tile_size = tuple(int(v) for v in options.tile_size.split('x'))
+    else:
+        tile_size = (layout['width'] // layout['tiles_x'],
+                     layout['height'] // layout['tiles_y'])
+    size = render_pyramid(layout, args[1], tile_size, store=options.store,
+                          region_size=int(options.region_size),
+                          workers=int(options.workers or 0) or None,
+                          opacity=float(options.opacity),
+                          correction=float(options.correction))
+    print('rendered %dx%d' % size)
+
+
+if __name__ == '__main__':
+    _main()
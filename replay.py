@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""Local stand-in for the twitter stream/search apis, for load testing.
+
+Serves, over plain http:
+
+    POST|GET /1.1/statuses/filter.json   line-delimited stream of tweets
+    GET      /1.1/search/tweets.json     pages of past tweets (max_id)
+    GET      /avatars/<user id>/<tweet id>.<ext>
+                                         the avatar of a served tweet
+
+Tweets are either synthetic or replayed from a file of recorded tweet
+json (one per line, e.g. what hack.py prints); avatars either come from
+a directory of collected images named <user_id>.<ext> (like images2/)
+or are generated.  Every served tweet gets a fresh, increasing id and
+points its profile_image_url at this server, so the time between
+streaming a tweet and the collector fetching its avatar -- the last step
+of ingesting it -- measures the end-to-end lag.  Ingest throughput and
+lag are reported periodically and when the server is stopped.
+
+The stream rate is `--rate` tweets per second, with optional bursts:
+
+    python replay.py --rate 20 --burst 2000:10:60
+
+streams 20 tweets/s, going up to 2000/s for 10 seconds every minute
+(overlapping bursts add up).  Tweets are paced by the time elapsed since
+the stream started: a slow write is caught up by the next ones.  A
+backfill run (a search without max_id) gets `--search-pages` pages.
+Point the collector at it with, e.g.:
+
+    manage.py run_collector 1 --stream-url http://localhost:8765/1.1/statuses/filter.json
+
+or ``replay_url = 'http://localhost:8765'`` in hack.py's settings.
+
+"""
+
+from __future__ import division
+import io
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+
+def percentile(values, fraction):
+    """Return the value at `fraction` of the sorted `values`.
+    >>> percentile([3, 1, 2, 4], 0.5)
+    3
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def rate_at(elapsed, rate, bursts):
+    """Return the tweets/second rate `elapsed` seconds into the stream.
+    >>> rate_at(5, 10, [(1000, 10, 60)])
+    1000
+    >>> rate_at(15, 10, [(1000, 10, 60)])
+    10
+    """
+    extra = 0
+    for (burst_rate, duration, every) in bursts:
+        if elapsed % every < duration:
+            extra += max(0, burst_rate - rate)
+    return rate + extra
+
+
+def tweets_due(elapsed, rate, bursts):
+    """Return the number of tweets streamed `elapsed` seconds into the
+    stream: the integral of ``rate_at``.
+    >>> tweets_due(70.0, 10, [(1000, 10, 60)])
+    20500.0
+    """
+    due = rate * elapsed
+    for (burst_rate, duration, every) in bursts:
+        bursting = (elapsed // every) * duration + \
+            min(elapsed % every, duration)
+        due += max(0, burst_rate - rate) * bursting
+    return due
+
+
+class Metrics(object):
+    """Emission time of every served tweet, and when its avatar was
+    fetched."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._emitted = {}
+        self.emitted = 0
+        self.fetched = 0
+        self._lags = []
+        self._all_lags = []
+        self._last_report = (time.time(), 0)
+
+    def emit(self, tweet_id):
+        with self._lock:
+            self._emitted[tweet_id] = time.time()
+            self.emitted += 1
+
+    def fetch(self, tweet_id):
+        with self._lock:
+            emitted_at = self._emitted.pop(tweet_id, None)
+            if emitted_at is not None:
+                self.fetched += 1
+                self._lags.append(time.time() - emitted_at)
+
+    def report(self):
+        with self._lock:
+            (now, (then, fetched)) = (time.time(), self._last_report)
+            lags, self._lags = self._lags, []
+            self._all_lags.extend(lags)
+            self._last_report = (now, self.fetched)
+            backlog = len(self._emitted)
+            throughput = (self.fetched - fetched) / max(now - then, 1e-6)
+        return ('emitted %d ingested %d backlog %d | %.1f tweets/s | '
+                'lag p50 %.3fs p95 %.3fs max %.3fs'
+                % (self.emitted, self.fetched, backlog, throughput,
+                   percentile(lags, 0.5), percentile(lags, 0.95),
+                   max(lags or [0])))
+
+    def summary(self):
+        self.report()
+        lags = self._all_lags
+        return ('total: emitted %d ingested %d | lag p50 %.3fs p95 %.3fs '
+                'p99 %.3fs max %.3fs'
+                % (self.emitted, self.fetched, percentile(lags, 0.5),
+                   percentile(lags, 0.95), percentile(lags, 0.99),
+                   max(lags or [0])))
+
+
+class TweetSource(object):
+    """Produces the tweets to serve: recorded ones in a loop, or
+    synthetic ones."""
+
+    def __init__(self, recorded=None, users=5000, text='#replay test'):
+        self.recorded = recorded
+        self.users = users
+        self.text = text
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._recorded_cycle = itertools.cycle(recorded) if recorded else None
+
+    def next_id(self):
+        #like twitter's: time based, increasing
+        with self._lock:
+            return (int(time.time() * 1000) << 22) \
+                + next(self._sequence) % (1 << 22)
+
+    def tweet(self, base_url, track=None):
+        tweet_id = self.next_id()
+        if self._recorded_cycle is not None:
+            with self._lock:
+                tweet = json.loads(json.dumps(next(self._recorded_cycle)))
+        else:
+            user_id = random.randint(1, self.users)
+            tweet = {'text': '%s %d' % (track or self.text, tweet_id),
+                     'user': {'id': user_id, 'id_str': str(user_id),
+                              'screen_name': 'user%d' % user_id}}
+        user = tweet.setdefault('user', {})
+        ext = (user.get('profile_image_url') or '.jpg').rsplit('.', 1)[-1]
+        user['profile_image_url'] = '%s/avatars/%s/%d.%s' % (
+            base_url, user.get('id', 0), tweet_id, ext)
+        user.pop('profile_image_url_https', None)
+        tweet['id'] = tweet_id
+        tweet['id_str'] = str(tweet_id)
+        tweet['timestamp_ms'] = str(int(time.time() * 1000))
+        return tweet
+
+
+class Avatars(object):
+    """Image bytes for avatars: collected ones by user id, or solid
+    color jpegs."""
+
+    def __init__(self, directory=None, colors=64):
+        self.files = {}
+        if directory:
+            for name in os.listdir(directory):
+                self.files[name.rsplit('.', 1)[0]] = os.path.join(directory,
+                                                                  name)
+        self._generated = []
+        for i in range(colors):
+            out = io.BytesIO()
+            Image.new('RGB', (48, 48),
+                      tuple(random.randint(0, 255) for c in 'rgb'))\
+                 .save(out, 'JPEG')
+            self._generated.append(out.getvalue())
+
+    def get(self, user_id, tweet_id):
+        path = self.files.get(str(user_id))
+        if path:
+            with open(path, 'rb') as f:
+                return f.read()
+        return self._generated[tweet_id % len(self._generated)]
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    @property
+    def base_url(self):
+        return 'http://%s' % (self.headers.get('Host')
+                              or '%s:%d' % self.server.server_address)
+
+    def params(self):
+        query = parse_qs(urlparse(self.path).query)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            query.update(parse_qs(self.rfile.read(length).decode('utf-8')))
+        return dict((k, v[0]) for (k, v) in query.items())
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/1.1/statuses/filter.json':
+            self.stream(self.params())
+        elif path == '/1.1/search/tweets.json':
+            self.search(self.params())
+        elif path.startswith('/avatars/'):
+            self.avatar(path[len('/avatars/'):])
+        else:
+            self.send_error(404)
+
+    do_POST = do_GET
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def avatar(self, name):
+        #the user is in the url: nothing is kept per served tweet
+        try:
+            (user_id, name) = name.split('/')
+            tweet_id = int(name.split('.')[0])
+        except ValueError:
+            return self.send_error(404)
+        self.server.metrics.fetch(tweet_id)
+        self.send_body('image/jpeg', self.server.avatars.get(user_id,
+                                                              tweet_id))
+
+    def _tweet(self, track):
+        tweet = self.server.tweets.tweet(self.base_url, track)
+        self.server.metrics.emit(tweet['id'])
+        return tweet
+
+    def search(self, params):
+        count = min(int(params.get('count', 15)), 100)
+        max_id = params.get('max_id')
+        if max_id is None:
+            #the first page of a new backfill
+            self.server.search_pages = 0
+        self.server.search_pages += 1
+        if self.server.search_pages > self.server.max_search_pages:
+            count = 0
+        statuses = [self._tweet(params.get('q')) for i in range(count)]
+        if max_id is not None:
+            #keep paging backwards, until --search-pages are served
+            for (i, status) in enumerate(statuses):
+                status['id'] = int(max_id) - i
+                status['id_str'] = str(status['id'])
+        self.send_body('application/json', json.dumps({
+            'statuses': statuses,
+            'search_metadata': {'count': len(statuses)},
+        }).encode('utf-8'))
+
+    def stream(self, params):
+        track = params.get('track', '').split(',')[0] or None
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        started = time.time()
+        (sent, last_write) = (0, started)
+        try:
+            while not server.stopping:
+                now = time.time()
+                due = int(tweets_due(now - started, server.rate,
+                                     server.bursts))
+                lines = [json.dumps(self._tweet(track))
+                         for i in range(due - sent)]
+                sent = due
+                if lines:
+                    self.chunk(('\r\n'.join(lines) + '\r\n').encode('utf-8'))
+                    last_write = now
+                elif now - last_write >= 30:
+                    #keep-alive, like twitter
+                    self.chunk(b'\r\n')
+                    last_write = now
+                time.sleep(max(0, server.tick - (time.time() - now)))
+        except (IOError, OSError):
+            #the collector disconnected
+            pass
+
+    def chunk(self, data):
+        self.wfile.write(('%x\r\n' % len(data)).encode('ascii')
+                         + data + b'\r\n')
+        self.wfile.flush()
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tweets, avatars, rate=10, bursts=(),
+                 max_search_pages=15, verbose=False):
+        HTTPServer.__init__(self, address, ReplayHandler)
+        self.tweets = tweets
+        self.avatars = avatars
+        self.rate = rate
+        self.bursts = list(bursts)
+        self.tick = 0.01
+        self.max_search_pages = max_search_pages
+        self.search_pages = 0
+        self.verbose = verbose
+        self.stopping = False
+        self.metrics = Metrics()
+
+
+def _build_parser():
+    """Return a command-line arguments parser."""
+    usage = "Usage: %prog [--rate RATE] [--burst RATE:SECONDS:EVERY] ..."
+    parser = OptionParser(usage=usage)
+    parser.add_option("-p", "--port", dest="port", default="8765",
+                      help="Port to listen on.", metavar="PORT")
+    parser.add_option("-r", "--rate", dest="rate", default="10",
+                      help="Stream tweets per second.", metavar="RATE")
+    parser.add_option("-b", "--burst", dest="bursts", action="append",
+                      default=[], metavar="RATE:SECONDS:EVERY",
+                      help="Go up to RATE tweets/s for SECONDS every EVERY "
+                      "seconds (can be repeated).")
+    parser.add_option("-t", "--tweets", dest="tweets", default=None,
+                      help="File of recorded tweets, one json per line.",
+                      metavar="TWEETS")
+    parser.add_option("-a", "--avatars", dest="avatars", default=None,
+                      help="Directory of avatars named <user_id>.<ext>.",
+                      metavar="DIR")
+    parser.add_option("-u", "--users", dest="users", default="5000",
+                      help="Number of synthetic users.", metavar="USERS")
+    parser.add_option("--search-pages", dest="search_pages", default="15",
+                      help="Search pages served to each backfill before "
+                      "an empty one.",
+                      metavar="PAGES")
+    parser.add_option("--report", dest="report", default="5",
+                      help="Seconds between metrics reports.",
+                      metavar="SECONDS")
+    parser.add_option("-v", "--verbose", dest="verbose",
+                      action="store_true", default=False)
+    return parser
+
+
+def _main():
+    """Run the command-line interface."""
+    parser = _build_parser()
+    (options, args) = parser.parse_args()
+
+    recorded = None
+    if options.tweets:
+        with open(options.tweets) as f:
+            recorded = [json.loads(line) for line in f if line.strip()]
+    server = ReplayServer(('', int(options.port)),
+                          TweetSource(recorded, users=int(options.users)),
+                          Avatars(options.avatars),
+                          rate=float(options.rate),
+                          bursts=[tuple(float(v) for v in b.split(':'))
+                                  for b in options.bursts],
+                          max_search_pages=int(options.search_pages),
+                          verbose=options.verbose)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('replaying on port %s' % options.port)
+    try:
+        while True:
+            time.sleep(float(options.report))
+            print(server.metrics.report())
+    except KeyboardInterrupt:
+        server.stopping = True
+        server.shutdown()
+        print(server.metrics.summary())
+
+
+if __name__ == '__main__':
+    _main()
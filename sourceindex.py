@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""Reusable index of a pool of source images.
+
+Rendering against a pool of sources used to start from a shell glob:
+every render listed the directories, and loaded and hashed every image
+again.  A ``SourceIndex`` is scanned once, and kept up to date by
+scanning only the files that are new or were modified since (by size
+and modification time; a file whose content hash didn't change isn't
+decoded again).  It is a text file, with a header line and one json
+line per image:
+
+    {"version": 1, "thumbnail_size": 128}
+    {"id": "images2/30528628.jpg", "mtime": 1453.2, "bytes": 2510,
+     "sha1": "...", "width": 48, "height": 48, "color": [91, 80, 77],
+     "dhash": "00000000000000ff"}
+
+Images that can't be decoded are kept with an "error" instead, so they
+are neither scanned again nor rendered.  With a `thumbnail_size`, the
+images are also packed as thumbnails (their smaller side that large) in
+a ``TileStore`` next to the index, under the same ids: mosaics whose
+tiles aren't larger than that are rendered out of it, without opening
+the original files at all.  Changing the size packs a new store; once
+more than half of the store is thumbnails of modified or removed images,
+it is compacted.
+
+Rendering from an index matches the tiles against the colors in the
+index, so only the sources a mosaic actually uses are ever loaded (see
+``osaic.mosaicify_index``).
+
+    python osaic.py index --thumbnails 128 images.index images2/
+    python osaic.py render images.index target.jpg -o mosaic.jpg
+
+"""
+
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+from optparse import OptionParser
+
+from PIL import Image, ImageStat
+
+from dedup import HashIndex, dhash, from_hex, to_hex
+import tilestore
+from tilestore import TileStore
+
+VERSION = 1
+EXTENSIONS = ('jpg', 'jpeg', 'png', 'gif')
+#Size the images are decoded at to compute their color and hash
+ANALYSIS_SIZE = (64, 64)
+
+
+def list_sources(paths, extensions=EXTENSIONS):
+    """Return the images of `paths` (files, or directories: their images,
+    not recursively), sorted."""
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            found.update(os.path.join(path, name)
+                         for name in os.listdir(path)
+                         if name.rsplit('.', 1)[-1].lower() in extensions)
+        else:
+            found.add(path)
+    return sorted(found)
+
+
+def _scan(job):
+    """Return the entry of the image (path, stat, previous entry), and
+    its encoded thumbnail (or None)."""
+    (path, (mtime, size), previous, thumbnail_size) = job
+    with open(path, 'rb') as f:
+        data = f.read()
+    sha1 = hashlib.sha1(data).hexdigest()
+    if previous is not None and previous['sha1'] == sha1:
+        #touched, not modified
+        return (dict(previous, mtime=mtime, bytes=size), None)
+    entry = {'id': path, 'mtime': mtime, 'bytes': size, 'sha1': sha1}
+    try:
+        img = Image.open(io.BytesIO(data))
+        (entry['width'], entry['height']) = img.size
+        if thumbnail_size:
+            scale = thumbnail_size / float(min(img.size))
+            thumbnail_dims = (max(1, int(round(img.size[0] * scale))),
+                              max(1, int(round(img.size[1] * scale))))
+            img.draft('RGB', thumbnail_dims)
+        else:
+            img.draft('RGB', ANALYSIS_SIZE)
+        img = img.convert('RGB')
+    except (IOError, ValueError) as e:
+        entry['error'] = str(e) or e.__class__.__name__
+        return (entry, None)
+    entry['color'] = [int(v) for v in ImageStat.Stat(img).mean]
+    entry['dhash'] = to_hex(dhash(img))
+    thumbnail = None
+    if thumbnail_size:
+        if scale < 1:
+            img = img.resize(thumbnail_dims, Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, 'JPEG', quality=90)
+        thumbnail = buf.getvalue()
+    return (entry, thumbnail)
+
+
+class SourceIndex(object):
+    """Entries of the images of a pool, by id (see the module)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.thumbnail_path = path + '.tiles'
+        self.thumbnail_size = None
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                header = json.loads(f.readline())
+                if header.get('version') != VERSION:
+                    raise ValueError('%s: unknown index version' % path)
+                self.thumbnail_size = header.get('thumbnail_size')
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry['id']] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def save(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(json.dumps({'version': VERSION,
+                                'thumbnail_size': self.thumbnail_size})
+                    + '\n')
+            for key in sorted(self.entries):
+                f.write(json.dumps(self.entries[key], sort_keys=True) + '\n')
+        os.rename(temporary, self.path)
+
+    def update(self, paths, thumbnail_size=None, pool=None, workers=None):
+        """Scan the images of `paths` (see ``list_sources``): only new
+        and modified ones are read.  Images no longer there are dropped,
+        the index then covers exactly `paths`.  Return the numbers of
+        images (scanned, removed)."""
+        sources = list_sources(paths)
+        rescan = thumbnail_size != self.thumbnail_size
+        self.thumbnail_size = thumbnail_size
+        jobs = []
+        for path in sources:
+            stat = os.stat(path)
+            previous = self.entries.get(path)
+            if rescan or previous is None or \
+               (previous['mtime'], previous['bytes']) != \
+               (stat.st_mtime, stat.st_size):
+                jobs.append((path, (stat.st_mtime, stat.st_size),
+                             None if rescan else previous, thumbnail_size))
+        removed = set(self.entries) - set(sources)
+        for path in removed:
+            del self.entries[path]
+
+        own_pool = pool is None and len(jobs) > 1
+        if own_pool:
+            pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+        #thumbnails of another size are packed into a new store, which
+        #replaces the old one once the index says so
+        store_path = self.thumbnail_path + ('.tmp' if rescan else '')
+        if rescan:
+            tilestore.remove(store_path)
+        store = TileStore(store_path, mode='a') if thumbnail_size else None
+        try:
+            results = pool.imap_unordered(_scan, jobs, chunksize=16) \
+                if pool is not None else (_scan(job) for job in jobs)
+            for (entry, thumbnail) in results:
+                self.entries[entry['id']] = entry
+                if thumbnail is not None:
+                    store.add(entry['id'], thumbnail)
+            #modified and removed images leave their old thumbnails behind
+            wasted = store is not None and \
+                2 * store.size(self.ids()) < os.path.getsize(store_path)
+        finally:
+            if store is not None:
+                store.close()
+            if own_pool:
+                pool.close()
+                pool.join()
+        self.save()
+        if rescan and thumbnail_size:
+            tilestore.move(store_path, self.thumbnail_path)
+        elif rescan:
+            tilestore.remove(self.thumbnail_path)
+        elif wasted:
+            tilestore.compact(self.thumbnail_path, self.ids())
+        return (len(jobs), len(removed))
+
+    def ids(self):
+        """Return the ids of the images that can be rendered."""
+        return sorted(key for (key, entry) in self.entries.items()
+                      if 'error' not in entry)
+
+    def duplicates(self, max_distance=4):
+        """Return ``{duplicate id: canonical id}`` of the near-identical
+        images, as ``osaic.collapse_duplicates`` would."""
+        index = HashIndex(max_distance)
+        duplicates = {}
+        for key in self.ids():
+            canonical = index.add(from_hex(self.entries[key]['dhash']), key)
+            if canonical != key:
+                duplicates[key] = canonical
+        return duplicates
+
+    def store_for(self, tile_size):
+        """Return the path of the thumbnails, if they are large enough
+        for tiles of `tile_size` (width, height), or None."""
+        if not self.thumbnail_size or \
+           max(tile_size) > self.thumbnail_size:
+            return None
+        return self.thumbnail_path
+
+
+def _main(argv=None, prog=None):
+    parser = OptionParser(usage="Usage: %prog [options] INDEX "
+                          "SOURCE_DIR|IMAGE ...", prog=prog)
+    parser.add_option("--thumbnails", dest="thumbnails", default=None,
+                      help="also pack thumbnails of the images, their "
+                      "smaller side this large (0 for none, defaults to "
+                      "the size of the previous scan)", metavar="PIXELS")
+    parser.add_option("-w", "--workers", dest="workers", default=None,
+                      help="number of worker processes", metavar="N")
+    (options, args) = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.print_help()
+        exit(1)
+
+    index = SourceIndex(args[0])
+    thumbnail_size = index.thumbnail_size
+    if options.thumbnails is not None:
+        thumbnail_size = int(options.thumbnails) or None
+    (scanned, removed) = index.update(
+        args[1:], thumbnail_size=thumbnail_size,
+        workers=int(options.workers or 0) or None)
+    print('scanned %d, removed %d, %d images' % (scanned, removed,
+                                                 len(index.ids())))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,709 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""Tests of the library modules (the Django apps have their own).
+
+    python -m unittest tests
+"""
+
+import doctest
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+import numpy
+from PIL import Image, JpegImagePlugin
+
+import dedup
+import osaic
+import pyramid
+import replay
+import sourceindex
+import tilestore
+
+
+class DoctestTest(unittest.TestCase):
+
+    def test_doctests(self):
+        for module in (dedup, osaic, pyramid, replay, sourceindex,
+                       tilestore):
+            (failed, attempted) = doctest.testmod(module)
+            self.assertEqual(failed, 0, module.__name__)
+
+
+class ImageListTest(unittest.TestCase):
+
+    def test_match_is_search(self):
+        random = numpy.random.RandomState(0)
+        sources = random.randint(0, 256, (500, 3))
+        targets = random.uniform(0, 255, (1200, 3))
+        searched = osaic.ImageList(sources)
+        expected = [searched.search(color) for color in targets]
+        for chunk in (None, 1, 7):
+            self.assertEqual(
+                osaic.ImageList(sources).match(targets, chunk).tolist(),
+                expected)
+        #each source once, until all of them have been used
+        self.assertEqual(sorted(expected[:500]), list(range(500)))
+
+    def test_approximate_match(self):
+        random = numpy.random.RandomState(0)
+        sources = random.randint(0, 256, (300, 3))
+        targets = random.uniform(0, 255, (2000, 3))
+        rows = osaic.approximate_match(sources, targets)
+        self.assertEqual(osaic.approximate_match(sources, targets, chunk=7)
+                         .tolist(), rows.tolist())
+        #the nearest source of the center of each quantized color
+        centers = (targets.astype(int) >> 3 << 3) + 4
+        nearest = numpy.argmin(((sources[None, :, :] - centers[:, None, :])
+                                ** 2).sum(axis=2), axis=1)
+        self.assertEqual(rows.tolist(), nearest.tolist())
+        self.assertEqual(osaic.approximate_match([], targets[:3]).tolist(),
+                         [-1, -1, -1])
+
+    def test_approximate_budget(self):
+        random = numpy.random.RandomState(0)
+        computed = []
+
+        def squared_distances(colors, palette, palette_norms=None):
+            computed.append(len(colors) * len(palette))
+            return distances(colors, palette, palette_norms)
+        distances = osaic.squared_distances
+        #noisy targets have about as many distinct colors as tiles
+        targets = random.randint(0, 256, (15000, 3))
+        with mock.patch.object(osaic, 'squared_distances',
+                               squared_distances):
+            for count in (1000, 10 ** 5):
+                del computed[:]
+                osaic.approximate_match(random.randint(0, 256, (count, 3)),
+                                        targets)
+                self.assertLessEqual(sum(computed), osaic.APPROXIMATE_BUDGET)
+            #colors are coarsened until they fit
+            del computed[:]
+            sources = random.randint(0, 256, (5000, 3))
+            rows = osaic.approximate_match(sources, targets, budget=10 ** 6)
+            self.assertEqual(sum(computed), 64 * 5000)
+        (targets, rows) = (targets[:200], rows[:200])
+        centers = (targets >> 6 << 6) + 32
+        nearest = numpy.argmin(((sources[None, :, :] - centers[:, None, :])
+                                ** 2).sum(axis=2), axis=1)
+        self.assertEqual(rows.tolist(), nearest.tolist())
+
+    def test_distance_chunk(self):
+        self.assertEqual(osaic.distance_chunk(0), osaic.DISTANCE_BUDGET // 8)
+        self.assertEqual(osaic.distance_chunk(10 ** 9), 1)
+        self.assertLessEqual(osaic.distance_chunk(10 ** 5) * 10 ** 5 * 8,
+                             osaic.DISTANCE_BUDGET)
+
+
+class SerialPool(object):
+    "Stands in for a process pool, failing after `fail_after` results"
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.jobs = []
+
+    def imap_unordered(self, func, jobs, chunksize=1):
+        for job in jobs:
+            if len(self.jobs) == self.fail_after:
+                raise KeyboardInterrupt('killed')
+            self.jobs.append(job)
+            yield func(job)
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+
+class TileStoreTest(TemporaryDirectoryTestCase):
+
+    def test_round_trip(self):
+        with tilestore.TileStore(self.path('tiles'), mode='a') as store:
+            store.add('a.jpg', b'first')
+            store.add('b.jpg', b'second')
+            self.assertEqual(store.get('a.jpg'), b'first')
+        with tilestore.TileStore(self.path('tiles')) as store:
+            self.assertEqual(store.ids(), ['a.jpg', 'b.jpg'])
+            self.assertEqual(dict(store.items()),
+                             {'a.jpg': b'first', 'b.jpg': b'second'})
+            self.assertEqual(store.open('b.jpg').read(), b'second')
+            self.assertRaises(KeyError, store.get, 'c.jpg')
+            self.assertRaises(IOError, store.add, 'c.jpg', b'third')
+
+    def test_last_entry_wins(self):
+        with tilestore.TileStore(self.path('tiles'), mode='a') as store:
+            store.add('a.jpg', b'old')
+            store.add('b.jpg', b'other')
+            store.add('a.jpg', b'new')
+        with tilestore.TileStore(self.path('tiles')) as store:
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store.get('a.jpg'), b'new')
+            #in data file order: the new bytes come last
+            self.assertEqual(store.ids(), ['b.jpg', 'a.jpg'])
+        self.assertEqual(tilestore.compact(self.path('tiles')), len(b'old'))
+        with tilestore.TileStore(self.path('tiles')) as store:
+            self.assertEqual(dict(store.items()),
+                             {'a.jpg': b'new', 'b.jpg': b'other'})
+
+    def test_move(self):
+        with tilestore.TileStore(self.path('new.tiles'), mode='a') as store:
+            store.add('a.png', b'new')
+        with mock.patch.object(tilestore.os, 'rename',
+                               wraps=os.rename) as rename:
+            tilestore.move(self.path('new.tiles'), self.path('images.tiles'))
+        #the data is in place before the index pointing to it
+        self.assertEqual([call[0][1] for call in rename.call_args_list],
+                         [self.path('images.tiles'),
+                          self.path('images.tiles.idx')])
+        with tilestore.TileStore(self.path('images.tiles')) as store:
+            self.assertEqual(store.get('a.png'), b'new')
+
+    def test_refresh(self):
+        with tilestore.TileStore(self.path('tiles'), mode='a') as writer:
+            writer.add('a.jpg', b'first')
+            reader = tilestore.TileStore(self.path('tiles'))
+            writer.add('b.jpg', b'second')
+            #an entry still being written
+            with open(self.path('tiles.idx'), 'ab') as idx:
+                idx.write(b'c.jpg\t11')
+            self.assertNotIn('b.jpg', reader)
+            reader.refresh()
+            self.assertEqual(reader.get('b.jpg'), b'second')
+            self.assertNotIn('c.jpg', reader)
+            reader.close()
+
+
+class TargetTest(TemporaryDirectoryTestCase):
+
+    def target(self, size, name='target.jpg'):
+        #red on the left, blue on the right
+        img = Image.new('RGB', size, (255, 0, 0))
+        img.paste((0, 0, 255), (size[0] // 2, 0, size[0], size[1]))
+        img.save(self.path(name))
+        return self.path(name)
+
+    def test_draft(self):
+        target = self.target((2000, 1000))
+        draft = JpegImagePlugin.JpegImageFile.draft
+        with mock.patch.object(JpegImagePlugin.JpegImageFile, 'draft',
+                               autospec=True, side_effect=draft) as drafted:
+            img = osaic.load_target(target, 10, 5)
+        #decoded at 1/8 (250x125), then resized to 8 pixels per tile
+        self.assertEqual(drafted.call_args[0][1:], ('RGB', (80, 40)))
+        self.assertEqual(img.size, (80, 40))
+        colors = osaic.grid_colors(img, 10, 5)
+        for row in range(5):
+            for (red, green, blue) in colors[row * 10:row * 10 + 4]:
+                self.assertTrue(red > 240 and blue < 15, colors)
+            for (red, green, blue) in colors[row * 10 + 6:row * 10 + 10]:
+                self.assertTrue(red < 15 and blue > 240, colors)
+
+    def test_size(self):
+        #never larger than the target, never smaller than the lattice
+        self.assertEqual(osaic.load_target(self.target((30, 20)), 10, 5)
+                         .size, (30, 20))
+        self.assertEqual(osaic.load_target(self.target((5, 3)), 10, 5)
+                         .size, (10, 5))
+        self.assertEqual(osaic.load_target(self.target((300, 200)), 10, 5,
+                                           cell_size=2).size, (20, 10))
+
+
+class BatchTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        #sources are only reused once all of them are, so there are
+        #enough of each color for every cell of that color
+        self.sources = []
+        for (name, color) in (('red', (255, 0, 0)), ('green', (0, 255, 0)),
+                              ('blue', (0, 0, 255))):
+            for i in range(32):
+                self.sources.append(self.path('%s-%d.png' % (name, i)))
+                Image.new('RGB', (8, 8), color).save(self.sources[-1])
+        #red on the left, blue on the right
+        self.wide = self.path('wide.png')
+        image = Image.new('RGB', (200, 100), (255, 0, 0))
+        image.paste((0, 0, 255), (100, 0, 200, 100))
+        image.save(self.wide)
+        #green on top, red below
+        self.tall = self.path('tall.png')
+        image = Image.new('RGB', (100, 200), (0, 255, 0))
+        image.paste((255, 0, 0), (0, 100, 100, 200))
+        image.save(self.tall)
+
+    def test_targets(self):
+        (wide, tall) = osaic.mosaicify_batch([self.wide, self.tall],
+                                             self.sources, tiles=4)
+        #the tiles of the first target...
+        self.assertEqual((wide.layout['tiles_x'], wide.layout['tiles_y']),
+                         (4, 4))
+        self.assertEqual((wide.layout['width'], wide.layout['height']),
+                         (200, 100))
+        #...in a lattice of the ratio of each target
+        self.assertEqual((tall.layout['tiles_x'], tall.layout['tiles_y']),
+                         (4, 16))
+        self.assertEqual((tall.layout['width'], tall.layout['height']),
+                         (200, 400))
+        names = lambda mosaic: [os.path.basename(name).split('-')[0]
+                                for name in mosaic.layout['best_matching']]
+        self.assertEqual(names(wide), ['red', 'red', 'blue', 'blue'] * 4)
+        self.assertEqual(names(tall), ['green'] * 32 + ['red'] * 32)
+
+    def test_save_all(self):
+        (mosaic,) = osaic.mosaicify_batch([self.wide], self.sources, tiles=4)
+        specs = [osaic.OutputSpec(self.path('full.png')),
+                 osaic.OutputSpec(self.path('half.jpg'), 0.5, quality=95),
+                 osaic.OutputSpec(self.path('low.jpg'), 0.5, quality=10),
+                 osaic.OutputSpec.parse(self.path('thumb.png') + ':50x50')]
+        mosaic.save_all(specs)
+        sizes = dict((name, Image.open(self.path(name)).size)
+                     for name in ('full.png', 'half.jpg', 'low.jpg',
+                                  'thumb.png'))
+        #tiles of 50x25, 25x12, and 12x6 to fit 50x50
+        self.assertEqual(sizes, {'full.png': (200, 100),
+                                 'half.jpg': (100, 48),
+                                 'low.jpg': (100, 48),
+                                 'thumb.png': (48, 24)})
+        self.assertEqual(Image.open(self.path('full.png')).getpixel((10, 10)),
+                         (255, 0, 0))
+        self.assertEqual(Image.open(self.path('thumb.png')).getpixel((40, 20)),
+                         (0, 0, 255))
+        self.assertLess(os.path.getsize(self.path('low.jpg')),
+                        os.path.getsize(self.path('half.jpg')))
+        self.assertRaises(ValueError, mosaic.save_all,
+                          [osaic.OutputSpec(self.path('big.png'), 2)])
+
+
+class FramesTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(FramesTest, self).setUp()
+        self.sources = []
+        for (name, color) in (('red', (255, 0, 0)), ('blue', (0, 0, 255))):
+            for i in range(4):
+                self.sources.append(self.path('%s-%d.png' % (name, i)))
+                Image.new('RGB', (8, 8), color).save(self.sources[-1])
+
+    def frame(self, name, color, corner=None):
+        image = Image.new('RGB', (40, 40), color)
+        if corner is not None:
+            image.paste(corner, (0, 0, 20, 20))
+        image.save(self.path(name))
+        return self.path(name)
+
+    def test_threshold(self):
+        frames = [self.frame('1.png', (255, 0, 0)),
+                  #slightly darker, with a blue top left corner
+                  self.frame('2.png', (245, 5, 0), (0, 0, 255)),
+                  self.frame('3.png', (255, 0, 0))]
+        with mock.patch.object(osaic.ImageList, 'match', autospec=True,
+                               side_effect=osaic.ImageList.match) as match:
+            layouts = [mosaic.layout['best_matching'] for mosaic in
+                       osaic.mosaicify_frames(frames, self.sources, tiles=2)]
+        #only the tiles past the threshold are matched again
+        self.assertEqual([len(call[0][1]) for call in match.call_args_list],
+                         [4, 1, 1])
+        (first, second, third) = layouts
+        self.assertEqual(len(set(first)), 4)
+        self.assertTrue(all('red' in name for name in first))
+        self.assertIn('blue', second[0])
+        self.assertEqual(second[1:], first[1:])
+        #the tiles kept are reserved: the corner gets its red back
+        self.assertEqual(third, first)
+
+
+class MosaicTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(MosaicTest, self).setUp()
+        #a red and a gray tile of 4x2 pixels, on a 2x2 lattice: 8x4 pixels
+        atlas = numpy.empty((2, 2, 4, 3), numpy.uint8)
+        atlas[0] = (200, 0, 0)
+        atlas[1] = (100, 100, 100)
+        self.table = osaic.SourceTable(['red.png', 'gray.png'],
+                                       [(200, 0, 0), (100, 100, 100)], atlas)
+        self.indices = [0, 1, 1, 0]
+
+    def pixels(self, mosaic=None, name='mosaic.png'):
+        if mosaic is not None:
+            mosaic.save(self.path(name))
+        image = Image.open(self.path(name))
+        return [image.getpixel((x, y)) for y in (0, 3) for x in (0, 7)]
+
+    def test_blend(self):
+        #white on the left, black on the right
+        target = self.path('target.png')
+        image = Image.new('RGB', (80, 40), (255, 255, 255))
+        image.paste((0, 0, 0), (40, 0, 80, 40))
+        image.save(target)
+        mosaic = osaic.Mosaic(self.table, self.indices, (2, 2))
+        self.assertEqual(self.pixels(mosaic), [(200, 0, 0), (100, 100, 100),
+                                               (100, 100, 100), (200, 0, 0)])
+        self.assertEqual(self.pixels(mosaic.blended(
+            osaic.Overlay(target, 0.5))), [(227, 127, 127), (50, 50, 50),
+                                           (177, 177, 177), (100, 0, 0)])
+        self.assertEqual(self.pixels(mosaic.blended(
+            osaic.Overlay(target, 1))), [(255, 255, 255), (0, 0, 0),
+                                         (255, 255, 255), (0, 0, 0)])
+        #a box of the image is blended with the same part of the target
+        overlay = osaic.Overlay(target, 0.5)
+        pixels = numpy.full((1, 2, 3), 100, numpy.uint8)
+        self.assertEqual(overlay.blend(pixels, (0, 0, 2, 1), (8, 4))
+                         .tolist(), [[[177, 177, 177]] * 2])
+        self.assertEqual(overlay.blend(pixels, (6, 3, 8, 4), (8, 4))
+                         .tolist(), [[[50, 50, 50]] * 2])
+
+    def test_correction(self):
+        layout = {'target_colors': [(0, 200, 0), (100, 100, 100),
+                                    (255, 255, 255), (0, 0, 0)]}
+        mosaic = osaic.Mosaic(self.table, self.indices, (2, 2), layout,
+                              correction=1)
+        #fully corrected tiles have the colors of their cells
+        self.assertEqual(self.pixels(mosaic), [(0, 200, 0), (100, 100, 100),
+                                               (255, 255, 255), (0, 0, 0)])
+        mosaic.correction = 0.5
+        mosaic._image = None
+        expected = [(100, 100, 0), (100, 100, 100), (178, 178, 178),
+                    (100, 0, 0)]
+        self.assertEqual(self.pixels(mosaic), expected)
+        #all the outputs have the same shifts
+        mosaic.save_all([osaic.OutputSpec(self.path('all.png'))])
+        self.assertEqual(self.pixels(name='all.png'), expected)
+        self.assertEqual(self.pixels(osaic.Mosaic(
+            self.table, self.indices, (2, 2), layout)),
+            [(200, 0, 0), (100, 100, 100), (100, 100, 100), (200, 0, 0)])
+
+
+class PyramidTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(PyramidTest, self).setUp()
+        sources = []
+        for (name, color) in (('red', (255, 0, 0)), ('blue', (0, 0, 255))):
+            sources.append(self.path('%s.png' % name))
+            Image.new('RGB', (40, 40), color).save(sources[-1])
+        #4x2 tiles of 150 pixels: a 600x300 image
+        self.layout = {'tiles_x': 4, 'tiles_y': 2,
+                       'best_matching': [sources[i % 2] for i in range(8)]}
+        self.destination = self.path('mosaic.dzi')
+
+    def render(self, pool):
+        return pyramid.render_pyramid(self.layout, self.destination,
+                                      (150, 150), region_size=256,
+                                      pool=pool)
+
+    def level_tiles(self, level):
+        directory = self.path('mosaic_files', str(level))
+        return dict((name, Image.open(os.path.join(directory, name)).size)
+                    for name in os.listdir(directory))
+
+    def test_levels(self):
+        self.assertEqual(self.render(SerialPool()), (600, 300))
+        top = pyramid.levels(600, 300) - 1
+        self.assertEqual(self.level_tiles(top), {
+            '0_0.jpg': (256, 256), '1_0.jpg': (256, 256),
+            '2_0.jpg': (88, 256), '0_1.jpg': (256, 44),
+            '1_1.jpg': (256, 44), '2_1.jpg': (88, 44)})
+        self.assertEqual(self.level_tiles(top - 1), {
+            '0_0.jpg': (256, 150), '1_0.jpg': (44, 150)})
+        for level in range(top - 1):
+            self.assertEqual(self.level_tiles(level), {
+                '0_0.jpg': pyramid.level_size(600, 300, level, top)})
+        #the reduced level shows the tiles of the one below
+        tile = Image.open(self.path('mosaic_files', str(top - 1), '0_0.jpg'))
+        (red, green, blue) = tile.getpixel((30, 30))
+        self.assertTrue(red > 200 and blue < 50)
+        (red, green, blue) = tile.getpixel((100, 30))
+        self.assertTrue(blue > 200 and red < 50)
+        with open(self.destination) as f:
+            self.assertIn('Width="600" Height="300"', f.read())
+
+    def test_resume(self):
+        self.assertRaises(KeyboardInterrupt, self.render,
+                          SerialPool(fail_after=2))
+        resumed = SerialPool()
+        self.render(resumed)
+        regions = list(pyramid.regions(600, 300, 256))
+        #the regions done before being killed aren't rendered again
+        self.assertEqual(sorted(job for job in resumed.jobs
+                                if len(job) == 4), sorted(regions[2:]))
+        self.assertEqual(len(self.level_tiles(pyramid.levels(600, 300) - 1)),
+                         6)
+        again = SerialPool()
+        self.render(again)
+        self.assertEqual(again.jobs, [])
+        #another layout starts over
+        self.layout['best_matching'].reverse()
+        again = SerialPool()
+        self.render(again)
+        self.assertEqual(len([job for job in again.jobs if len(job) == 4]),
+                         len(regions))
+
+    def test_region(self):
+        #a source in a column the region doesn't cover
+        green = self.path('green.png')
+        Image.new('RGB', (40, 40), (0, 255, 0)).save(green)
+        self.layout['best_matching'][2] = green
+        self.layout['target_colors'] = [(0, 255, 0)] * 8
+        top = pyramid.levels(600, 300) - 1
+        os.makedirs(self.path(str(top)))
+        with mock.patch.object(osaic, 'ImageWrapper',
+                               wraps=osaic.ImageWrapper) as wrapper:
+            self.assertEqual(pyramid.render_region(
+                (0, 0, 256, 256), self.layout, (150, 150), self.directory,
+                correction=0.5), ((0, 0, 256, 256), 1))
+        self.assertEqual(sorted(call[1]['filename']
+                                for call in wrapper.call_args_list),
+                         sorted(self.layout['best_matching'][:2]))
+        tile = Image.open(pyramid.tile_path(self.directory, top, 0, 0, 'jpg'))
+        self.assertEqual(tile.size, (256, 256))
+        #red and blue tiles, half way to green
+        for (pixel, expected) in (((30, 30), (127, 128, 0)),
+                                  ((200, 200), (0, 128, 127))):
+            for (value, expected_value) in zip(tile.getpixel(pixel),
+                                               expected):
+                self.assertAlmostEqual(value, expected_value, delta=8)
+
+
+class RenderJobTest(TemporaryDirectoryTestCase):
+
+    def test_resume(self):
+        job = osaic.RenderJob(self.directory, target='a.jpg', tiles=10)
+        self.assertFalse(job.resumed)
+        self.assertIsNone(job.load_json('layout'))
+        job.save_json('layout', {'tiles_x': 10})
+        job.mark_done('stage')
+        table = osaic.SourceTable(['a.jpg', 'b.jpg'],
+                                  numpy.array([[1, 2, 3], [4, 5, 6]]),
+                                  numpy.zeros((2, 4, 4, 3), numpy.uint8),
+                                  ids=numpy.array([1, 0]))
+        job.save_table(table, {'c.jpg': 'a.jpg'})
+
+        job = osaic.RenderJob(self.directory, tiles=10, target='a.jpg')
+        self.assertTrue(job.resumed)
+        self.assertEqual(job.load_json('layout'), {'tiles_x': 10})
+        self.assertTrue(job.done('stage'))
+        (loaded, duplicates) = job.load_table()
+        self.assertEqual(duplicates, {'c.jpg': 'a.jpg'})
+        self.assertEqual(loaded.colors.tolist(), table.colors.tolist())
+        self.assertEqual(loaded.ids.tolist(), [1, 0])
+        self.assertEqual(loaded.atlas.shape, (2, 4, 4, 3))
+
+        job = osaic.RenderJob(self.directory, target='b.jpg', tiles=10)
+        self.assertFalse(job.resumed)
+        self.assertFalse(job.done('stage'))
+        self.assertIsNone(job.load_table())
+
+    def test_foreign_files(self):
+        with open(self.path('notes.txt'), 'w') as f:
+            f.write('mine')
+        os.mkdir(self.path('photos'))
+        job = osaic.RenderJob(self.directory, target='a.jpg')
+        job.save_json('match-0', [1, 2])
+        job.mark_done('stage')
+        job._replace('partial.npy.tmp', lambda f: None)
+        job = osaic.RenderJob(self.directory, target='b.jpg')
+        #only what the previous job wrote is gone
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['job.json', 'notes.txt', 'photos'])
+
+    def test_batch(self):
+        sources = []
+        for (name, color) in (('red', (255, 0, 0)), ('blue', (0, 0, 255))):
+            sources.append(self.path('%s.png' % name))
+            Image.new('RGB', (8, 8), color).save(sources[-1])
+        with open(self.path('layout.json'), 'w') as f:
+            f.write('{}')
+        for tiles in (2, 3):
+            osaic.mosaicify_batch(sources[:1], sources, tiles=tiles,
+                                  job_dir=self.directory)
+        #the job keeps to its own subdirectory
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['blue.png', 'layout.json', 'red.png', 'render'])
+        self.assertIn('match-0.json', os.listdir(self.path('render')))
+
+
+class SourceIndexTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        super(SourceIndexTest, self).setUp()
+        os.mkdir(self.path('sources'))
+        for (name, color) in (('red', (255, 0, 0)), ('green', (0, 255, 0)),
+                              ('blue', (0, 0, 255))):
+            self.image(name, color)
+        self.index = sourceindex.SourceIndex(self.path('images.index'))
+        self.store = self.path('images.index.tiles')
+
+    def image(self, name, color, size=(40, 40)):
+        Image.new('RGB', size, color).save(self.path('sources',
+                                                     name + '.png'))
+
+    def update(self, thumbnail_size):
+        return self.index.update([self.path('sources')], thumbnail_size,
+                                 pool=SerialPool())
+
+    def packed(self):
+        with tilestore.TileStore(self.store) as store:
+            return (len(store), store.size(), os.path.getsize(self.store))
+
+    def test_thumbnails_size_change(self):
+        self.assertEqual(self.update(16), (3, 0))
+        (count, size, data) = self.packed()
+        self.assertEqual((count, size), (3, data))
+        #the thumbnails are packed again, not appended
+        self.assertEqual(self.update(32), (3, 0))
+        (count, size, data) = self.packed()
+        self.assertEqual((count, size), (3, data))
+        self.assertFalse(os.path.exists(self.store + '.tmp'))
+        self.assertEqual(sourceindex.SourceIndex(self.index.path)
+                         .thumbnail_size, 32)
+        self.update(None)
+        self.assertFalse(os.path.exists(self.store))
+
+    def test_store_compacted(self):
+        self.update(16)
+        for step in range(6):
+            self.image('red', (255, step, 0), size=(40 + step, 40))
+            self.assertEqual(self.update(16), (1, 0))
+            (count, size, data) = self.packed()
+            self.assertEqual(count, 3)
+            self.assertLessEqual(data, 2 * size)
+        os.remove(self.path('sources', 'blue.png'))
+        self.update(16)
+        with tilestore.TileStore(self.store) as store:
+            self.assertLessEqual(os.path.getsize(self.store),
+                                 2 * store.size(self.index.ids()))
+
+    def test_render_loads_only_used(self):
+        self.image('darkred', (200, 0, 0))
+        self.update(None)
+        colors = dict((key, self.index.entries[key]['color'])
+                      for key in self.index.ids())
+        #never matched: loading them would fail
+        colors.update((self.path('sources', 'missing%d.png' % i),
+                       (0, 255, 255)) for i in range(5))
+        target = self.path('target.png')
+        Image.new('RGB', (40, 40), (255, 0, 0)).save(target)
+        (mosaic,) = osaic.mosaicify_index([target], colors, tiles=2,
+                                          duplicates={'a.png': 'b.png'})
+        used = mosaic.layout['best_matching']
+        self.assertEqual(len(used), 4)
+        self.assertEqual(used.count(self.path('sources', 'red.png')), 1)
+        self.assertFalse([name for name in used if 'missing' in name])
+        self.assertEqual(mosaic.layout['duplicates'], {'a.png': 'b.png'})
+        image = self.path('mosaic.png')
+        mosaic.save(image)
+        self.assertEqual(Image.open(image).size,
+                         (mosaic.layout['width'], mosaic.layout['height']))
+
+    def test_render_job(self):
+        self.update(None)
+        colors = dict((key, self.index.entries[key]['color'])
+                      for key in self.index.ids())
+        target = self.path('target.png')
+        Image.new('RGB', (40, 40), (255, 0, 0)).save(target)
+        render = lambda: osaic.mosaicify_index([target], colors, tiles=2,
+                                               job_dir=self.directory)
+        (first,) = render()
+        self.assertTrue(os.path.exists(self.path('render', 'table.json')))
+        #resumed: nothing is matched or loaded again
+        with mock.patch.object(osaic, 'match_target') as match_target, \
+                mock.patch.object(osaic, 'load_matched') as load_matched:
+            (resumed,) = render()
+        self.assertFalse(match_target.called or load_matched.called)
+        self.assertEqual(json.dumps(resumed.layout), json.dumps(first.layout))
+        for (name, mosaic) in (('first.png', first), ('resumed.png', resumed)):
+            mosaic.save(self.path(name))
+        self.assertEqual(Image.open(self.path('first.png')).tobytes(),
+                         Image.open(self.path('resumed.png')).tobytes())
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = replay.ReplayServer(
+            ('127.0.0.1', 0), replay.TweetSource(users=10),
+            replay.Avatars(colors=1), rate=100, max_search_pages=2)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.stopping = True
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_json(self, path):
+        response = urlopen(self.url + path)
+        try:
+            return json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+
+    def test_tweets_due(self):
+        self.assertEqual(replay.tweets_due(0, 10, []), 0)
+        self.assertEqual(replay.tweets_due(2.5, 10, []), 25)
+        #two bursts of 5s in 65s, 90/s above the base rate
+        self.assertEqual(replay.tweets_due(65, 10, [(100, 5, 60)]),
+                         650 + 90 * 10)
+
+    def test_stream_keeps_pace(self):
+        response = urlopen(self.url + '/1.1/statuses/filter.json?track=x')
+        started = time.time()
+        received = 0
+        while time.time() - started < 1:
+            if response.readline().strip():
+                received += 1
+        response.close()
+        #paced by elapsed time, not by how long each loop took
+        self.assertGreater(received, 80)
+        self.assertLess(received, 130)
+
+    def test_search_pages_per_backfill(self):
+        for run in range(2):
+            page = self.get_json('/1.1/search/tweets.json?q=x')
+            self.assertEqual(len(page['statuses']), 15)
+            max_id = page['statuses'][-1]['id'] - 1
+            page = self.get_json('/1.1/search/tweets.json?q=x&max_id=%d'
+                                 % max_id)
+            self.assertEqual(len(page['statuses']), 15)
+            page = self.get_json('/1.1/search/tweets.json?q=x&max_id=%d'
+                                 % (max_id - 15))
+            self.assertEqual(page['statuses'], [])
+
+    def test_avatars(self):
+        tweet = self.get_json('/1.1/search/tweets.json?q=x')['statuses'][0]
+        response = urlopen(tweet['user']['profile_image_url'])
+        try:
+            self.assertEqual(response.info()['Content-Type'], 'image/jpeg')
+            self.assertTrue(response.read())
+        finally:
+            response.close()
+        self.assertEqual(self.server.metrics.fetched, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+"""Packed storage for collected source images.
+
+Collecting avatars for a busy hashtag leaves tens of thousands of tiny
+files around, and opening each of them separately costs more than
+actually decoding it.  A ``TileStore`` keeps all of the images inside
+a single append-only data file, next to a small text index with one
+line per image:
+
+    <id>\t<offset>\t<length>
+
+Ids are whatever the caller used to name the image -- by convention the
+path the image would have had on disk (e.g. ``images2/30528628.jpg``) so
+that renders and json data look the same either way.
+
+Appending an id twice is allowed: the last entry wins, the older bytes
+are simply left behind in the data file, until ``compact`` rewrites it
+without them.  The data file is memory mapped
+for reading, so fetching many ids in offset order (see ``sorted``) is a
+sequential scan instead of thousands of open/seek/close calls.
+
+The module can also be used from the command line to pack an existing
+directory of images:
+
+    python tilestore.py images2/ images.tiles
+
+"""
+
+import io
+import mmap
+import os
+import sys
+
+
+class TileStore(object):
+    """Append-only data file plus an ``id -> (offset, length)`` index."""
+
+    def __init__(self, path, mode='r'):
+        """Open the store at `path` (the data file; the index lives at
+        `path` + '.idx').  Use mode 'a' to be able to add images; the
+        files are created if they do not exist.
+
+        """
+        if mode not in ('r', 'a'):
+            raise ValueError("mode should be 'r' or 'a'")
+        self.path = path
+        self.index_path = path + '.idx'
+        self.mode = mode
+        self._index = {}
+        self._index_size = 0
+        self._map = None
+        self._map_size = 0
+        self._data = None
+        self._index_file = None
+        if mode == 'a':
+            self._data = open(self.path, 'ab')
+            self._index_file = open(self.index_path, 'ab')
+        self._read_index()
+
+    def _read_index(self):
+        """Load new entries of the index file (it only ever grows)."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as idx:
+            idx.seek(self._index_size)
+            for line in idx:
+                if not line.endswith(b'\n'):
+                    #partially written entry: the writer died or is
+                    #still writing it, in both cases it is not ours yet
+                    break
+                self._index_size += len(line)
+                (tile_id, offset, length) = \
+                    line.decode('utf-8').rstrip('\n').rsplit('\t', 2)
+                self._index[tile_id] = (int(offset), int(length))
+
+    def _mapped(self, end):
+        """Return a memory map of the data file covering at least `end`."""
+        if self._map is None or self._map_size < end:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, 'rb') as data:
+                self._map_size = os.fstat(data.fileno()).st_size
+                self._map = mmap.mmap(data.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        return self._map
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, tile_id):
+        return tile_id in self._index
+
+    def refresh(self):
+        """Pick up images added by another process since opening."""
+        self._read_index()
+
+    def ids(self):
+        """Return all ids, in data file order."""
+        return self.sorted(self._index)
+
+    def sorted(self, ids):
+        """Return `ids` sorted by their position inside the data file.
+
+        Reading images in this order makes bulk loads sequential.
+        Unknown ids are put at the end, so that reading them still
+        raises a ``KeyError``.
+
+        """
+        end = (float('inf'), 0)
+        return sorted(ids, key=lambda i: self._index.get(i, end)[0])
+
+    def size(self, ids=None):
+        """Return the number of bytes of the images of `ids` (all of
+        them by default; unknown ids are ignored)."""
+        return sum(self._index[i][1]
+                   for i in (self._index if ids is None else ids)
+                   if i in self._index)
+
+    def get(self, tile_id):
+        """Return the raw (encoded) bytes stored for `tile_id`."""
+        (offset, length) = self._index[tile_id]
+        if self._data is not None:
+            self._data.flush()
+        return self._mapped(offset + length)[offset:offset + length]
+
+    def open(self, tile_id):
+        """Return a file-like object for the image stored as `tile_id`."""
+        return io.BytesIO(self.get(tile_id))
+
+    def items(self, ids=None):
+        """Iterate over (id, bytes) pairs, sequentially."""
+        for tile_id in self.sorted(self._index if ids is None else ids):
+            yield (tile_id, self.get(tile_id))
+
+    def add(self, tile_id, data):
+        """Append `data` (encoded image bytes) as `tile_id`."""
+        if self._data is None:
+            raise IOError("TileStore was opened read-only")
+        if '\t' in tile_id or '\n' in tile_id:
+            raise ValueError("Tile ids could not contain tabs or newlines.")
+        self._data.seek(0, os.SEEK_END)
+        offset = self._data.tell()
+        self._data.write(data)
+        #the data needs to be on disk before the index points to it
+        self._data.flush()
+        entry = ('%s\t%d\t%d\n' % (tile_id, offset, len(data))).encode('utf-8')
+        self._index_file.write(entry)
+        self._index_file.flush()
+        self._index_size += len(entry)
+        self._index[tile_id] = (offset, len(data))
+
+    def add_file(self, tile_id, fileobj):
+        """Append the content of an open (binary) file as `tile_id`."""
+        self.add(tile_id, fileobj.read())
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        for f in (self._data, self._index_file):
+            if f is not None:
+                f.close()
+        self._data = self._index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def move(path, destination):
+    """Rename the store at `path` (data file and index) to
+    `destination`, replacing the store there if any."""
+    #like for ``add``, the data goes before the index pointing to it
+    os.rename(path, destination)
+    os.rename(path + '.idx', destination + '.idx')
+
+
+def remove(path):
+    """Delete the store at `path`, if there is one."""
+    for name in (path, path + '.idx'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def compact(path, ids=None):
+    """Rewrite the store at `path` with only the images of `ids` (all
+    of them by default), dropping the bytes of the replaced entries.
+    Return the number of bytes freed.
+
+    The new store is written aside, then renamed over the old one: it
+    shouldn't be read meanwhile.
+
+    """
+    temporary = path + '.tmp'
+    remove(temporary)
+    with TileStore(path) as old:
+        with TileStore(temporary, mode='a') as new:
+            for (tile_id, data) in old.items(
+                    None if ids is None else [i for i in ids if i in old]):
+                new.add(tile_id, data)
+    freed = os.path.getsize(path) - os.path.getsize(temporary)
+    move(temporary, path)
+    return freed
+
+
+def pack_directory(directory, path, extensions=('jpg', 'jpeg', 'png')):
+    """Add every image of `directory`, not already packed, to the store
+    at `path`.  Return the number of images added."""
+    added = 0
+    with TileStore(path, mode='a') as store:
+        for name in sorted(os.listdir(directory)):
+            if name.rsplit('.', 1)[-1].lower() not in extensions:
+                continue
+            tile_id = os.path.join(directory, name)
+            if tile_id in store:
+                continue
+            with open(tile_id, 'rb') as f:
+                store.add_file(tile_id, f)
+            added += 1
+    return added
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: %s IMAGE_DIR STORE' % sys.argv[0])
+        exit(1)
+    print('packed', pack_directory(sys.argv[1], sys.argv[2]), 'images')